@@ -0,0 +1,125 @@
+import argparse
+import ctypes
+import os
+import random
+import sys
+import time
+
+# Measure the per-token cost of turning the byte pieces of the runtime callback into text.
+# "legacy" replays the former split_byte_data concatenate-and-retry decoding, "decoder" is token_decoder.TokenDecoder,
+# and "callback" is the complete callback_impl of flask_server.py (token echo off) called through ctypes.
+# Usage: python3 bench_callback.py [--lib ./build/librkllmrt.so] [--tokens 200000] [--text cjk|ascii]
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, "..", "rkllm_server")
+
+SAMPLE_TEXT = {
+    "cjk": "瑞芯微RKLLM在板端运行大语言模型，支持流式输出。🚀 これは日本語のテキストです。한국어 텍스트도 포함됩니다. ",
+    "ascii": "RKLLM runs large language models on the board and streams the output token by token. ",
+}
+
+
+# Cut the UTF-8 bytes of text into pieces of 1 to 4 bytes, so multi-byte characters are split like BPE tokens split them.
+def make_pieces(text, count, seed=0):
+    rng = random.Random(seed)
+    data = text.encode("utf-8")
+    pieces = []
+    position = 0
+    while len(pieces) < count:
+        size = rng.randint(1, 4)
+        piece = data[position:position + size]
+        if len(piece) < size:
+            piece += data[:size - len(piece)]
+        pieces.append(piece)
+        position = (position + size) % len(data)
+    return pieces
+
+
+def run_legacy(pieces):
+    output = []
+    split_byte_data = bytes(b"")
+    for piece in pieces:
+        try:
+            output.append((split_byte_data + piece).decode('utf-8'))
+            split_byte_data = bytes(b"")
+        except:
+            split_byte_data += piece
+    return output, split_byte_data
+
+
+def run_decoder(pieces):
+    from token_decoder import TokenDecoder
+    output = []
+    decoder = TokenDecoder()
+    for piece in pieces:
+        text = decoder.decode(piece)
+        if text:
+            output.append(text)
+    output.append(decoder.flush())
+    return output, b""
+
+
+def run_callback(server, pieces):
+    from rkllm_runtime import RKLLMResult
+
+    stream_id, stream = server.open_token_stream()
+    stream.queue.maxsize = 0 # Nobody consumes the output during the measurement
+    results = []
+    for piece in pieces:
+        result = RKLLMResult()
+        result.text = piece
+        results.append(ctypes.pointer(result))
+    normal = server.LLMCallState.RKLLM_RUN_NORMAL
+    start = time.perf_counter()
+    for result in results:
+        server.callback(result, stream_id, normal)
+    elapsed = time.perf_counter() - start
+    server.callback(ctypes.pointer(RKLLMResult()), stream_id, server.LLMCallState.RKLLM_RUN_FINISH)
+    output = []
+    while not stream.queue.empty():
+        _, text, _ = stream.queue.get_nowait()
+        if text:
+            output.append(text)
+    server.close_token_stream(stream_id)
+    return elapsed, output
+
+
+def measure(name, func, pieces):
+    start = time.perf_counter()
+    output, buffered = func(pieces)
+    elapsed = time.perf_counter() - start
+    print(f"[{name}] {elapsed / len(pieces) * 1e9:8.0f} ns/token, {len(''.join(output))} chars, {len(buffered)} bytes left buffered")
+    return "".join(output), buffered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lib', type=str, default=os.path.join(BENCH_DIR, "build", "librkllmrt.so"), help='Path of the stub librkllmrt.so built by build_stub.sh;')
+    parser.add_argument('--tokens', type=int, default=200000, help='Number of byte pieces fed to each decoder;')
+    parser.add_argument('--text', type=str, default="cjk", choices=sorted(SAMPLE_TEXT), help='Sample text the pieces are cut from;')
+    args = parser.parse_args()
+
+    os.environ["RKLLM_LIB_PATH"] = os.path.abspath(args.lib)
+    sys.path.insert(0, SERVER_DIR)
+    import flask_server as server
+    server.TOKEN_ECHO = False
+
+    pieces = make_pieces(SAMPLE_TEXT[args.text], args.tokens)
+    legacy_text, legacy_buffered = measure("legacy  ", run_legacy, pieces)
+    decoder_text, _ = measure("decoder ", run_decoder, pieces)
+    elapsed, callback_output = run_callback(server, pieces)
+    print(f"[callback] {elapsed / len(pieces) * 1e9:8.0f} ns/token, {len(''.join(callback_output))} chars")
+    # The legacy decoding drops the bytes still buffered at the end; the decoder flushes them as U+FFFD.
+    expected_text = legacy_text + legacy_buffered.decode("utf-8", errors="replace")
+    if not expected_text == decoder_text == "".join(callback_output):
+        print("Error: the decoded outputs differ.")
+        sys.exit(1)
+
+    # A stream that starts in the middle of a character: the legacy decoding never recovers and buffers every byte.
+    broken = [b"\x9f"] + pieces[:10000]
+    measure("legacy   mid-character start", run_legacy, broken)
+    broken_text, _ = measure("decoder  mid-character start", run_decoder, broken)
+    if broken_text != "\ufffd" + decoder_text[:len(broken_text) - 1]:
+        print("Error: the decoder did not recover from a mid-character start.")
+        sys.exit(1)
+    print("outputs identical")
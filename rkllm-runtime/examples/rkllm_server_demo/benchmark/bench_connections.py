@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from urllib.parse import urlparse
+
+# Open many concurrent streaming /rkllm_chat requests against a running server and report how many it served, how
+# many it rejected or dropped, and the peak memory and thread count of the server process.
+# Most connections sit in the instance queue, which is what costs a thread each in the Flask server.
+# Usage: python3 bench_connections.py --url http://127.0.0.1:8080 --pid [Server PID] [--connections 200] [--timeout 120]
+
+
+def read_proc_status(pid):
+    status = {}
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                key, _, value = line.partition(":")
+                status[key] = value.strip()
+    except OSError:
+        return None
+    return {"rss_mb": int(status["VmRSS"].split()[0]) / 1024.0, "threads": int(status["Threads"])}
+
+
+async def sample_process(pid, peak, stop):
+    while not stop.is_set():
+        sample = read_proc_status(pid)
+        if sample is not None:
+            peak["rss_mb"] = max(peak["rss_mb"], sample["rss_mb"])
+            peak["threads"] = max(peak["threads"], sample["threads"])
+        try:
+            await asyncio.wait_for(stop.wait(), 0.1)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def stream_request(host, port, body, timeout, results):
+    start = time.monotonic()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        results["connect_failed"] += 1
+        return
+    try:
+        writer.write((f"POST /rkllm_chat HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                      f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode("utf-8") + body)
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        if not status_line:
+            results["dropped"] += 1
+            return
+        status = int(status_line.split()[1])
+        # Connection: close, so the response ends when the server closes the connection.
+        remaining = timeout - (time.monotonic() - start)
+        await asyncio.wait_for(reader.read(), max(0.0, remaining))
+        if status == 200:
+            results["served"] += 1
+            results["seconds"].append(time.monotonic() - start)
+        elif status == 503:
+            results["rejected"] += 1
+        else:
+            results["failed"] += 1
+    except asyncio.TimeoutError:
+        results["timed_out"] += 1
+    except (OSError, ValueError, IndexError):
+        results["dropped"] += 1
+    finally:
+        writer.close()
+
+
+async def main(args):
+    url = urlparse(args.url)
+    body = json.dumps({"messages": [{"role": "user", "content": args.prompt}], "stream": True}).encode("utf-8")
+    results = {"served": 0, "rejected": 0, "failed": 0, "dropped": 0, "timed_out": 0, "connect_failed": 0, "seconds": []}
+
+    idle = read_proc_status(args.pid) if args.pid else None
+    peak = {"rss_mb": 0.0, "threads": 0}
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_process(args.pid, peak, stop)) if args.pid else None
+
+    start = time.monotonic()
+    await asyncio.gather(*[stream_request(url.hostname, url.port or 80, body, args.timeout, results) for _ in range(args.connections)])
+    wall = time.monotonic() - start
+    stop.set()
+    if sampler is not None:
+        await sampler
+
+    seconds = sorted(results.pop("seconds"))
+    report = dict(results, connections=args.connections, wall_seconds=round(wall, 2))
+    if seconds:
+        report["p50_request_seconds"] = round(seconds[len(seconds) // 2], 3)
+        report["max_request_seconds"] = round(seconds[-1], 3)
+    if idle is not None:
+        report["idle_rss_mb"] = round(idle["rss_mb"], 1)
+        report["idle_threads"] = idle["threads"]
+        report["peak_rss_mb"] = round(peak["rss_mb"], 1)
+        report["peak_threads"] = peak["threads"]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8080', help='Base URL of the RKLLM server;')
+    parser.add_argument('--pid', type=int, help='PID of the server process, to sample its memory and threads;')
+    parser.add_argument('--connections', type=int, default=200, help='Number of concurrent streaming requests;')
+    parser.add_argument('--prompt', type=str, default='Hello', help='User message sent by every request;')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Seconds after which a request is counted as timed out;')
+    args = parser.parse_args()
+    if args.connections > 1000 and os.name == "posix":
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, args.connections + 64), hard))
+    asyncio.run(main(args))
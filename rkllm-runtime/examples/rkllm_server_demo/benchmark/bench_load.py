@@ -0,0 +1,387 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlparse
+
+# Replay a prompt-length/output-length distribution against the OpenAI-compatible streaming endpoint at a fixed
+# concurrency (closed loop) or a fixed request rate (open loop) and report p50/p99 TTFT, inter-token latency,
+# throughput, server CPU per token and server RSS.
+# With --launch the server is started on the stub librkllmrt.so (see run_stub_server.py), so the whole Python serving
+# stack is measured without a board; the --max_* / --min_* options turn the run into a pass/fail check for CI.
+# Usage: python3 bench_load.py --launch flask [--requests 200] [--concurrency 8 | --qps 20]
+#                              [--prompt_tokens 32:512] [--output_tokens 16:128] [--json result.json]
+#        python3 bench_load.py --url http://127.0.0.1:8080 --pid [Server PID] ...
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+# Servers serving /v1/chat/completions, which --launch can start.
+SERVERS = {"flask": "flask_server.py"}
+# The stub counts one prompt token per 4 bytes of text.
+PROMPT_WORD = "tok "
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+# "N" or "MIN:MAX" (uniform).
+def parse_range(value):
+    low, _, high = value.partition(":")
+    return int(low), int(high or low)
+
+
+# The (prompt_tokens, output_tokens) of every request: from a JSON lines trace with those two keys, or drawn from the
+# --prompt_tokens / --output_tokens ranges with a fixed seed so that runs are comparable.
+def make_workload(args):
+    if args.trace:
+        with open(args.trace) as trace_file:
+            items = [json.loads(line) for line in trace_file if line.strip()]
+        workload = [(int(item["prompt_tokens"]), int(item["output_tokens"])) for item in items]
+        return (workload * (args.requests // len(workload) + 1))[:args.requests]
+    rng = random.Random(args.seed)
+    prompt_range = parse_range(args.prompt_tokens)
+    output_range = parse_range(args.output_tokens)
+    return [(rng.randint(*prompt_range), rng.randint(*output_range)) for _ in range(args.requests)]
+
+
+class ProcessSampler(object):
+    def __init__(self, pid):
+        self.pid = pid
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.peak_rss_mb = 0.0
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as stat_file:
+            fields = stat_file.read().rpartition(")")[2].split()
+        return (int(fields[11]) + int(fields[12])) / self.clock_ticks # utime + stime
+
+    def rss_mb(self):
+        with open(f"/proc/{self.pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+        return 0.0
+
+    async def sample(self, stop):
+        while not stop.is_set():
+            try:
+                self.peak_rss_mb = max(self.peak_rss_mb, self.rss_mb())
+            except OSError:
+                return
+            try:
+                await asyncio.wait_for(stop.wait(), 0.05)
+            except asyncio.TimeoutError:
+                pass
+
+
+# The response body as it arrives, with the chunked transfer encoding of HTTP/1.1 servers removed.
+async def read_body(reader, chunked):
+    if not chunked:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            yield data
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+            return
+        data = await reader.readexactly(size)
+        await reader.readexactly(2)
+        yield data
+
+
+# Send one streaming chat completion and record when each piece of text arrived.
+async def run_request(host, port, prompt_tokens, output_tokens, timeout, headers=()):
+    body = json.dumps({
+        "messages": [{"role": "user", "content": PROMPT_WORD * prompt_tokens}],
+        "max_tokens": output_tokens,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }).encode("utf-8")
+    result = {"status": None, "arrivals": [], "completion_tokens": None}
+    start = time.perf_counter()
+    result["start"] = start
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        result["status"] = "connect_failed"
+        return result
+    try:
+        extra = "".join(f"{header}\r\n" for header in headers)
+        writer.write((f"POST /v1/chat/completions HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n{extra}"
+                      f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode("utf-8") + body)
+        await writer.drain()
+
+        async def consume():
+            status_line = await reader.readline()
+            result["status"] = int(status_line.split()[1])
+            chunked = False
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = header.decode("latin-1").partition(":")
+                if name.strip().lower() == "transfer-encoding" and "chunked" in value.lower():
+                    chunked = True
+            pending = b""
+            async for data in read_body(reader, chunked):
+                now = time.perf_counter()
+                pending += data
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    if not line.startswith(b"data: ") or line.startswith(b"data: [DONE]"):
+                        continue
+                    chunk = json.loads(line[6:])
+                    if chunk.get("usage"):
+                        result["completion_tokens"] = chunk["usage"]["completion_tokens"]
+                    for choice in chunk.get("choices", []):
+                        if (choice.get("delta") or {}).get("content"):
+                            result["arrivals"].append(now)
+
+        await asyncio.wait_for(consume(), timeout)
+    except asyncio.TimeoutError:
+        result["status"] = "timed_out"
+    except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+        result["status"] = result["status"] or "dropped"
+    finally:
+        writer.close()
+    result["end"] = time.perf_counter()
+    return result
+
+
+async def run_load(args, host, port, workload):
+    if args.qps:
+        # Open loop: request i starts at i / qps seconds, however long the earlier ones take.
+        async def delayed(index, prompt_tokens, output_tokens):
+            await asyncio.sleep(max(0.0, start + index / args.qps - time.perf_counter()))
+            return await run_request(host, port, prompt_tokens, output_tokens, args.timeout, args.header)
+        start = time.perf_counter()
+        return await asyncio.gather(*[delayed(index, *item) for index, item in enumerate(workload)])
+
+    # Closed loop: each of the --concurrency clients sends its next request as soon as the previous one finished.
+    pending = list(reversed(workload))
+    results = []
+
+    async def client():
+        while pending:
+            results.append(await run_request(host, port, *pending.pop(), args.timeout, args.header))
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    return results
+
+
+# Keep the server busy with a /rkllm_batch of items (in its batch lane) until cancelled; counts the finished items.
+async def run_background_batch(host, port, items, output_tokens, finished):
+    body = json.dumps({"prompts": [PROMPT_WORD * 64] * items, "max_tokens": output_tokens}).encode("utf-8")
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write((f"POST /rkllm_batch HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                      f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode("utf-8") + body)
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if b'"rkllm_batch.item"' in line:
+                finished.append(line)
+    finally:
+        writer.close()
+
+
+# Send the warm-up requests, then the measured load while sampling the server process.
+async def measure(args, host, port, workload, sampler):
+    if args.warmup:
+        await asyncio.gather(*[run_request(host, port, prompt_tokens, output_tokens, args.timeout, args.header)
+                               for prompt_tokens, output_tokens in workload[:args.warmup]])
+    background = None
+    background_items = []
+    if args.background_batch:
+        background = asyncio.ensure_future(run_background_batch(host, port, args.background_batch,
+                                                                parse_range(args.output_tokens)[1], background_items))
+        await asyncio.sleep(0.5) # Let the batch take the instances first
+    stop = asyncio.Event()
+    sampling = asyncio.ensure_future(sampler.sample(stop)) if sampler else None
+    cpu_start = sampler.cpu_seconds() if sampler else None
+    wall_start = time.perf_counter()
+    results = await run_load(args, host, port, workload)
+    wall_seconds = time.perf_counter() - wall_start
+    cpu_seconds = sampler.cpu_seconds() - cpu_start if sampler else None
+    if sampling:
+        stop.set()
+        await sampling
+    if background:
+        background.cancel()
+        try:
+            await background
+        except (asyncio.CancelledError, OSError):
+            pass
+        print(f"background batch items finished during the run: {len(background_items)}")
+    return results, wall_seconds, cpu_seconds
+
+
+def rounded(value):
+    return None if value is None else round(value, 2)
+
+
+def summarize(results, wall_seconds, cpu_seconds, peak_rss_mb):
+    served = [result for result in results if result["status"] == 200 and result["arrivals"]]
+    ttft = [(result["arrivals"][0] - result["start"]) * 1000 for result in served]
+    itl = [(b - a) * 1000 for result in served for a, b in zip(result["arrivals"], result["arrivals"][1:])]
+    tokens = sum(result["completion_tokens"] if result["completion_tokens"] is not None else len(result["arrivals"])
+                 for result in served)
+    errors = {}
+    for result in results:
+        if result not in served:
+            errors[str(result["status"])] = errors.get(str(result["status"]), 0) + 1
+    return {
+        "requests": len(results),
+        "served": len(served),
+        "errors": errors,
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(len(served) / wall_seconds, 2) if wall_seconds > 0 else None,
+        "completion_tokens": tokens,
+        "tokens_per_second": round(tokens / wall_seconds, 2) if wall_seconds > 0 else None,
+        "ttft_p50_ms": rounded(percentile(ttft, 50)),
+        "ttft_p99_ms": rounded(percentile(ttft, 99)),
+        "itl_p50_ms": rounded(percentile(itl, 50)),
+        "itl_p99_ms": rounded(percentile(itl, 99)),
+        "cpu_us_per_token": round(cpu_seconds / tokens * 1e6, 1) if cpu_seconds is not None and tokens else None,
+        "peak_rss_mb": round(peak_rss_mb, 1) if peak_rss_mb else None,
+    }
+
+
+def report(summary):
+    def ms(value):
+        return "-" if value is None else f"{value:.2f}"
+    print(f"requests={summary['requests']} served={summary['served']} errors={summary['errors'] or 0} wall={summary['wall_seconds']}s")
+    print(f"  throughput  : {summary['requests_per_second']} req/s, {summary['tokens_per_second']} tokens/s ({summary['completion_tokens']} tokens)")
+    print(f"  TTFT ms     : p50={ms(summary['ttft_p50_ms'])} p99={ms(summary['ttft_p99_ms'])}")
+    print(f"  ITL  ms     : p50={ms(summary['itl_p50_ms'])} p99={ms(summary['itl_p99_ms'])}")
+    print(f"  server CPU  : {summary['cpu_us_per_token']} us/token")
+    print(f"  server RSS  : {summary['peak_rss_mb']} MB peak")
+    sys.stdout.flush()
+
+
+# Compare the summary with the --max_* / --min_* limits; returns the violated ones.
+def check_limits(args, summary):
+    failures = []
+    for key, limit, is_max in (("ttft_p99_ms", args.max_ttft_p99_ms, True), ("itl_p99_ms", args.max_itl_p99_ms, True),
+                               ("cpu_us_per_token", args.max_cpu_us_per_token, True),
+                               ("peak_rss_mb", args.max_rss_mb, True),
+                               ("tokens_per_second", args.min_tokens_per_second, False)):
+        if limit is None:
+            continue
+        value = summary[key]
+        if value is None or (value > limit if is_max else value < limit):
+            failures.append(f"{key}={value} ({'max' if is_max else 'min'} {limit})")
+    if summary["served"] < summary["requests"]:
+        failures.append(f"served={summary['served']} of {summary['requests']} requests")
+    return failures
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Start a server on the stub library and wait until it accepts connections.
+def launch_server(args):
+    port = free_port()
+    model_path = os.path.join(BENCH_DIR, "build", "stub.rkllm")
+    open(model_path, "a").close()
+    env = dict(os.environ)
+    env["RKLLM_STUB_TOKENS"] = "1000000" # Generations end at max_tokens
+    env["RKLLM_STUB_TOKEN_US"] = str(args.token_us)
+    env["RKLLM_STUB_PREFILL_US"] = str(args.prefill_us)
+    command = [sys.executable, os.path.join(BENCH_DIR, "run_stub_server.py"), SERVERS[args.launch],
+               "--rkllm_model_path", model_path, "--target_platform", "rk3588", "--no_token_echo",
+               "--num_instances", str(args.instances), "--port", str(port)] + args.server_args
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL if not args.server_log else None,
+                               stderr=subprocess.DEVNULL if not args.server_log else None)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode}; run with --server_log to see why.")
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The server did not start listening within 60 seconds.")
+
+
+def main(args):
+    process = None
+    if args.launch:
+        process, url = launch_server(args)
+        pid = process.pid
+    else:
+        url, pid = args.url, args.pid
+    try:
+        parsed = urlparse(url)
+        host, port = parsed.hostname, parsed.port or 80
+        workload = make_workload(args)
+        sampler = ProcessSampler(pid) if pid else None
+        results, wall_seconds, cpu_seconds = asyncio.run(measure(args, host, port, workload, sampler))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    summary = summarize(results, wall_seconds, cpu_seconds, sampler.peak_rss_mb if sampler else None)
+    summary["config"] = {"server": args.launch or url, "concurrency": None if args.qps else args.concurrency, "qps": args.qps,
+                         "prompt_tokens": args.trace or args.prompt_tokens, "output_tokens": args.trace or args.output_tokens,
+                         "token_us": args.token_us if args.launch else None}
+    report(summary)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(summary, json_file, indent=2)
+
+    failures = check_limits(args, summary)
+    for failure in failures:
+        print("FAIL:", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--launch', type=str, choices=sorted(SERVERS), help='Start this server on the stub library for the run;')
+    parser.add_argument('--url', type=str, default="http://127.0.0.1:8080", help='Address of an already running server (without --launch);')
+    parser.add_argument('--pid', type=int, help='PID of the already running server, for its CPU time and RSS;')
+    parser.add_argument('--requests', type=int, default=200, help='Number of measured requests;')
+    parser.add_argument('--warmup', type=int, default=2, help='Requests sent before the measurement;')
+    parser.add_argument('--concurrency', type=int, default=4, help='Clients sending requests back to back (closed loop);')
+    parser.add_argument('--qps', type=float, help='Start requests at this fixed rate instead (open loop);')
+    parser.add_argument('--prompt_tokens', type=str, default="32:512", help='Prompt length in tokens, N or MIN:MAX;')
+    parser.add_argument('--output_tokens', type=str, default="16:128", help='Generated tokens per request (max_tokens), N or MIN:MAX;')
+    parser.add_argument('--trace', type=str, help='JSON lines file of {"prompt_tokens": N, "output_tokens": M} replayed instead of the ranges;')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated workload;')
+    parser.add_argument('--header', type=str, action='append', default=[], help='Extra request header, e.g. "X-Priority-Class: batch" (repeatable);')
+    parser.add_argument('--background_batch', type=int, default=0, help='Keep a /rkllm_batch of this many items running during the measurement (Flask server);')
+    parser.add_argument('--timeout', type=float, default=300.0, help='Seconds after which a request counts as timed out;')
+    parser.add_argument('--instances', type=int, default=1, help='--num_instances of the launched server;')
+    parser.add_argument('--token_us', type=int, default=5000, help='Stub delay per generated token in microseconds (with --launch);')
+    parser.add_argument('--prefill_us', type=int, default=50, help='Stub delay per prompt token in microseconds (with --launch);')
+    parser.add_argument('--server_log', action='store_true', help='Show the output of the launched server;')
+    parser.add_argument('--json', type=str, help='Write the summary to this file;')
+    parser.add_argument('--max_ttft_p99_ms', type=float, help='Fail if the p99 time to first token is higher;')
+    parser.add_argument('--max_itl_p99_ms', type=float, help='Fail if the p99 inter-token latency is higher;')
+    parser.add_argument('--max_cpu_us_per_token', type=float, help='Fail if the server CPU time per token is higher;')
+    parser.add_argument('--max_rss_mb', type=float, help='Fail if the peak server RSS is higher;')
+    parser.add_argument('--min_tokens_per_second', type=float, help='Fail if the throughput is lower;')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER, help='Extra arguments for the launched server, after --;')
+    args = parser.parse_args()
+    if args.server_args and args.server_args[0] == "--":
+        args.server_args = args.server_args[1:]
+    sys.exit(main(args))
@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import json
+import sys
+from urllib.parse import urlparse
+
+import bench_load
+
+# Server CPU time per generated token of streamed responses under each flush policy (--stream_flush_ms and
+# --stream_flush_tokens of the servers) at 1, 16 and 64 concurrent streams. Every level starts its own server on the
+# stub librkllmrt.so with one instance per stream, so all streams decode at the same time and the CPU time is what the
+# Python side spends per token on queuing, JSON encoding and socket writes.
+# A policy is MS:TOKENS; 0:1 sends one chunk per token (the former behaviour), 0:0 sends what has arrived whenever the
+# client is ready, 20:0 collects the tokens of up to 20 ms into one chunk.
+# Usage: python3 bench_stream_flush.py [--policies 0:1,0:0,20:0] [--concurrency 1,16,64] [--output_tokens 128] [--json result.json]
+
+
+def parse_policy(value):
+    interval_ms, _, max_tokens = value.partition(":")
+    return float(interval_ms), int(max_tokens or 0)
+
+
+def measure_level(args, policy, concurrency):
+    interval_ms, max_tokens = policy
+    load_args = argparse.Namespace(
+        launch="flask", token_us=args.token_us, prefill_us=args.prefill_us, instances=concurrency, server_log=args.server_log,
+        server_args=["--stream_flush_ms", str(interval_ms), "--stream_flush_tokens", str(max_tokens), "--queue_timeout", "600"],
+        warmup=min(concurrency, 4), background_batch=0, header=[], timeout=args.timeout, qps=None, concurrency=concurrency,
+        requests=concurrency * args.rounds, output_tokens=str(args.output_tokens))
+    workload = [(args.prompt_tokens, args.output_tokens)] * load_args.requests
+    process, url = bench_load.launch_server(load_args)
+    try:
+        parsed = urlparse(url)
+        sampler = bench_load.ProcessSampler(process.pid)
+        results, wall_seconds, cpu_seconds = asyncio.run(bench_load.measure(load_args, parsed.hostname, parsed.port, workload, sampler))
+    finally:
+        process.terminate()
+        process.wait()
+    summary = bench_load.summarize(results, wall_seconds, cpu_seconds, sampler.peak_rss_mb)
+    served = [result for result in results if result["status"] == 200 and result["arrivals"]]
+    summary["chunks_per_request"] = round(sum(len(result["arrivals"]) for result in served) / len(served), 1) if served else None
+    summary["config"] = {"stream_flush_ms": interval_ms, "stream_flush_tokens": max_tokens, "concurrency": concurrency}
+    return summary
+
+
+def main(args):
+    policies = [parse_policy(value) for value in args.policies.split(",")]
+    levels = [int(value) for value in args.concurrency.split(",")]
+    summaries = []
+    print(f"{'policy':>10} {'streams':>8} {'cpu us/token':>13} {'chunks/req':>11} {'tokens/s':>10} {'ttft p50 ms':>12} {'served':>8}")
+    sys.stdout.flush()
+    for concurrency in levels:
+        for policy in policies:
+            summary = measure_level(args, policy, concurrency)
+            summaries.append(summary)
+            print(f"{'{:g}:{}'.format(*policy):>10} {concurrency:>8} {summary['cpu_us_per_token']!s:>13} {summary['chunks_per_request']!s:>11} "
+                  f"{summary['tokens_per_second']!s:>10} {summary['ttft_p50_ms']!s:>12} {summary['served']:>4}/{summary['requests']:<3}")
+            sys.stdout.flush()
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(summaries, json_file, indent=2)
+    return 0 if all(summary["served"] == summary["requests"] for summary in summaries) else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--policies', type=str, default="0:1,0:0,20:0", help='Comma-separated flush policies, MS:TOKENS each;')
+    parser.add_argument('--concurrency', type=str, default="1,16,64", help='Comma-separated numbers of concurrent streams;')
+    parser.add_argument('--rounds', type=int, default=2, help='Requests per stream at each level;')
+    parser.add_argument('--prompt_tokens', type=int, default=16, help='Prompt length in tokens;')
+    parser.add_argument('--output_tokens', type=int, default=128, help='Generated tokens per request;')
+    parser.add_argument('--token_us', type=int, default=2000, help='Stub delay per generated token in microseconds;')
+    parser.add_argument('--prefill_us', type=int, default=50, help='Stub delay per prompt token in microseconds;')
+    parser.add_argument('--timeout', type=float, default=300.0, help='Seconds after which a request counts as timed out;')
+    parser.add_argument('--server_log', action='store_true', help='Show the output of the launched servers;')
+    parser.add_argument('--json', type=str, help='Write the summaries to this file;')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,104 @@
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+# Measure how quickly tokens emitted by librkllmrt reach the HTTP generator.
+# "polling" replays the former global_text list + sleep/join loop, "queue" uses the per-request token streams of flask_server.py.
+# Usage: python3 bench_token_stream.py [--lib ./build/librkllmrt.so] [--runs 5] [--tokens 64] [--token_us 20000]
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, "..", "rkllm_server")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run_polling(rkllm_runtime, prompt):
+    # Reproduces the consumer loop of receive_message before per-request token queues were introduced.
+    global_text = []
+    split_byte_data = [bytes(b"")]
+
+    def legacy_callback_impl(result, userdata, state):
+        if state == rkllm_runtime.LLMCallState.RKLLM_RUN_NORMAL:
+            try:
+                global_text.append((split_byte_data[0] + result.contents.text).decode('utf-8'))
+                split_byte_data[0] = bytes(b"")
+            except UnicodeDecodeError:
+                split_byte_data[0] += result.contents.text
+
+    legacy_callback = rkllm_runtime.callback_type(legacy_callback_impl)
+    handle = rkllm_runtime.RKLLMHandle(rkllm_runtime.default_param("stub", max_new_tokens=-1), legacy_callback)
+
+    arrivals = []
+    start = time.perf_counter()
+    model_thread = threading.Thread(target=handle.run, args=(prompt,))
+    model_thread.start()
+    model_thread_finished = False
+    while not model_thread_finished:
+        while len(global_text) > 0:
+            global_text.pop(0)
+            arrivals.append(time.perf_counter())
+            time.sleep(0.005)
+        model_thread.join(timeout=0.005)
+        model_thread_finished = not model_thread.is_alive()
+    handle.destroy()
+    return start, arrivals
+
+
+def run_queue(server, model, prompt):
+    arrivals = []
+    start = time.perf_counter()
+    for _ in server.ModelRun(model, prompt):
+        arrivals.append(time.perf_counter())
+    return start, arrivals
+
+
+def report(name, samples, cpu_seconds):
+    ttft = [(arrivals[0] - start) * 1000 for start, arrivals in samples if arrivals]
+    itl = [(b - a) * 1000 for _, arrivals in samples for a, b in zip(arrivals, arrivals[1:])]
+    tokens = sum(len(arrivals) for _, arrivals in samples)
+    print(f"[{name}] runs={len(samples)} tokens={tokens}")
+    print(f"  TTFT ms : mean={statistics.mean(ttft):.2f} p50={percentile(ttft, 50):.2f} p99={percentile(ttft, 99):.2f}")
+    print(f"  ITL  ms : mean={statistics.mean(itl):.2f} p50={percentile(itl, 50):.2f} p99={percentile(itl, 99):.2f}")
+    print(f"  CPU  us/token: {cpu_seconds / max(tokens, 1) * 1e6:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lib', type=str, default=os.path.join(BENCH_DIR, "build", "librkllmrt.so"), help='Path of the stub librkllmrt.so built by build_stub.sh;')
+    parser.add_argument('--runs', type=int, default=5, help='Number of generations per mode;')
+    parser.add_argument('--tokens', type=int, default=64, help='Tokens generated per run;')
+    parser.add_argument('--token_us', type=int, default=20000, help='Stub delay per generated token in microseconds;')
+    parser.add_argument('--mode', type=str, default="both", choices=["both", "polling", "queue"], help='Consumer implementation to measure;')
+    args = parser.parse_args()
+
+    os.environ["RKLLM_LIB_PATH"] = os.path.abspath(args.lib)
+    os.environ["RKLLM_STUB_TOKENS"] = str(args.tokens)
+    os.environ["RKLLM_STUB_TOKEN_US"] = str(args.token_us)
+    sys.path.insert(0, SERVER_DIR)
+    import flask_server as server
+    import rkllm_runtime
+
+    # Silence the per-token console echo of the server callback so that only the consumers are measured.
+    sys.stdout = open(os.devnull, "w")
+    results = {}
+    if args.mode in ("both", "polling"):
+        cpu_start = time.process_time()
+        samples = [run_polling(rkllm_runtime, "benchmark") for _ in range(args.runs)]
+        results["polling"] = (samples, time.process_time() - cpu_start)
+    if args.mode in ("both", "queue"):
+        model = server.RKLLM("stub")
+        cpu_start = time.process_time()
+        samples = [run_queue(server, model, "benchmark") for _ in range(args.runs)]
+        results["queue"] = (samples, time.process_time() - cpu_start)
+        model.release()
+    sys.stdout = sys.__stdout__
+
+    for name, (samples, cpu_seconds) in results.items():
+        report(name, samples, cpu_seconds)
@@ -0,0 +1,25 @@
+#!/bin/bash
+
+#*****************************************************************************************#
+# Build the stub librkllmrt.so used by the RKLLM-Server benchmarks.
+# The stub implements the rkllm.h API on the host CPU, so no board or NPU is needed.
+# Usage: ./build_stub.sh [Output Directory]
+# example: ./build_stub.sh ./build
+#*****************************************************************************************#
+
+ROOT_PWD=$( cd "$( dirname $0 )" && pwd )
+OUTPUT_DIR=${1:-${ROOT_PWD}/build}
+RKLLM_API_PATH=${ROOT_PWD}/../../../runtime/Linux/librkllm_api
+
+if [[ -z ${CC} ]];then
+    CC=gcc
+fi
+
+mkdir -p ${OUTPUT_DIR}
+${CC} -O2 -shared -fPIC -Wall \
+    -I${RKLLM_API_PATH}/include \
+    -o ${OUTPUT_DIR}/librkllmrt.so \
+    ${ROOT_PWD}/stub/rkllm_stub.c \
+    -lpthread
+
+echo "Stub library: ${OUTPUT_DIR}/librkllmrt.so"
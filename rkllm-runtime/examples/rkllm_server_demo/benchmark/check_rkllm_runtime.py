@@ -0,0 +1,122 @@
+import argparse
+import ctypes
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# Exercise the rkllm_runtime binding package against the stub librkllmrt.so: every rkllm.h function is called once
+# through the cached prototypes and the results seen by the callback are checked.
+# Usage: python3 check_rkllm_runtime.py [--lib ./build/librkllmrt.so]
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, "..", "rkllm_server")
+
+
+# Collects what the runtime reports for one run.
+class Recorder(object):
+    def __init__(self, rkllm_runtime):
+        self.states = rkllm_runtime.LLMCallState
+        self.pieces = []
+        self.userdata = []
+        self.hidden = None
+        self.finished = threading.Event()
+        self.error = False
+        self.callback = rkllm_runtime.callback_type(self.callback_impl)
+
+    def reset(self):
+        self.pieces = []
+        self.userdata = []
+        self.hidden = None
+        self.error = False
+        self.finished.clear()
+
+    def callback_impl(self, result, userdata, state):
+        self.userdata.append(userdata)
+        if state == self.states.RKLLM_RUN_NORMAL:
+            self.pieces.append(result.contents.text)
+        elif state == self.states.RKLLM_RUN_GET_LAST_HIDDEN_LAYER:
+            layer = result.contents.last_hidden_layer
+            self.hidden = (layer.num_tokens, layer.embd_size)
+        elif state == self.states.RKLLM_RUN_ERROR:
+            self.error = True
+            self.finished.set()
+        elif state == self.states.RKLLM_RUN_FINISH:
+            self.finished.set()
+
+
+def check(name, condition):
+    print(f"[{'PASS' if condition else 'FAIL'}] {name}")
+    sys.stdout.flush()
+    return condition
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lib', type=str, default=os.path.join(BENCH_DIR, "build", "librkllmrt.so"), help='Path of the stub librkllmrt.so built by build_stub.sh;')
+    args = parser.parse_args()
+
+    os.environ["RKLLM_STUB_TOKENS"] = "8"
+    os.environ["RKLLM_STUB_TOKEN_US"] = "2000"
+    os.environ["RKLLM_STUB_EMBD_SIZE"] = "16"
+    sys.path.insert(0, SERVER_DIR)
+    import rkllm_runtime
+    rkllm_runtime.configure(os.path.abspath(args.lib))
+
+    results = []
+    library = rkllm_runtime.load_library()
+    results.append(check("library is loaded once per path", library is rkllm_runtime.load_library(args.lib)))
+
+    param = rkllm_runtime.default_param("stub", max_context_len=256, top_k=1)
+    results.append(check("default_param keeps the given fields", param.max_context_len == 256 and param.model_path == b"stub"))
+
+    recorder = Recorder(rkllm_runtime)
+    handle = rkllm_runtime.RKLLMHandle(param, recorder.callback)
+
+    ret = handle.run("hello", 7)
+    results.append(check("run prompt", ret == 0 and len(recorder.pieces) == 8 and recorder.finished.is_set()))
+    results.append(check("userdata reaches the callback", set(recorder.userdata) == {7}))
+
+    recorder.reset()
+    handle.run(input_ids=[1, 2, 3, 4])
+    results.append(check("run token ids", len(recorder.pieces) == 8))
+
+    recorder.reset()
+    handle.run(input_ids=[1, 2, 3], infer_mode=rkllm_runtime.RKLLMInferMode.RKLLM_INFER_GET_LAST_HIDDEN_LAYER)
+    results.append(check("last hidden layer", recorder.hidden == (3, 16) and not recorder.pieces))
+
+    # The stub counts the image tokens of a multimodal input as prompt tokens ("x" is one more).
+    recorder.reset()
+    image_embed = (ctypes.c_float * (4 * 16))()
+    handle.run("x", image_embed=image_embed, n_image_tokens=4,
+               infer_mode=rkllm_runtime.RKLLMInferMode.RKLLM_INFER_GET_LAST_HIDDEN_LAYER)
+    results.append(check("run multimodal input", recorder.hidden == (5, 16)))
+
+    recorder.reset()
+    handle.run("unknown adapter", lora_adapter_name="missing")
+    results.append(check("unknown LoRA adapter reports an error", recorder.error))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_path = os.path.join(cache_dir, "prompt.bin")
+        recorder.reset()
+        handle.run("cached", save_prompt_cache_path=cache_path)
+        results.append(check("prompt cache saved", os.path.exists(cache_path)))
+        results.append(check("prompt cache loaded", handle.load_prompt_cache(cache_path) == 0))
+        results.append(check("prompt cache released", handle.release_prompt_cache() == 0))
+
+    recorder.reset()
+    ret = handle.run_async("async", 9)
+    time.sleep(0.005)
+    results.append(check("run_async returns while running", ret == 0 and handle.is_running()))
+    handle.abort()
+    recorder.finished.wait(5)
+    time.sleep(0.01)
+    results.append(check("abort stops the run", len(recorder.pieces) < 8 and not handle.is_running()))
+
+    handle.destroy()
+    handle.destroy()
+    results.append(check("destroy is idempotent", not handle.handle))
+
+    print(f"{sum(results)}/{len(results)} checks passed")
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,92 @@
+import atexit
+import os
+import resource
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# Start one of the servers on a machine without a board: the runtime is the stub librkllmrt.so built by build_stub.sh,
+# the frequency governor runs against a fake sysfs tree in a temporary directory that is deleted at exit (the board
+# frequency script of --freq_mode fixed is skipped) and the open-file limit is only raised as far as the hard limit
+# allows.
+# Usage: python3 run_stub_server.py [flask_server.py|asgi_server.py] [server arguments...]
+# The model path only has to exist; the RKLLM_STUB_* environment variables configure the generated tokens.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, "..", "rkllm_server")
+STUB_LIB_PATH = os.path.join(BENCH_DIR, "build", "librkllmrt.so")
+
+# Frequencies listed by the fake domains: cpufreq in kHz, devfreq in Hz.
+FAKE_FREQUENCIES = {"cpufreq": [408000, 1200000, 1800000], "devfreq": [300000000, 600000000, 1000000000]}
+FAKE_GOVERNORS = {"cpufreq": "schedutil", "devfreq": "simple_ondemand"}
+
+
+def clamped_setrlimit(limit, limits, setrlimit=resource.setrlimit):
+    _, hard = resource.getrlimit(limit)
+    if hard != resource.RLIM_INFINITY:
+        limits = tuple(min(value, hard) for value in limits)
+    setrlimit(limit, limits)
+
+
+def skip_fix_freq(command, *args, run=subprocess.run, **kwargs):
+    if isinstance(command, str) and "fix_freq_" in command:
+        return subprocess.CompletedProcess(command, 0)
+    return run(command, *args, **kwargs)
+
+
+def write_file(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fake_file:
+        fake_file.write(value + "\n")
+
+
+# A sysfs tree with the frequency domains of platform at their lowest frequency, the idle states of 8 CPUs and two
+# thermal zones. The kernel would apply a written frequency; here the governor's writes only replace the file contents.
+def make_fake_sysfs(root, platform):
+    from freq_governor import PLATFORM_DOMAINS, DOMAIN_FILES, AVAILABLE_GOVERNORS_FILES, USERSPACE_GOVERNOR
+    for _, kind, path in PLATFORM_DOMAINS[platform]:
+        governor_file, set_file, cur_file, available_file = DOMAIN_FILES[kind]
+        frequencies = FAKE_FREQUENCIES[kind]
+        write_file(os.path.join(root, path, governor_file), FAKE_GOVERNORS[kind])
+        write_file(os.path.join(root, path, AVAILABLE_GOVERNORS_FILES[kind]), " ".join([FAKE_GOVERNORS[kind], USERSPACE_GOVERNOR]))
+        write_file(os.path.join(root, path, set_file), "<unsupported>")
+        write_file(os.path.join(root, path, cur_file), str(frequencies[0]))
+        write_file(os.path.join(root, path, available_file), " ".join(str(freq) for freq in frequencies))
+    for cpu in range(8):
+        write_file(os.path.join(root, f"sys/devices/system/cpu/cpu{cpu}/cpuidle/state1/disable"), "0")
+    for zone, zone_type in enumerate(("soc-thermal", "npu-thermal")):
+        write_file(os.path.join(root, f"sys/class/thermal/thermal_zone{zone}/type"), zone_type)
+        write_file(os.path.join(root, f"sys/class/thermal/thermal_zone{zone}/temp"), str(40000 + zone * 2500))
+
+
+def option(argv, name, default=None):
+    for index, arg in enumerate(argv):
+        if arg == name and index + 1 < len(argv):
+            return argv[index + 1]
+        if arg.startswith(name + "="):
+            return arg.partition("=")[2]
+    return default
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 run_stub_server.py [flask_server.py|asgi_server.py] [server arguments...]")
+        sys.exit(1)
+    os.environ.setdefault("RKLLM_LIB_PATH", STUB_LIB_PATH)
+    resource.setrlimit = clamped_setrlimit
+    subprocess.run = skip_fix_freq
+
+    script = os.path.join(SERVER_DIR, sys.argv[1])
+    sys.path.insert(0, SERVER_DIR)
+    sys.argv = sys.argv[1:]
+    if option(sys.argv, "--freq_mode", "governor") == "governor" and option(sys.argv, "--sysfs_root") is None:
+        platform = option(sys.argv, "--target_platform")
+        if platform in ("rk3588", "rk3576"):
+            sysfs_root = tempfile.mkdtemp(prefix="rkllm_sysfs_")
+            # Registered before the governor's own exit handler, so it runs after the clocks were relaxed.
+            atexit.register(shutil.rmtree, sysfs_root, True)
+            make_fake_sysfs(sysfs_root, platform)
+            sys.argv += ["--sysfs_root", sysfs_root]
+    runpy.run_path(script, run_name="__main__")
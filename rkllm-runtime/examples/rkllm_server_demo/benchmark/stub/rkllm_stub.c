@@ -0,0 +1,323 @@
+// Deterministic stand-in for librkllmrt.so.
+//
+// Implements the symbols declared in rkllm.h without touching the NPU so that
+// the Python servers can be exercised and benchmarked on any Linux machine.
+// Every generated token is delivered through the registered callback after a
+// fixed delay. The behaviour is controlled through environment variables:
+//
+//   RKLLM_STUB_TOKENS          number of tokens generated per run (default 32)
+//   RKLLM_STUB_TOKEN_US        delay before each generated token, in us (default 20000)
+//   RKLLM_STUB_PREFILL_US      delay per prompt token before the first token, in us (default 0)
+//   RKLLM_STUB_TEXT            text emitted for every token (default "tok ")
+//   RKLLM_STUB_EMBD_SIZE       hidden size reported in GET_LAST_HIDDEN_LAYER mode (default 16)
+
+#include <pthread.h>
+#include <stdint.h>
+#include <stdbool.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include "rkllm.h"
+
+#define STUB_MAX_LORA 16
+
+typedef struct {
+    RKLLMParam param;
+    LLMResultCallback callback;
+    char lora_names[STUB_MAX_LORA][64];
+    int n_lora;
+    volatile int abort_flag;
+    volatile int running;
+    pthread_t worker;
+    int worker_valid;
+} StubHandle;
+
+typedef struct {
+    StubHandle* handle;
+    RKLLMInput input;
+    RKLLMInferParam infer_params;
+    RKLLMLoraParam lora_params;
+    RKLLMPromptCacheParam prompt_cache_params;
+    char* prompt;
+    void* userdata;
+} StubTask;
+
+static long env_long(const char* name, long fallback)
+{
+    const char* value = getenv(name);
+    if (value == NULL || *value == '\0') {
+        return fallback;
+    }
+    return strtol(value, NULL, 10);
+}
+
+static const char* env_str(const char* name, const char* fallback)
+{
+    const char* value = getenv(name);
+    return (value == NULL || *value == '\0') ? fallback : value;
+}
+
+static void sleep_us(long us)
+{
+    if (us <= 0) {
+        return;
+    }
+    struct timespec ts;
+    ts.tv_sec = us / 1000000;
+    ts.tv_nsec = (us % 1000000) * 1000;
+    nanosleep(&ts, NULL);
+}
+
+static size_t count_prompt_tokens(const RKLLMInput* input)
+{
+    switch (input->input_type) {
+    case RKLLM_INPUT_PROMPT:
+        return input->prompt_input ? strlen(input->prompt_input) / 4 + 1 : 0;
+    case RKLLM_INPUT_TOKEN:
+        return input->token_input.n_tokens;
+    case RKLLM_INPUT_EMBED:
+        return input->embed_input.n_tokens;
+    case RKLLM_INPUT_MULTIMODAL:
+        return (input->multimodal_input.prompt ? strlen(input->multimodal_input.prompt) / 4 + 1 : 0)
+               + input->multimodal_input.n_image_tokens;
+    }
+    return 0;
+}
+
+static int has_lora(StubHandle* h, const char* name)
+{
+    for (int i = 0; i < h->n_lora; i++) {
+        if (strcmp(h->lora_names[i], name) == 0) {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+static void join_worker(StubHandle* h)
+{
+    if (h->worker_valid) {
+        pthread_join(h->worker, NULL);
+        h->worker_valid = 0;
+    }
+}
+
+static int run_task(StubHandle* h, RKLLMInput* input, RKLLMInferParam* infer_params, void* userdata)
+{
+    RKLLMResult result;
+    memset(&result, 0, sizeof(result));
+
+    if (infer_params && infer_params->lora_params && infer_params->lora_params->lora_adapter_name
+        && !has_lora(h, infer_params->lora_params->lora_adapter_name)) {
+        h->callback(&result, userdata, RKLLM_RUN_ERROR);
+        return -1;
+    }
+
+    size_t n_prompt = count_prompt_tokens(input);
+    sleep_us(env_long("RKLLM_STUB_PREFILL_US", 0) * (long)n_prompt);
+
+    if (infer_params && infer_params->prompt_cache_params
+        && infer_params->prompt_cache_params->save_prompt_cache
+        && infer_params->prompt_cache_params->prompt_cache_path) {
+        FILE* fp = fopen(infer_params->prompt_cache_params->prompt_cache_path, "wb");
+        if (fp != NULL) {
+            fprintf(fp, "rkllm-stub-prompt-cache %zu\n", n_prompt);
+            fclose(fp);
+        }
+    }
+
+    if (infer_params && infer_params->mode == RKLLM_INFER_GET_LAST_HIDDEN_LAYER) {
+        int embd_size = (int)env_long("RKLLM_STUB_EMBD_SIZE", 16);
+        int num_tokens = n_prompt > 0 ? (int)n_prompt : 1;
+        float* hidden = (float*)malloc(sizeof(float) * embd_size * num_tokens);
+        for (int t = 0; t < num_tokens; t++) {
+            for (int e = 0; e < embd_size; e++) {
+                hidden[t * embd_size + e] = (float)t + (float)e / (float)embd_size;
+            }
+        }
+        result.last_hidden_layer.hidden_states = hidden;
+        result.last_hidden_layer.embd_size = embd_size;
+        result.last_hidden_layer.num_tokens = num_tokens;
+        h->callback(&result, userdata, RKLLM_RUN_GET_LAST_HIDDEN_LAYER);
+        free(hidden);
+        memset(&result, 0, sizeof(result));
+        h->callback(&result, userdata, RKLLM_RUN_FINISH);
+        return 0;
+    }
+
+    long n_tokens = env_long("RKLLM_STUB_TOKENS", 32);
+    if (h->param.max_new_tokens > 0 && n_tokens > h->param.max_new_tokens) {
+        n_tokens = h->param.max_new_tokens;
+    }
+    long token_us = env_long("RKLLM_STUB_TOKEN_US", 20000);
+    const char* text = env_str("RKLLM_STUB_TEXT", "tok ");
+
+    for (long i = 0; i < n_tokens; i++) {
+        if (h->abort_flag) {
+            break;
+        }
+        sleep_us(token_us);
+        result.text = text;
+        result.token_id = (int32_t)i;
+        h->callback(&result, userdata, RKLLM_RUN_NORMAL);
+    }
+    memset(&result, 0, sizeof(result));
+    h->callback(&result, userdata, RKLLM_RUN_FINISH);
+    return 0;
+}
+
+RKLLMParam rkllm_createDefaultParam()
+{
+    RKLLMParam param;
+    memset(&param, 0, sizeof(param));
+    param.max_context_len = 512;
+    param.max_new_tokens = -1;
+    param.top_k = 1;
+    param.top_p = 0.9f;
+    param.temperature = 0.8f;
+    param.repeat_penalty = 1.1f;
+    param.mirostat_tau = 5.0f;
+    param.mirostat_eta = 0.1f;
+    param.skip_special_token = true;
+    return param;
+}
+
+int rkllm_init(LLMHandle* handle, RKLLMParam* param, LLMResultCallback callback)
+{
+    if (handle == NULL || param == NULL) {
+        return -1;
+    }
+    StubHandle* h = (StubHandle*)calloc(1, sizeof(StubHandle));
+    h->param = *param;
+    h->callback = callback;
+    *handle = h;
+    return 0;
+}
+
+int rkllm_load_lora(LLMHandle handle, RKLLMLoraAdapter* lora_adapter)
+{
+    StubHandle* h = (StubHandle*)handle;
+    if (h == NULL || lora_adapter == NULL || lora_adapter->lora_adapter_name == NULL) {
+        return -1;
+    }
+    if (has_lora(h, lora_adapter->lora_adapter_name)) {
+        return 0;
+    }
+    if (h->n_lora >= STUB_MAX_LORA) {
+        return -1;
+    }
+    snprintf(h->lora_names[h->n_lora++], 64, "%s", lora_adapter->lora_adapter_name);
+    return 0;
+}
+
+int rkllm_load_prompt_cache(LLMHandle handle, const char* prompt_cache_path)
+{
+    if (handle == NULL || prompt_cache_path == NULL) {
+        return -1;
+    }
+    return access(prompt_cache_path, R_OK) == 0 ? 0 : -1;
+}
+
+int rkllm_release_prompt_cache(LLMHandle handle)
+{
+    return handle == NULL ? -1 : 0;
+}
+
+int rkllm_run(LLMHandle handle, RKLLMInput* rkllm_input, RKLLMInferParam* rkllm_infer_params, void* userdata)
+{
+    StubHandle* h = (StubHandle*)handle;
+    if (h == NULL || rkllm_input == NULL) {
+        return -1;
+    }
+    join_worker(h);
+    h->abort_flag = 0;
+    h->running = 1;
+    int ret = run_task(h, rkllm_input, rkllm_infer_params, userdata);
+    h->running = 0;
+    return ret;
+}
+
+static void* async_worker(void* arg)
+{
+    StubTask* task = (StubTask*)arg;
+    StubHandle* h = task->handle;
+    run_task(h, &task->input, &task->infer_params, task->userdata);
+    h->running = 0;
+    free(task->prompt);
+    free(task);
+    return NULL;
+}
+
+int rkllm_run_async(LLMHandle handle, RKLLMInput* rkllm_input, RKLLMInferParam* rkllm_infer_params, void* userdata)
+{
+    StubHandle* h = (StubHandle*)handle;
+    if (h == NULL || rkllm_input == NULL) {
+        return -1;
+    }
+    join_worker(h);
+
+    // The caller's buffers may be gone once this call returns, so copy them.
+    StubTask* task = (StubTask*)calloc(1, sizeof(StubTask));
+    task->handle = h;
+    task->userdata = userdata;
+    task->input = *rkllm_input;
+    if (rkllm_input->input_type == RKLLM_INPUT_PROMPT && rkllm_input->prompt_input) {
+        task->prompt = strdup(rkllm_input->prompt_input);
+        task->input.prompt_input = task->prompt;
+    }
+    if (rkllm_infer_params) {
+        task->infer_params = *rkllm_infer_params;
+        if (rkllm_infer_params->lora_params) {
+            task->lora_params = *rkllm_infer_params->lora_params;
+            task->infer_params.lora_params = &task->lora_params;
+        }
+        if (rkllm_infer_params->prompt_cache_params) {
+            task->prompt_cache_params = *rkllm_infer_params->prompt_cache_params;
+            task->infer_params.prompt_cache_params = &task->prompt_cache_params;
+        }
+    }
+
+    h->abort_flag = 0;
+    h->running = 1;
+    if (pthread_create(&h->worker, NULL, async_worker, task) != 0) {
+        h->running = 0;
+        free(task->prompt);
+        free(task);
+        return -1;
+    }
+    h->worker_valid = 1;
+    return 0;
+}
+
+int rkllm_abort(LLMHandle handle)
+{
+    StubHandle* h = (StubHandle*)handle;
+    if (h == NULL) {
+        return -1;
+    }
+    h->abort_flag = 1;
+    return 0;
+}
+
+int rkllm_is_running(LLMHandle handle)
+{
+    StubHandle* h = (StubHandle*)handle;
+    if (h == NULL) {
+        return -1;
+    }
+    return h->running ? 0 : 1;
+}
+
+int rkllm_destroy(LLMHandle handle)
+{
+    StubHandle* h = (StubHandle*)handle;
+    if (h == NULL) {
+        return -1;
+    }
+    h->abort_flag = 1;
+    join_worker(h);
+    free(h);
+    return 0;
+}
@@ -1,18 +1,15 @@
+import os
 import sys
-import requests
-import json
-  
-# Set the address of the Server.
-server_url = 'http://172.16.10.79:8080/rkllm_chat'
+from rkllm_client import RKLLMClient, RKLLMServerError, API_RKLLM
+
+# Set the address of the Server (or pass it in RKLLM_SERVER_URL).
+server_url = os.environ.get('RKLLM_SERVER_URL', 'http://172.16.10.79:8080')
 # Set whether to enable streaming mode.
 is_streaming = True
 
-# Create a session object.
-session = requests.Session()
-session.keep_alive = False  # Close the connection pool to maintain a long connection.
-adapter = requests.adapters.HTTPAdapter(max_retries=5)
-session.mount('https://', adapter)
-session.mount('http://', adapter)
+# Create a client object. It keeps its connections to the server open between questions, and retries a question
+# while the server is busy.
+client = RKLLMClient(server_url.rsplit('/rkllm_chat', 1)[0], api=API_RKLLM)
 
 if __name__ == '__main__':
     print("============================")
@@ -28,48 +25,27 @@ if __name__ == '__main__':
                 print("============================")
                 break
             else:
-                # Set the request headers; in this case, the headers have no actual effect and are only used to simulate the OpenAI interface design.
-                headers = {
-                    'Content-Type': 'application/json',
-                    'Authorization': 'not_required'
-                }
-
                 # Prepare the data to be sent
-                # model: The model defined by the user when setting up RKLLM-Server; this has no effect here
                 # messages: The user's input question, which RKLLM-Server will use as input and return the model's reply; multiple questions can be added to messages
                 # stream: Whether to enable streaming conversation, similar to the OpenAI interface
-                data = {
-                    "model": 'your_model_deploy_with_RKLLM_Server',
-                    "messages": [{"role": "user", "content": user_message}],
-                    "stream": is_streaming
-                }
-
-                # Send a POST request
-                responses = session.post(server_url, json=data, headers=headers, stream=is_streaming, verify=False)
+                messages = [{"role": "user", "content": user_message}]
 
-                if not is_streaming:
-                    # Parse the response
-                    if responses.status_code == 200:
-                        print("Q:", data["messages"][-1]["content"])
-                        print("A:", json.loads(responses.text)["choices"][-1]["message"]["content"])
+                try:
+                    print("Q:", messages[-1]["content"])
+                    if not is_streaming:
+                        print("A:", client.chat(messages).content)
                     else:
-                        print("Error:", responses.text)
-                else:
-                    if responses.status_code == 200:
-                        print("Q:", data["messages"][-1]["content"])
                         print("A:", end="")
-                        for line in responses.iter_lines():
-                            if line:
-                                line = json.loads(line.decode('utf-8'))
-                                if line["choices"][-1]["finish_reason"] != "stop":
-                                    print(line["choices"][-1]["delta"]["content"], end="")
-                                    sys.stdout.flush()
-                    else:
-                        print('Error:', responses.text)
-                        
+                        for delta in client.stream_chat(messages):
+                            print(delta, end="")
+                            sys.stdout.flush()
+                        print()
+                except (RKLLMServerError, OSError) as e:
+                    print("Error:", e)
+
         except KeyboardInterrupt:
-            # Capture Ctrl-C signal to close the session
-            session.close()
+            # Capture Ctrl-C signal to close the connections
+            client.close()
 
             print("\n")
             print("============================")
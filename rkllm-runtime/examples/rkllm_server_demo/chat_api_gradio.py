@@ -1,9 +1,18 @@
 from gradio_client import Client
 
+# Instantiate the Gradio Client once: it fetches the API description of the server when it is created, and is reused
+# for every message. Users need to modify according to their specific deployment URL.
+client = None
+
+def get_client():
+    global client
+    if client is None:
+        client = Client("http://0.0.0.0:8080")
+    return client
+
 # This function interacts with the RKLLM model by calling the Gradio Client API.
 def chat_with_rkllm(user_message, history=[]):
-    # Instantiate the Gradio Client. Users need to modify according to their specific deployment URL.
-    client = Client("http://0.0.0.0:8080")
+    client = get_client()
 
     # Call the Gradio Client API for interaction. The internal APIs mainly include:
     # get_user_input: The model retrieves user input and adds it to the history record 'history'.
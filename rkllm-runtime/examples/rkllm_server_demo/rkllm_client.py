@@ -0,0 +1,541 @@
+# Python client of the RKLLM servers, with a blocking (RKLLMClient) and an asyncio (AsyncRKLLMClient) API.
+# Both keep their HTTP/1.1 connections open between requests, stream the reply as it is generated, retry a request
+# the server rejected with 503 after a backoff, and answer many prompts concurrently with map_chat.
+# Only the standard library is used.
+
+import asyncio
+import http.client
+import json
+import random
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+# /v1/chat/completions of the Flask server: every streamed chunk carries only its new text.
+API_OPENAI = "openai"
+# /rkllm_chat of the Flask and ASGI servers.
+API_RKLLM = "rkllm"
+API_PATHS = {API_OPENAI: "/v1/chat/completions", API_RKLLM: "/rkllm_chat"}
+
+DEFAULT_BASE_URL = "http://127.0.0.1:8080"
+
+# The status of a request rejected by a busy server, which is retried.
+RETRY_STATUS = 503
+
+
+class RKLLMServerError(Exception):
+    def __init__(self, status, message, retry_after=None):
+        Exception.__init__(self, "{} {}".format(status, message))
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after # Seconds, from the Retry-After header of a rejected request
+
+
+# The reply to one chat request. content and finish_reason are those of the first choice; /rkllm_chat answers every
+# user message of a request in a choice of its own.
+class ChatResult(object):
+    def __init__(self, content, finish_reason=None, usage=None, choices=None):
+        self.content = content
+        self.finish_reason = finish_reason
+        self.usage = usage
+        self.choices = choices or []
+
+    def __repr__(self):
+        return "ChatResult({!r}, finish_reason={!r})".format(self.content, self.finish_reason)
+
+
+# The JSON body of a chat request. messages is a list of chat messages or a single user message; options are further
+# request fields (max_tokens, temperature, lora_adapter, ...).
+def chat_body(api, messages, stream, options):
+    if isinstance(messages, str):
+        messages = [{"role": "user", "content": messages}]
+    body = dict(options, messages=messages, stream=stream)
+    if stream and api == API_OPENAI:
+        body.setdefault("stream_options", {"include_usage": True})
+    return json.dumps(body).encode("utf-8")
+
+
+def parse_result(data):
+    choices = data.get("choices") or []
+    first = choices[0] if choices else {}
+    return ChatResult((first.get("message") or {}).get("content") or "", first.get("finish_reason"), data.get("usage"), choices)
+
+
+def server_error(status, body, retry_after=None):
+    try:
+        data = json.loads(body)
+        message = (data.get("error") or {}).get("message") or data.get("message") or body.decode("utf-8", "replace")
+    except (ValueError, AttributeError):
+        message = body.decode("utf-8", "replace")
+    return RKLLMServerError(status, message, retry_after)
+
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+# Seconds to wait before the next attempt: the server's Retry-After if it sent one, otherwise an exponential backoff
+# with jitter, so that clients rejected together do not come back together.
+def retry_delay(attempt, retry_after, backoff, max_backoff):
+    if retry_after is not None:
+        return min(retry_after, max_backoff)
+    return min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+# Turns the lines of a streamed reply into text deltas. Also keeps the finish_reason and usage, where the server sends them.
+class StreamParser(object):
+    def __init__(self, api):
+        self.api = api
+        self.seen = 0
+        self.finish_reason = None
+        self.usage = None
+
+    def feed(self, line):
+        line = line.strip()
+        if not line:
+            return []
+        if self.api == API_OPENAI:
+            if not line.startswith(b"data: ") or line == b"data: [DONE]":
+                return []
+            chunk = json.loads(line[len(b"data: "):])
+            if chunk.get("error"):
+                raise RKLLMServerError(200, chunk["error"].get("message"))
+            if chunk.get("usage"):
+                self.usage = chunk["usage"]
+            choices = chunk.get("choices") or []
+        else:
+            choices = json.loads(line).get("choices") or []
+            # The Flask server repeats every earlier delta in each chunk, the ASGI server sends the new one only.
+            if len(choices) > self.seen:
+                choices, self.seen = choices[self.seen:], len(choices)
+        deltas = []
+        for choice in choices:
+            if choice.get("finish_reason"):
+                self.finish_reason = choice["finish_reason"]
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                deltas.append(content)
+        return deltas
+
+
+# Settings shared by both clients.
+class ClientConfig(object):
+    def __init__(self, base_url, api, api_key, headers, timeout, max_retries, backoff, max_backoff, pool_size):
+        if api not in API_PATHS:
+            raise ValueError("api must be one of {}".format("/".join(API_PATHS)))
+        parts = urlsplit(base_url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError("base_url must be an http:// or https:// URL")
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.prefix = parts.path.rstrip("/")
+        self.api = api
+        self.headers = {"Host": parts.netloc, "Content-Type": "application/json", "Connection": "keep-alive"}
+        if api_key:
+            self.headers["Authorization"] = "Bearer " + api_key
+        self.headers.update(headers or {})
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+
+    def chat_path(self):
+        return self.prefix + API_PATHS[self.api]
+
+
+# Idle HTTP connections to the server, most recently used first. A connection goes back to the pool only once its
+# response has been read to the end and the server keeps it open.
+class ConnectionPool(object):
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.idle = []
+        self.connects = 0
+
+    def _connect(self):
+        self.connects += 1
+        if self.config.https:
+            return http.client.HTTPSConnection(self.config.host, self.config.port, timeout=self.config.timeout)
+        return http.client.HTTPConnection(self.config.host, self.config.port, timeout=self.config.timeout)
+
+    # Send a request and return (connection, response) with the headers read. A pooled connection that the server
+    # has closed in the meantime is replaced by a new one.
+    def request(self, method, path, body):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is not None:
+            try:
+                conn.request(method, path, body, self.config.headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                conn.close()
+        conn = self._connect()
+        try:
+            conn.request(method, path, body, self.config.headers)
+            return conn, conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+
+    def release(self, conn, response):
+        if response.isclosed() and conn.sock is not None:
+            with self.lock:
+                if len(self.idle) < self.config.pool_size:
+                    self.idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+# A streamed reply of RKLLMClient. Iterating yields the text deltas as the server sends them; closing the stream early
+# closes its connection, which makes the server abort the generation.
+class ChatStream(object):
+    def __init__(self, pool, conn, response, parser):
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.parser = parser
+        self.parts = []
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            for line in self.response:
+                for delta in self.parser.feed(line):
+                    self.parts.append(delta)
+                    yield delta
+        finally:
+            self.close()
+
+    @property
+    def content(self):
+        return "".join(self.parts)
+
+    @property
+    def finish_reason(self):
+        return self.parser.finish_reason
+
+    @property
+    def usage(self):
+        return self.parser.usage
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pool.release(self.conn, self.response)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Blocking client; one instance can be shared by many threads.
+#   client = RKLLMClient("http://[board_ip]:8080")
+#   print(client.chat("What is RKLLM?").content)
+#   for delta in client.stream_chat("Write a haiku.", max_tokens=64): print(delta, end="")
+class RKLLMClient(object):
+    def __init__(self, base_url=DEFAULT_BASE_URL, api=API_OPENAI, api_key=None, headers=None, timeout=300.0, max_retries=5,
+                 backoff=0.5, max_backoff=30.0, pool_size=8):
+        self.config = ClientConfig(base_url, api, api_key, headers, timeout, max_retries, backoff, max_backoff, pool_size)
+        self.pool = ConnectionPool(self.config)
+
+    # Send a request, retrying while the server answers 503. Returns (connection, response) of a 200 response.
+    # Raises RKLLMServerError for any other status, or once the retries are used up.
+    def _request(self, method, path, body=None):
+        for attempt in range(self.config.max_retries + 1):
+            conn, response = self.pool.request(method, path, body)
+            if response.status == 200:
+                return conn, response
+            error = server_error(response.status, response.read(), parse_retry_after(response.getheader("Retry-After")))
+            self.pool.release(conn, response)
+            if response.status != RETRY_STATUS or attempt == self.config.max_retries:
+                raise error
+            time.sleep(retry_delay(attempt, error.retry_after, self.config.backoff, self.config.max_backoff))
+
+    def chat(self, messages, **options):
+        conn, response = self._request("POST", self.config.chat_path(), chat_body(self.config.api, messages, False, options))
+        try:
+            data = json.loads(response.read())
+        finally:
+            self.pool.release(conn, response)
+        return parse_result(data)
+
+    def stream_chat(self, messages, **options):
+        conn, response = self._request("POST", self.config.chat_path(), chat_body(self.config.api, messages, True, options))
+        return ChatStream(self.pool, conn, response, StreamParser(self.config.api))
+
+    # GET a JSON endpoint, e.g. get("/rkllm_status").
+    def get(self, path):
+        conn, response = self._request("GET", self.config.prefix + path)
+        try:
+            return json.loads(response.read())
+        finally:
+            self.pool.release(conn, response)
+
+    # Answer every prompt (a string or a list of messages) with up to concurrency requests in flight. Returns the
+    # ChatResults in the order of prompts; a request that failed has its exception in its place.
+    def map_chat(self, prompts, concurrency=4, **options):
+        def run(prompt):
+            try:
+                return self.chat(prompt, **options)
+            except (RKLLMServerError, OSError, http.client.HTTPException, ValueError) as e:
+                return e
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            return list(executor.map(run, prompts))
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# One HTTP/1.1 connection of AsyncRKLLMClient.
+class AsyncConnection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+
+# A response of AsyncRKLLMClient whose body is read on demand: sized, chunked, or up to the end of the connection.
+class AsyncResponse(object):
+    def __init__(self, pool, conn, status, headers):
+        self.pool = pool
+        self.conn = conn
+        self.status = status
+        self.headers = headers
+        self.chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        self.length = int(headers["content-length"]) if "content-length" in headers and not self.chunked else None
+        self.will_close = headers.get("connection", "").lower() == "close" or (self.length is None and not self.chunked)
+        self.done = False
+
+    # One read of the body, which raises asyncio.TimeoutError if the server sends nothing for timeout seconds.
+    async def _read(self, awaitable):
+        return await asyncio.wait_for(awaitable, self.pool.config.timeout)
+
+    async def _blocks(self):
+        reader = self.conn.reader
+        if self.chunked:
+            while True:
+                size = int((await self._read(reader.readline())).split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    while (await self._read(reader.readline())) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                yield await self._read(reader.readexactly(size))
+                await self._read(reader.readexactly(2))
+        elif self.length is not None:
+            if self.length:
+                yield await self._read(reader.readexactly(self.length))
+        else:
+            while True:
+                block = await self._read(reader.read(65536))
+                if not block:
+                    break
+                yield block
+        self.done = True
+
+    async def read(self):
+        try:
+            return b"".join([block async for block in self._blocks()])
+        finally:
+            self.release()
+
+    async def lines(self):
+        pending = b""
+        try:
+            async for block in self._blocks():
+                pending += block
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    yield line
+            if pending:
+                yield pending
+        finally:
+            self.release()
+
+    def release(self):
+        self.pool.release(self)
+
+
+# Idle connections of AsyncRKLLMClient, most recently used first.
+class AsyncConnectionPool(object):
+    def __init__(self, config):
+        self.config = config
+        self.idle = []
+        self.connects = 0
+
+    async def _connect(self):
+        self.connects += 1
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.config.host, self.config.port, ssl=ssl.create_default_context() if self.config.https else None),
+            self.config.timeout)
+        return AsyncConnection(reader, writer)
+
+    async def _send(self, conn, method, path, body):
+        headers = dict(self.config.headers, **{"Content-Length": str(len(body or b""))})
+        head = "".join("{}: {}\r\n".format(name, value) for name, value in headers.items())
+        conn.writer.write("{} {} HTTP/1.1\r\n{}\r\n".format(method, path, head).encode("latin-1") + (body or b""))
+        await conn.writer.drain()
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by the server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await conn.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return AsyncResponse(self, conn, status, headers)
+
+    # Send a request and return the response with the headers read. A pooled connection that the server has closed
+    # in the meantime is replaced by a new one.
+    async def request(self, method, path, body):
+        while self.idle:
+            conn = self.idle.pop()
+            if conn.reader.at_eof():
+                conn.close()
+                continue
+            try:
+                return await asyncio.wait_for(self._send(conn, method, path, body), self.config.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                conn.close()
+                break
+        conn = await self._connect()
+        try:
+            return await asyncio.wait_for(self._send(conn, method, path, body), self.config.timeout)
+        except BaseException:
+            conn.close()
+            raise
+
+    def release(self, response):
+        conn, response.conn = response.conn, None
+        if conn is None:
+            return
+        if response.done and not response.will_close and len(self.idle) < self.config.pool_size:
+            self.idle.append(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+# A streamed reply of AsyncRKLLMClient: async iteration yields the text deltas; aclose() ends the stream early.
+class AsyncChatStream(object):
+    def __init__(self, response, parser):
+        self.response = response
+        self.parser = parser
+        self.parts = []
+        self.line_iterator = response.lines()
+
+    def __aiter__(self):
+        return self._deltas()
+
+    async def _deltas(self):
+        try:
+            async for line in self.line_iterator:
+                for delta in self.parser.feed(line):
+                    self.parts.append(delta)
+                    yield delta
+        finally:
+            await self.aclose()
+
+    @property
+    def content(self):
+        return "".join(self.parts)
+
+    @property
+    def finish_reason(self):
+        return self.parser.finish_reason
+
+    @property
+    def usage(self):
+        return self.parser.usage
+
+    async def aclose(self):
+        await self.line_iterator.aclose()
+        self.response.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+# asyncio client with the API of RKLLMClient; for use from one event loop.
+#   async with AsyncRKLLMClient("http://[board_ip]:8080") as client:
+#       results = await client.map_chat(["first prompt", "second prompt"], concurrency=8)
+class AsyncRKLLMClient(object):
+    def __init__(self, base_url=DEFAULT_BASE_URL, api=API_OPENAI, api_key=None, headers=None, timeout=300.0, max_retries=5,
+                 backoff=0.5, max_backoff=30.0, pool_size=8):
+        self.config = ClientConfig(base_url, api, api_key, headers, timeout, max_retries, backoff, max_backoff, pool_size)
+        self.pool = AsyncConnectionPool(self.config)
+
+    async def _request(self, method, path, body=None):
+        for attempt in range(self.config.max_retries + 1):
+            response = await self.pool.request(method, path, body)
+            if response.status == 200:
+                return response
+            error = server_error(response.status, await response.read(), parse_retry_after(response.headers.get("retry-after")))
+            if response.status != RETRY_STATUS or attempt == self.config.max_retries:
+                raise error
+            await asyncio.sleep(retry_delay(attempt, error.retry_after, self.config.backoff, self.config.max_backoff))
+
+    async def chat(self, messages, **options):
+        response = await self._request("POST", self.config.chat_path(), chat_body(self.config.api, messages, False, options))
+        return parse_result(json.loads(await response.read()))
+
+    async def stream_chat(self, messages, **options):
+        response = await self._request("POST", self.config.chat_path(), chat_body(self.config.api, messages, True, options))
+        return AsyncChatStream(response, StreamParser(self.config.api))
+
+    async def get(self, path):
+        response = await self._request("GET", self.config.prefix + path)
+        return json.loads(await response.read())
+
+    async def map_chat(self, prompts, concurrency=4, **options):
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def run(prompt):
+            async with semaphore:
+                try:
+                    return await self.chat(prompt, **options)
+                except (RKLLMServerError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+                    return e
+        return await asyncio.gather(*[run(prompt) for prompt in prompts])
+
+    async def close(self):
+        self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,94 @@
+import json
+import math
+import threading
+
+# Rough prompt length in tokens when no tokenizer is at hand.
+CHARS_PER_TOKEN = 4
+
+# Tokens a request is assumed to generate when it sets no limit.
+DEFAULT_ESTIMATE_TOKENS = 256
+
+# A prompt token costs this fraction of a generated token: prefill processes the prompt in parallel.
+PREFILL_COST = 0.1
+
+LANE_INTERACTIVE = "interactive"
+LANE_BATCH = "batch"
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after # Whole seconds after which the request is likely to be admitted
+
+
+# A priority class of requests. Lanes with a lower rank get instances first. A lane keeps at most max_queue requests
+# waiting (0 = unlimited) and rejects a request whose predicted wait exceeds slo_seconds (0 = never). The generations
+# of a preemptible lane are aborted when a request of a lane with a lower rank cannot get an instance.
+class Lane(object):
+    def __init__(self, name, rank, max_queue=0, slo_seconds=0.0, preemptible=False):
+        self.name = name
+        self.rank = rank
+        self.max_queue = max_queue
+        self.slo_seconds = slo_seconds
+        self.preemptible = preemptible
+
+    def describe(self):
+        return {"name": self.name, "rank": self.rank, "max_queue": self.max_queue, "slo_seconds": self.slo_seconds,
+                "preemptible": self.preemptible}
+
+
+def default_lanes():
+    return [
+        Lane(LANE_INTERACTIVE, 0, max_queue=64, slo_seconds=30.0),
+        Lane(LANE_BATCH, 10, max_queue=1024, preemptible=True),
+    ]
+
+
+# Read a lane file: a JSON list of {"name", "rank", "max_queue", "slo_seconds", "preemptible"} objects.
+def read_lanes(path):
+    with open(path, "r") as lanes_file:
+        entries = json.load(lanes_file)
+    return [Lane(entry["name"], int(entry.get("rank", 0)), int(entry.get("max_queue", 0)), float(entry.get("slo_seconds", 0.0)),
+                 bool(entry.get("preemptible", False))) for entry in entries]
+
+
+# The work a request brings, in generated-token equivalents: the expected output plus the prompt at PREFILL_COST.
+def request_cost(prompt_chars=0, max_new_tokens=-1, prompt_tokens=None):
+    if prompt_tokens is None:
+        prompt_tokens = prompt_chars / CHARS_PER_TOKEN
+    if max_new_tokens is None or max_new_tokens <= 0:
+        max_new_tokens = DEFAULT_ESTIMATE_TOKENS
+    return prompt_tokens * PREFILL_COST + max_new_tokens
+
+
+# Seconds an instance needs per unit of request cost, learned from how long requests held their instance.
+# Requests that stop before their token limit take less than estimated, which the average reflects as well.
+class CostModel(object):
+    def __init__(self, seconds_per_unit=0.1, smoothing=0.1):
+        self.seconds_per_unit = seconds_per_unit
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.samples = 0
+
+    # Until a request has finished, seconds_per_unit is only a guess.
+    @property
+    def calibrated(self):
+        return self.samples > 0
+
+    def seconds(self, cost):
+        return cost * self.seconds_per_unit
+
+    def observe(self, cost, seconds):
+        if cost <= 0 or seconds <= 0:
+            return
+        with self.lock:
+            rate = seconds / cost
+            if self.samples == 0:
+                self.seconds_per_unit = rate
+            else:
+                self.seconds_per_unit += self.smoothing * (rate - self.seconds_per_unit)
+            self.samples += 1
+
+
+def retry_after(seconds):
+    return max(1, int(math.ceil(seconds)))
@@ -0,0 +1,542 @@
+import sys
+import os
+import subprocess
+import resource
+import signal
+import time
+import argparse
+import json
+import asyncio
+import heapq
+import itertools
+
+# The ctypes bindings, the RKLLM wrapper, the callback and the metrics are shared with the Flask server.
+import flask_server
+from run_context import RunContext, FINAL_STATES
+from flask_server import RKLLM, LLMCallState, ABORT_TIMEOUT, PROMPT_TEXT_PREFIX, PROMPT_TEXT_POSTFIX, PROMPT_TEXT_TURN_SEPARATOR, metrics_registry, run_metrics
+from prompt_template import PromptTemplate, TemplateStore
+from stream_writer import FlushPolicy, ChunkTemplate, CONTENT_MARKER, EVERY_TOKEN
+from freq_governor import FrequencyGovernor, FREQ_MODE_GOVERNOR, FREQ_MODE_FIXED, FREQ_MODES
+from worker_pool import PoolTimeout, SCHEDULE_FIFO, SCHEDULE_PRIORITY
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+
+# RunContext whose output is handed from the runtime callback thread to the event loop with call_soon_threadsafe.
+# It is registered in flask_server.run_contexts, so the shared callback delivers to it like to a TokenStream.
+class AsyncTokenStream(RunContext):
+    def __init__(self, loop):
+        RunContext.__init__(self)
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, state, text=None):
+        self.state = state
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (state, text, self.n_tokens))
+
+
+# One generation on an RKLLM instance, consumed from a coroutine. Same semantics as flask_server.ModelRun.
+class AsyncModelRun(object):
+    def __init__(self, rkllm_model, prompt, max_new_tokens=-1, timeout=None):
+        self.rkllm_model = rkllm_model
+        self.max_new_tokens = max_new_tokens
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.finish_reason = None
+        self.closed = False
+        self.n_tokens = 0 # Tokens whose output was taken from the stream
+        self.stream = AsyncTokenStream(asyncio.get_running_loop())
+        self.stream_id = flask_server.run_contexts.register(self.stream)
+        if rkllm_model.run(prompt, self.stream_id) != 0:
+            self.stream.put(LLMCallState.RKLLM_RUN_ERROR)
+
+    async def texts(self):
+        async for text in self.chunks(EVERY_TOKEN):
+            yield text
+
+    # The output in chunks collected by flush_policy, like flask_server.ModelRun.chunks.
+    async def chunks(self, flush_policy):
+        pieces = []
+        first_piece_time = None
+        first_piece_sent = False
+        try:
+            while True:
+                now = time.monotonic()
+                remaining = None if self.deadline is None else self.deadline - now
+                if remaining is not None and remaining <= 0:
+                    self.finish_reason = "timeout"
+                    break
+                wait = remaining
+                if pieces:
+                    wait = flush_policy.wait(now - first_piece_time)
+                    if remaining is not None:
+                        wait = min(wait, remaining)
+                try:
+                    state, text, self.n_tokens = await self.get(wait)
+                except asyncio.TimeoutError:
+                    if not pieces:
+                        self.finish_reason = "timeout"
+                        break
+                    yield "".join(pieces)
+                    pieces = []
+                    continue
+                if text:
+                    now = time.monotonic()
+                    if not first_piece_sent:
+                        first_piece_sent = True
+                        yield text
+                    else:
+                        if not pieces:
+                            first_piece_time = now
+                        pieces.append(text)
+                        if flush_policy.full(len(pieces), now - first_piece_time):
+                            yield "".join(pieces)
+                            pieces = []
+                if state == LLMCallState.RKLLM_RUN_FINISH:
+                    self.finish_reason = "stop"
+                    break
+                if state == LLMCallState.RKLLM_RUN_ERROR:
+                    self.finish_reason = "error"
+                    break
+                if self.max_new_tokens > 0 and self.n_tokens >= self.max_new_tokens:
+                    self.finish_reason = "length"
+                    break
+            if pieces:
+                yield "".join(pieces)
+        finally:
+            await self.close()
+
+    async def get(self, timeout=None):
+        # asyncio.wait_for with a timeout of 0 gives up before the queue is even looked at.
+        if timeout is not None and timeout <= 0:
+            try:
+                return self.stream.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                raise asyncio.TimeoutError()
+        return await asyncio.wait_for(self.stream.queue.get(), timeout)
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if not self.stream.finished():
+                # rkllm_abort may block until the runtime has stopped, so it runs off the event loop.
+                await asyncio.get_running_loop().run_in_executor(None, self.rkllm_model.abort)
+                try:
+                    await asyncio.wait_for(self.wait_finished(), ABORT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    print("Warning: RKLLM run did not stop within {}s after abort.".format(ABORT_TIMEOUT))
+                    sys.stdout.flush()
+        finally:
+            flask_server.run_contexts.unregister(self.stream_id)
+
+    async def wait_finished(self):
+        while True:
+            state, _, _ = await self.stream.queue.get()
+            if state in FINAL_STATES:
+                return
+
+
+# The WorkerPool of the Flask server for coroutines: a waiting request holds a future instead of a thread.
+class AsyncWorkerPool(object):
+    def __init__(self, workers, schedule=SCHEDULE_FIFO, governor=None):
+        if schedule not in (SCHEDULE_FIFO, SCHEDULE_PRIORITY):
+            raise ValueError(f"Unknown schedule: {schedule}")
+        self.workers = list(workers)
+        self.schedule = schedule
+        self.idle = list(self.workers)
+        self.waiters = [] # Heap of (priority, ticket, future)
+        self.tickets = itertools.count()
+        self.governor = governor
+
+        self.served = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self, timeout=None, priority=0):
+        start = time.monotonic()
+        if self.idle and not self.waiters:
+            worker = self.idle.pop()
+            self._report_activity()
+        else:
+            future = asyncio.get_running_loop().create_future()
+            waiter = (priority if self.schedule == SCHEDULE_PRIORITY else 0, next(self.tickets), future)
+            heapq.heappush(self.waiters, waiter)
+            self._report_activity()
+            try:
+                await asyncio.wait({future}, timeout=timeout)
+            except asyncio.CancelledError:
+                # The client went away while queued; an instance handed over in the meantime goes back to the pool.
+                if future.done():
+                    self.release(future.result())
+                else:
+                    self._remove(waiter)
+                raise
+            if not future.done():
+                self._remove(waiter)
+                self.timeouts += 1
+                raise PoolTimeout(f"No RKLLM instance became available within {timeout}s")
+            worker = future.result()
+
+        waited = time.monotonic() - start
+        self.served += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return worker
+
+    def _remove(self, waiter):
+        waiter[2].cancel()
+        self.waiters.remove(waiter)
+        heapq.heapify(self.waiters)
+        self._report_activity()
+
+    def release(self, worker):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(worker)
+                return
+        self.idle.append(worker)
+        self._report_activity()
+
+    def _report_activity(self):
+        if self.governor is not None:
+            self.governor.set_active(len(self.waiters) + len(self.workers) - len(self.idle))
+
+    def stats(self):
+        return {
+            "schedule": self.schedule,
+            "instances": len(self.workers),
+            "idle_instances": len(self.idle),
+            "queue_depth": len(self.waiters),
+            "served": self.served,
+            "timeouts": self.timeouts,
+            "avg_wait_seconds": self.total_wait / self.served if self.served else 0.0,
+            "max_wait_seconds": self.max_wait,
+        }
+
+    def close(self):
+        for worker in self.workers:
+            worker.release()
+        self.workers = []
+        self.idle = []
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def send_response(send, status, body, content_type="application/json"):
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode("utf-8")), (b"content-length", str(len(body)).encode("utf-8"))]})
+    await send({"type": "http.response.body", "body": body})
+
+
+# Run handler(send) until it finishes or the client disconnects; a disconnect cancels the handler, which aborts its
+# generation or leaves the instance queue.
+async def run_until_disconnect(receive, handler):
+    work = asyncio.ensure_future(handler)
+    disconnect = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await asyncio.wait({work, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        if not work.done():
+            work.cancel()
+        disconnect.cancel()
+    try:
+        await work
+    except asyncio.CancelledError:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rkllm_model_path', type=str, required=True, help='Absolute path of the converted RKLLM model on the Linux board;')
+    parser.add_argument('--target_platform', type=str, required=True, help='Target platform: e.g., rk3588/rk3576;')
+    parser.add_argument('--lora_model_path', type=str, help='Absolute path of the lora_model on the Linux board;')
+    parser.add_argument('--prompt_cache_path', type=str, help='Absolute path of the prompt_cache file on the Linux board;')
+    parser.add_argument('--num_instances', type=int, default=1, help='Number of RKLLM instances serving requests in parallel;')
+    parser.add_argument('--base_domain_ids', type=str, help='Comma-separated base_domain_id for each instance, e.g., 0,1,2 (default: the instance index);')
+    parser.add_argument('--schedule', type=str, default=SCHEDULE_FIFO, choices=[SCHEDULE_FIFO, SCHEDULE_PRIORITY], help='Order in which queued requests get an instance;')
+    parser.add_argument('--queue_timeout', type=float, default=60.0, help='Seconds a request may wait for a free instance before the server answers 503;')
+    parser.add_argument('--request_timeout', type=float, default=300.0, help='Seconds after which a running generation is aborted;')
+    parser.add_argument('--max_new_tokens', type=int, default=-1, help='Abort a generation after this many tokens (-1 means no limit);')
+    parser.add_argument('--model_config', type=str, help='Path of model_config.json providing the prompt template of --model_family;')
+    parser.add_argument('--model_family', type=str, help='Family in --model_config whose PROMPT_TEXT_PREFIX/PROMPT_TEXT_POSTFIX are used;')
+    parser.add_argument('--model_config_poll', type=float, default=2.0, help='Seconds between checks of --model_config for changes, which are applied without a restart (0 = never);')
+    parser.add_argument('--stream_flush_ms', type=float, default=0, help='Milliseconds a streamed piece of text may wait for more before its chunk is sent (0 = send what has arrived whenever the client is ready);')
+    parser.add_argument('--stream_flush_tokens', type=int, default=0, help='Send a streamed chunk once it holds this many pieces of text (0 = no limit, 1 = one chunk per token);')
+    parser.add_argument('--no_token_echo', action='store_true', help='Do not print the generated tokens to the console;')
+    parser.add_argument('--freq_mode', type=str, default=FREQ_MODE_GOVERNOR, choices=FREQ_MODES, help='Clock control: governor boosts the NPU/CPU/DDR clocks while requests are queued or running, fixed runs fix_freq_[platform].sh once, none leaves the clocks alone;')
+    parser.add_argument('--sysfs_root', type=str, default='/', help='Directory the sysfs paths of the governor are relative to;')
+    parser.add_argument('--governor_idle_seconds', type=float, default=10.0, help='Seconds without requests after which the governor gives the clocks back to the kernel governors;')
+    parser.add_argument('--governor_sample_interval', type=float, default=1.0, help='Seconds between samples of the current frequencies and thermal zones;')
+    parser.add_argument('--governor_cpuidle', action='store_true', help='Also disable the deep CPU idle state (state1) while the clocks are boosted;')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Address to listen on;')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on;')
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        print("Error: the ASGI server needs uvicorn: pip install uvicorn.")
+        sys.stdout.flush()
+        exit()
+
+    if not os.path.exists(args.rkllm_model_path):
+        print("Error: Please provide the correct rkllm model path, and ensure it is the absolute path on the board.")
+        sys.stdout.flush()
+        exit()
+
+    if not (args.target_platform in ["rk3588", "rk3576"]):
+        print("Error: Please specify the correct target platform: rk3588/rk3576.")
+        sys.stdout.flush()
+        exit()
+
+    if args.lora_model_path and not os.path.exists(args.lora_model_path):
+        print("Error: Please provide the correct lora_model path, and advise it is the absolute path on the board.")
+        sys.stdout.flush()
+        exit()
+
+    if args.prompt_cache_path and not os.path.exists(args.prompt_cache_path):
+        print("Error: Please provide the correct prompt_cache_file path, and advise it is the absolute path on the board.")
+        sys.stdout.flush()
+        exit()
+
+    # Prompt template: the built-in one, or the family template from model_config.json, recompiled when the file changes.
+    builtin_template = PromptTemplate(PROMPT_TEXT_PREFIX, PROMPT_TEXT_POSTFIX, PROMPT_TEXT_TURN_SEPARATOR)
+    template_store = None
+    if args.model_config:
+        template_store = TemplateStore(args.model_config, args.model_config_poll, (args.model_family,),
+                                       prefix=PROMPT_TEXT_PREFIX, postfix=PROMPT_TEXT_POSTFIX)
+        if template_store.family_template(args.model_family) is None:
+            print("Error: Please specify a --model_family defined in {}: {}.".format(args.model_config, "/".join(template_store.family_names())))
+            sys.stdout.flush()
+            exit()
+
+    def prompt_template():
+        if template_store is None:
+            return builtin_template
+        return template_store.family_template(args.model_family)
+
+    if args.num_instances < 1:
+        print("Error: --num_instances must be at least 1.")
+        sys.stdout.flush()
+        exit()
+
+    if args.base_domain_ids:
+        base_domain_ids = [int(domain_id) for domain_id in args.base_domain_ids.split(",")]
+        if len(base_domain_ids) != args.num_instances:
+            print("Error: --base_domain_ids must list one domain id per instance.")
+            sys.stdout.flush()
+            exit()
+    else:
+        base_domain_ids = list(range(args.num_instances))
+
+    # Clock control: the governor raises the clocks while there is work and relaxes them when the server is idle;
+    # --freq_mode fixed pins them once with the fix_freq script as before. A governor that cannot write any clock
+    # (e.g. without root) falls back to the script, which runs with sudo.
+    governor = None
+    if args.freq_mode == FREQ_MODE_GOVERNOR:
+        governor = FrequencyGovernor(args.target_platform, args.sysfs_root, args.governor_idle_seconds, args.governor_sample_interval,
+                                     args.governor_cpuidle)
+        if not governor.controls_clocks():
+            print("Warning: the frequency governor cannot write any clock of {}, falling back to --freq_mode fixed.".format(args.target_platform))
+            sys.stdout.flush()
+            governor.close()
+            governor = None
+    if args.freq_mode == FREQ_MODE_FIXED or (args.freq_mode == FREQ_MODE_GOVERNOR and governor is None):
+        command = "sudo bash fix_freq_{}.sh".format(args.target_platform)
+        subprocess.run(command, shell=True)
+
+    # Set resource limit
+    resource.setrlimit(resource.RLIMIT_NOFILE, (102400, 102400))
+
+    flask_server.TOKEN_ECHO = not args.no_token_echo
+
+    # Streamed responses collect the pieces of text that arrive close together into one chunk.
+    flush_policy = FlushPolicy(args.stream_flush_ms / 1000.0, args.stream_flush_tokens)
+
+    # Initialize RKLLM model
+    print("=========init....===========")
+    sys.stdout.flush()
+    load_start = time.monotonic()
+    rkllm_models = [RKLLM(args.rkllm_model_path, args.lora_model_path, args.prompt_cache_path, domain_id) for domain_id in base_domain_ids]
+    model_load_seconds = time.monotonic() - load_start
+    rkllm_pool = AsyncWorkerPool(rkllm_models, args.schedule, governor)
+    print("RKLLM Model has been initialized successfully！")
+    print("==============================")
+    sys.stdout.flush()
+
+    run_metrics.num_instances = len(rkllm_models)
+    metrics_registry.gauge_func("rkllm_instances", "RKLLM handles in the pool.", lambda: rkllm_pool.stats()["instances"])
+    metrics_registry.gauge_func("rkllm_active_handles", "RKLLM handles serving a request.",
+                                lambda: rkllm_pool.stats()["instances"] - rkllm_pool.stats()["idle_instances"])
+    metrics_registry.gauge_func("rkllm_queue_depth", "Requests waiting for a free RKLLM handle.", lambda: rkllm_pool.stats()["queue_depth"])
+    metrics_registry.counter_func("rkllm_queue_timeouts_total", "Requests that gave up waiting for a handle.", lambda: rkllm_pool.stats()["timeouts"])
+    if governor is not None:
+        metrics_registry.gauge_func("rkllm_governor_boosted", "1 while the governor holds the clocks at their maximum.",
+                                    lambda: int(governor.stats()["boosted"]))
+        metrics_registry.counter_func("rkllm_governor_boosts_total", "Times the governor raised the clocks for new work.",
+                                      lambda: governor.stats()["boosts"])
+        metrics_registry.counter_func("rkllm_governor_boosted_seconds_total", "Seconds the clocks were held at their maximum.",
+                                      lambda: governor.stats()["boosted_seconds"])
+        metrics_registry.labeled_gauge_func("rkllm_cur_freq", "Current frequency of each clock domain as reported by sysfs (kHz for CPUs, Hz otherwise).",
+                                            "domain", lambda: governor.stats()["cur_freq"])
+        metrics_registry.labeled_gauge_func("rkllm_thermal_zone_celsius", "Temperature of each thermal zone.",
+                                            "zone", lambda: governor.stats()["temperature_c"])
+    metrics_registry.gauge_func("rkllm_model_load_seconds", "Seconds it took to initialize the RKLLM handles.", lambda: model_load_seconds)
+    metrics_registry.gauge_func("rkllm_active_runs", "Runs whose callbacks are being delivered.", lambda: len(flask_server.run_contexts))
+
+    def split_messages(template, messages):
+        system_prompt = template.system_prompt
+        for message in messages:
+            if message.get('role') == 'system':
+                system_prompt = message['content']
+        return system_prompt, [message for message in messages if message.get('role') != 'system']
+
+    def chat_response(choice):
+        return {
+            "id": "rkllm_chat",
+            "object": "rkllm_chat",
+            "created": None,
+            "choices": [choice],
+            "usage": {
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "total_tokens": None
+            }
+        }
+
+    # Same request and response format as /rkllm_chat of the Flask server. A streamed chunk carries the new text in
+    # choices[-1] only, instead of every chunk sent so far.
+    # max_tokens in the request lowers --max_new_tokens; sampling parameters are fixed at startup in this server.
+    async def receive_message(data, send):
+        max_new_tokens = args.max_new_tokens
+        if data.get("max_tokens") is not None:
+            try:
+                max_tokens = int(data["max_tokens"])
+            except (TypeError, ValueError):
+                max_tokens = 0
+            if max_tokens < 1:
+                await send_response(send, 400, {'status': 'error', 'message': 'max_tokens must be a positive integer'})
+                return
+            max_new_tokens = max_tokens if max_new_tokens <= 0 else min(max_tokens, max_new_tokens)
+        try:
+            priority = int(data.get("priority", 0))
+        except (TypeError, ValueError):
+            await send_response(send, 400, {'status': 'error', 'message': 'priority must be an integer'})
+            return
+
+        try:
+            rkllm_model = await rkllm_pool.acquire(timeout=args.queue_timeout, priority=priority)
+        except PoolTimeout:
+            await send_response(send, 503, {'status': 'error', 'message': 'RKLLM_Server is busy! Maybe you can try again later.'})
+            return
+
+        try:
+            template = prompt_template()
+            system_prompt, user_messages = split_messages(template, data['messages'])
+            if not data.get("stream"):
+                response = chat_response(None)
+                response["choices"] = []
+                for index, message in enumerate(user_messages):
+                    model_run = AsyncModelRun(rkllm_model, template.render(message['content'], system_prompt), max_new_tokens, args.request_timeout)
+                    try:
+                        rkllm_output = "".join([text async for text in model_run.texts()])
+                    finally:
+                        await model_run.close()
+                    response["choices"].append({
+                        "index": index,
+                        "message": {"role": "assistant", "content": rkllm_output},
+                        "logprobs": None,
+                        "finish_reason": model_run.finish_reason,
+                    })
+                await send_response(send, 200, response)
+                return
+
+            await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+            for index, message in enumerate(user_messages):
+                model_run = AsyncModelRun(rkllm_model, template.render(message['content'], system_prompt), max_new_tokens, args.request_timeout)
+                chunk = ChunkTemplate(chat_response({
+                    "index": index,
+                    "delta": {"role": "assistant", "content": CONTENT_MARKER},
+                    "logprobs": None,
+                    "finish_reason": None,
+                }), suffix="\n\n")
+                try:
+                    async for text in model_run.chunks(flush_policy):
+                        await send({"type": "http.response.body", "body": chunk.render(text).encode("utf-8"), "more_body": True})
+                finally:
+                    # Also reached when the client disconnects in the middle of the stream: the run is aborted.
+                    await model_run.close()
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            rkllm_pool.release(rkllm_model)
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        path, method = scope["path"], scope["method"]
+        if path == "/rkllm_status" and method == "GET":
+            status = dict(rkllm_pool.stats(), stream_flush=flush_policy.describe())
+            if governor is not None:
+                status["governor"] = governor.stats()
+            await send_response(send, 200, status)
+        elif path == "/metrics" and method == "GET":
+            await send_response(send, 200, metrics_registry.render().encode("utf-8"), METRICS_CONTENT_TYPE)
+        elif path == "/rkllm_chat" and method == "POST":
+            body = await read_body(receive)
+            if body is None:
+                return
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            if not (isinstance(data, dict) and 'messages' in data):
+                await send_response(send, 400, {'status': 'error', 'message': 'Invalid JSON data!'})
+                return
+            await run_until_disconnect(receive, receive_message(data, send))
+        else:
+            await send_response(send, 404, {'status': 'error', 'message': 'Not found!'})
+
+    # Start the ASGI application; every connection is a coroutine on one event loop. uvicorn shuts down gracefully on
+    # SIGINT or SIGTERM and raises the signal again afterwards; both end up as KeyboardInterrupt, so the instances are
+    # released and the clocks relaxed below.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        uvicorn.run(app, host=args.host, port=args.port, log_level="warning", timeout_keep_alive=75)
+    except KeyboardInterrupt:
+        pass
+
+    print("====================")
+    print("RKLLM model inference completed, releasing RKLLM model resources...")
+    rkllm_pool.close()
+    if governor is not None:
+        governor.close()
+    print("====================")
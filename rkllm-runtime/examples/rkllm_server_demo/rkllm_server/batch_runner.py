@@ -0,0 +1,96 @@
+import queue
+import threading
+import time
+
+from admission import AdmissionRejected
+from worker_pool import PoolTimeout
+
+# Times an item is preempted and queued again before it runs to the end regardless.
+MAX_PREEMPTIONS = 3
+
+
+# The cancelled flag passed to run_item: set when the batch is cancelled or, for an item that may be preempted, when the
+# pool asks its instance to yield to a request of a higher lane. yielded records whether run_item saw the request to
+# yield, so an item that finished before it looked is not run again.
+class RunStop(object):
+    def __init__(self, runner, worker, preemptible):
+        self.runner = runner
+        self.worker = worker
+        self.preemptible = preemptible
+        self.yielded = False
+
+    def is_set(self):
+        if self.runner.cancelled.is_set():
+            return True
+        if self.preemptible and self.runner.pool.should_yield(self.worker):
+            self.yielded = True
+        return self.yielded
+
+
+# Run a list of independent items across the instances of a WorkerPool.
+# Each worker thread takes an instance, runs one item with run_item(rkllm_model, item, cancelled) and gives the instance
+# back, so the next item is submitted as soon as an instance is free and interactive requests can interleave.
+# match, lane and cost(item) are passed to WorkerPool.acquire. In a preemptible lane, an item whose instance is asked to
+# yield stops and is queued again. run_item must check cancelled.is_set() while it generates and report whether it
+# stopped because of it.
+# Iterating yields (index, result) in completion order; closing the iterator cancels the items that have not started.
+class BatchRunner(object):
+    def __init__(self, pool, items, run_item, concurrency=1, priority=0, queue_timeout=None, match=None, lane=None, cost=None):
+        self.pool = pool
+        self.match = match
+        self.lane = lane
+        self.cost = cost
+        self.preemptions = {} # index -> times the item was preempted
+        self.items = list(items)
+        self.run_item = run_item
+        self.priority = priority
+        self.queue_timeout = queue_timeout
+        self.pending = queue.Queue()
+        for index, item in enumerate(self.items):
+            self.pending.put((index, item))
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+        self.started = time.monotonic()
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(max(1, min(concurrency, len(self.items))))]
+        for worker in self.workers:
+            worker.start()
+
+    def _work(self):
+        while not self.cancelled.is_set():
+            try:
+                index, item = self.pending.get_nowait()
+            except queue.Empty:
+                return
+            preemptible = self.lane is not None and self.lane.preemptible and self.preemptions.get(index, 0) < MAX_PREEMPTIONS
+            try:
+                rkllm_model = self.pool.acquire(timeout=self.queue_timeout, priority=self.priority, match=self.match,
+                                                lane=self.lane, cost=self.cost(item) if self.cost is not None else 0.0,
+                                                preemptible=preemptible)
+            except (PoolTimeout, AdmissionRejected) as e:
+                self.results.put((index, {"error": str(e), "queue_timeout": True}))
+                continue
+            stop = RunStop(self, rkllm_model, preemptible)
+            try:
+                result = self.run_item(rkllm_model, item, stop)
+            except Exception as e:
+                result = {"error": str(e)}
+            finally:
+                preempted = stop.yielded and not self.cancelled.is_set()
+                self.pool.release(rkllm_model)
+            if preempted:
+                self.preemptions[index] = self.preemptions.get(index, 0) + 1
+                self.pending.put((index, item))
+                continue
+            self.results.put((index, result))
+
+    def __iter__(self):
+        try:
+            for _ in range(len(self.items)):
+                yield self.results.get()
+        finally:
+            self.close()
+
+    def close(self):
+        self.cancelled.set()
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+# The output of one generation, shared by every request that asked for it. The producer appends (index, text) events;
+# each subscriber replays them from the start and then follows new ones, so a request that attaches late still
+# receives the whole stream.
+class SharedGeneration(object):
+    def __init__(self, key):
+        self.key = key
+        self.events = []
+        self.finish_reasons = {} # choice index -> finish_reason
+        self.nbytes = 0
+        self.done = False
+        self.cancelled = False # Set once the last subscriber left before the end; the producer then aborts
+        self.subscribers = 0
+        self.cond = threading.Condition()
+
+    def publish(self, index, text):
+        with self.cond:
+            self.events.append((index, text))
+            self.nbytes += len(text.encode("utf-8"))
+            self.cond.notify_all()
+
+    def finish_choice(self, index, finish_reason):
+        with self.cond:
+            self.finish_reasons[index] = finish_reason
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def subscribe(self):
+        with self.cond:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        with self.cond:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.cancelled = True
+
+    # Yield the events of the generation from the first one until it is finished.
+    def follow(self):
+        position = 0
+        while True:
+            with self.cond:
+                while position >= len(self.events) and not self.done:
+                    self.cond.wait()
+                events = self.events[position:]
+                done = self.done
+            position += len(events)
+            for event in events:
+                yield event
+            if done and position >= len(self.events):
+                return
+
+    # Cached only if every choice ended normally; an error, timeout or abort would be replayed to later requests.
+    def cacheable(self):
+        return not self.cancelled and all(reason in ("stop", "length") for reason in self.finish_reasons.values())
+
+    # Like follow, with the events collected into chunks by flush_policy (see stream_writer.FlushPolicy). Yields lists
+    # of (index, text) in which the consecutive texts of a choice are joined; a late subscriber gets the events so far
+    # in as few chunks as the policy allows.
+    def follow_chunks(self, flush_policy):
+        position = 0
+        while True:
+            with self.cond:
+                while position >= len(self.events) and not self.done:
+                    self.cond.wait()
+                if position > 0:
+                    started = time.monotonic()
+                    while not self.done and not flush_policy.full(len(self.events) - position, time.monotonic() - started):
+                        wait = flush_policy.wait(time.monotonic() - started)
+                        if wait <= 0:
+                            break
+                        self.cond.wait(wait)
+                end = len(self.events)
+                if position == 0 and end:
+                    end = 1 # The first event is sent on its own
+                elif flush_policy.max_tokens > 0:
+                    end = min(end, position + flush_policy.max_tokens)
+                events = self.events[position:end]
+                done = self.done
+            position += len(events)
+            if events:
+                yield join_events(events)
+            if done and position >= len(self.events):
+                return
+
+
+# Join the consecutive texts of the same choice in a list of (index, text) events.
+def join_events(events):
+    joined = []
+    for index, text in events:
+        if joined and joined[-1][0] == index:
+            joined[-1][1].append(text)
+        else:
+            joined.append((index, [text]))
+    return [(index, "".join(texts)) for index, texts in joined]
+
+
+# Identical requests (same model, prompts and greedy decoding parameters) attach to one in-flight generation
+# instead of each running it. With cache_ttl > 0, finished generations are also kept for cache_ttl seconds and
+# replayed to exact repeats; the cache is bounded by the size of the generated text, least recently used first.
+class RequestCoalescer(object):
+    def __init__(self, cache_ttl=0, cache_max_bytes=0):
+        self.cache_ttl = cache_ttl # 0 disables the response cache
+        self.cache_max_bytes = cache_max_bytes # 0 means unlimited
+        self.lock = threading.Lock()
+        self.inflight = {} # key -> SharedGeneration
+        self.cache = OrderedDict() # key -> (expiry time, SharedGeneration), least recently used first
+        self.cache_bytes = 0
+
+        self.generations = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+        self.cache_evictions = 0
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    # The generation for key that is running or cached, subscribed for the caller; None if there is none.
+    # use_cache=False only attaches to a running generation, e.g. to refresh a cached response.
+    def lookup(self, key, use_cache=True):
+        with self.lock:
+            cached = self.cache.get(key) if use_cache else None
+            if cached is not None:
+                expiry, generation = cached
+                if expiry > time.monotonic():
+                    self.cache.move_to_end(key)
+                    self.cache_hits += 1
+                    generation.subscribe()
+                    return generation
+                self._drop(key)
+            generation = self.inflight.get(key)
+            if generation is None or generation.cancelled:
+                return None
+            self.coalesced += 1
+            generation.subscribe()
+            return generation
+
+    # Like lookup, but create and subscribe a new generation if there is none. Returns (generation, is_producer);
+    # the producer must run the generation and call complete() at its end.
+    def join(self, key, use_cache=True):
+        generation = self.lookup(key, use_cache)
+        if generation is not None:
+            return generation, False
+        with self.lock:
+            generation = self.inflight.get(key)
+            if generation is not None and not generation.cancelled:
+                self.coalesced += 1
+                generation.subscribe()
+                return generation, False
+            generation = self.inflight[key] = SharedGeneration(key)
+            self.generations += 1
+            generation.subscribe()
+            return generation, True
+
+    # Called by the producer once the generation is finished (or could not be started).
+    def complete(self, generation):
+        generation.finish()
+        with self.lock:
+            if self.inflight.get(generation.key) is generation:
+                del self.inflight[generation.key]
+            if self.cache_ttl <= 0 or not generation.cacheable():
+                return
+            if self.cache_max_bytes and generation.nbytes > self.cache_max_bytes:
+                return
+            if generation.key in self.cache:
+                self._drop(generation.key)
+            self.cache[generation.key] = (time.monotonic() + self.cache_ttl, generation)
+            self.cache_bytes += generation.nbytes
+            while self.cache_max_bytes and self.cache_bytes > self.cache_max_bytes:
+                self._drop(next(iter(self.cache)))
+                self.cache_evictions += 1
+
+    def _drop(self, key):
+        _, generation = self.cache.pop(key)
+        self.cache_bytes -= generation.nbytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                "inflight": len(self.inflight),
+                "generations": self.generations,
+                "coalesced": self.coalesced,
+                "cache_entries": len(self.cache),
+                "cache_mib": round(self.cache_bytes / 2**20, 3),
+                "cache_hits": self.cache_hits,
+                "cache_evictions": self.cache_evictions,
+            }
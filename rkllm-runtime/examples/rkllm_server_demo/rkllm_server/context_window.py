@@ -0,0 +1,124 @@
+import math
+import threading
+from collections import OrderedDict
+
+from admission import CHARS_PER_TOKEN
+from prompt_template import message_text
+
+# Token counts kept by TokenCounter; the least recently used are dropped first.
+MAX_COUNTED_TEXTS = 4096
+
+# Share of the budget a history is cut down to once it no longer fits.
+LOW_WATER = 0.75
+
+# How the summary of dropped turns is put in front of the turns that are kept.
+SUMMARY_FORMAT = "Summary of the earlier conversation: {}\n\n"
+
+# The prompt of a summarizer run over the dropped turns (and the summary of the turns dropped before them).
+SUMMARIZE_PROMPT = "Summarize the following conversation in a few sentences. Keep the facts and decisions needed to continue it.\n\n{}"
+
+
+# Token counts of texts, from the model's tokenizer if there is one and estimated from the length otherwise. Counts of
+# the tokenizer are kept per text, so a text is tokenized once however often it is counted, e.g. the history messages
+# a client sends again with every request.
+class TokenCounter(object):
+    def __init__(self, tokenizer=None, max_texts=MAX_COUNTED_TEXTS):
+        self.tokenizer = tokenizer
+        self.max_texts = max_texts
+        self.lock = threading.Lock()
+        self.counts = OrderedDict() # text -> token count, least recently used first
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self.tokenizer is None:
+            return int(math.ceil(len(text) / CHARS_PER_TOKEN))
+        with self.lock:
+            tokens = self.counts.get(text)
+            if tokens is not None:
+                self.counts.move_to_end(text)
+                return tokens
+        tokens = len(self.tokenizer.encode(text, add_special_tokens=False))
+        with self.lock:
+            self.counts[text] = tokens
+            while len(self.counts) > self.max_texts:
+                self.counts.popitem(last=False)
+        return tokens
+
+
+# One finished exchange of a conversation: text is its prompt text (message, postfix, reply and turn separator), and
+# tokens its token count, taken once when the turn finished.
+class Turn(object):
+    def __init__(self, user_message, reply, text, tokens):
+        self.user_message = user_message
+        self.reply = reply
+        self.text = text
+        self.tokens = tokens
+
+
+# The context of a model: max_context_len tokens, of which reserve_tokens are kept free for the reply. A prompt is made
+# of a fixed part (prefix, summary and the new message) and the history turns before the new message; when they do not
+# fit, the oldest turns are dropped until the rest fits in low_water of the budget. The following turns then extend the
+# shortened history (and its prompt cache) for a while before it has to be cut again.
+# summarizer, if set, is called as summarizer(rkllm_model, summary, turns) with the summary so far and the dropped
+# turns, and returns the summary that replaces them; without one, dropped turns are forgotten.
+class ContextWindow(object):
+    def __init__(self, max_context_len, reserve_tokens, low_water=LOW_WATER, summarizer=None):
+        self.max_context_len = max_context_len
+        self.reserve_tokens = reserve_tokens
+        self.low_water = low_water
+        self.summarizer = summarizer
+
+    # Tokens available for the prompt; reserve_tokens overrides the default reserve, e.g. with the max_tokens of a request.
+    def budget(self, reserve_tokens=None):
+        if reserve_tokens is None or reserve_tokens <= 0:
+            reserve_tokens = self.reserve_tokens
+        return max(0, self.max_context_len - reserve_tokens)
+
+    # The number of oldest turns to drop so that the fixed part and the remaining turns fit. turn_tokens are the token
+    # counts of the turns, oldest first. 0 if everything fits; all turns if not even the fixed part fits.
+    def turns_to_drop(self, fixed_tokens, turn_tokens, reserve_tokens=None):
+        budget = self.budget(reserve_tokens)
+        total = fixed_tokens + sum(turn_tokens)
+        if total <= budget:
+            return 0
+        target = budget * self.low_water
+        dropped = 0
+        for tokens in turn_tokens:
+            if total <= target:
+                break
+            total -= tokens
+            dropped += 1
+        return dropped
+
+
+# The text a summarizer is asked to compress: the previous summary followed by the dropped turns.
+def summary_request(summary, turns):
+    lines = ["Earlier: " + summary] if summary else []
+    for turn in turns:
+        lines.append("User: " + turn.user_message)
+        lines.append("Assistant: " + turn.reply)
+    return SUMMARIZE_PROMPT.format("\n".join(lines))
+
+
+def summary_text(summary):
+    return SUMMARY_FORMAT.format(summary) if summary else ""
+
+
+# The messages of an OpenAI-style conversation that fit into window: system messages and the last message are kept,
+# and the oldest of the other messages are dropped first. A shortened history never starts with an assistant message.
+# fixed_tokens counts the prompt around the messages (e.g. the template prefix), reply_tokens the postfix and separator
+# around each assistant message.
+def fit_messages(window, counter, messages, fixed_tokens, reply_tokens=0, reserve_tokens=None):
+    history = [index for index, message in enumerate(messages[:-1]) if message.get('role') != 'system']
+    kept = set(range(len(messages))) - set(history)
+    fixed = fixed_tokens + sum(counter.count(message_text(messages[index])) for index in kept)
+    dropped = window.turns_to_drop(fixed, [counter.count(message_text(messages[index])) +
+                                           (reply_tokens if messages[index].get('role') == 'assistant' else 0)
+                                           for index in history], reserve_tokens)
+    if not dropped:
+        return messages
+    while dropped < len(history) and messages[history[dropped]].get('role') == 'assistant':
+        dropped += 1
+    removed = set(history[:dropped])
+    return [message for index, message in enumerate(messages) if index not in removed]
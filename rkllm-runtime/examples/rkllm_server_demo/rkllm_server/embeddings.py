@@ -0,0 +1,70 @@
+import base64
+
+try:
+    import numpy as np
+except ImportError:
+    np = None # The embeddings endpoint is disabled without numpy
+
+# Ways to reduce the hidden states of all prompt tokens to one vector.
+POOLING_MEAN = "mean"
+POOLING_LAST = "last"
+POOLING_CLS = "cls"
+POOLING_MODES = (POOLING_MEAN, POOLING_LAST, POOLING_CLS)
+
+ENCODING_FLOAT = "float"
+ENCODING_BASE64 = "base64"
+
+
+# Receives the last hidden layer of one run inside the runtime callback.
+# The runtime frees the hidden states after the callback returns, so they are copied exactly once, from a numpy view of
+# the runtime's memory into this buffer. The buffer grows to the longest input it has received and is reused by the
+# following runs of the same handle, so a run allocates nothing once the handle has seen an input of its length.
+class HiddenStateBuffer(object):
+    def __init__(self):
+        self.array = None
+        self.num_tokens = 0
+        self.embd_size = 0
+
+    # Forget the states of the previous run, keeping the memory.
+    def reset(self):
+        self.num_tokens = 0
+
+    def copy_from(self, hidden_layer):
+        num_tokens, embd_size = hidden_layer.num_tokens, hidden_layer.embd_size
+        if num_tokens <= 0 or embd_size <= 0 or not hidden_layer.hidden_states:
+            return False
+        view = np.ctypeslib.as_array(hidden_layer.hidden_states, shape=(num_tokens, embd_size))
+        if self.array is None or self.array.shape[0] < num_tokens or self.array.shape[1] != embd_size:
+            self.array = np.empty((num_tokens, embd_size), dtype=np.float32)
+        np.copyto(self.array[:num_tokens], view)
+        self.num_tokens = num_tokens
+        self.embd_size = embd_size
+        return True
+
+    def states(self):
+        if self.array is None or self.num_tokens == 0:
+            return None
+        return self.array[:self.num_tokens]
+
+
+def pool(states, pooling=POOLING_MEAN, normalize=True):
+    if pooling == POOLING_MEAN:
+        vector = states.mean(axis=0)
+    elif pooling == POOLING_LAST:
+        vector = states[-1].copy()
+    elif pooling == POOLING_CLS:
+        vector = states[0].copy()
+    else:
+        raise ValueError(f"Unknown pooling: {pooling}")
+    if normalize:
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+    return vector
+
+
+# A list of floats, or the little-endian float32 bytes in base64 as OpenAI clients expect.
+def encode(vector, encoding_format=ENCODING_FLOAT):
+    if encoding_format == ENCODING_BASE64:
+        return base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+    return vector.tolist()
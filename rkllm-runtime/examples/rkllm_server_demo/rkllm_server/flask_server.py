@@ -1,302 +1,430 @@
-import ctypes
 import sys
 import os
+import base64
+import binascii
 import subprocess
 import resource
-import threading
+import signal
 import time
 import argparse
 import json
-from flask import Flask, request, jsonify, Response
+import queue
+import uuid
+import threading
+from collections import OrderedDict
+from flask import Flask, request, jsonify, Response, g, has_request_context
+from freq_governor import FrequencyGovernor, FREQ_MODE_GOVERNOR, FREQ_MODE_FIXED, FREQ_MODES
+from worker_pool import WorkerPool, PoolTimeout, SCHEDULE_FIFO, SCHEDULE_PRIORITY
+from prompt_cache import PromptCacheStore
+from session_store import SessionStore
+from stream_writer import FlushPolicy, ChunkTemplate, CumulativeChunks, CONTENT_MARKER, EVERY_TOKEN
+from context_window import ContextWindow, TokenCounter, Turn, fit_messages, summary_request, summary_text
+from batch_runner import BatchRunner
+from coalescer import RequestCoalescer
+from admission import AdmissionRejected, LANE_INTERACTIVE, LANE_BATCH, CHARS_PER_TOKEN, default_lanes, read_lanes, request_cost
+from run_context import RunContext, RunContextRegistry, FINAL_STATES
+from prompt_template import PromptTemplate, TemplateStore
+from sampling import SamplingParams
+from lora_registry import LoraAdapter, LoraRegistry, adapter_path
+from image_cache import ImageEmbeddingCache, UnknownImage
+from embeddings import HiddenStateBuffer, POOLING_MODES, POOLING_MEAN, ENCODING_FLOAT, ENCODING_BASE64
+import embeddings
+from keep_alive import KeepAliveRequestHandler
+from metrics import MetricsRegistry, RunMetrics, RunTimer, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from rkllm_runtime import LLMCallState, RKLLMInferMode, RKLLMHandle, RKLLMError, callback_type, default_param
 
 app = Flask(__name__)
 
 PROMPT_TEXT_PREFIX = "<|im_start|>system You are a helpful assistant. <|im_end|> <|im_start|>user"
 PROMPT_TEXT_POSTFIX = "<|im_end|><|im_start|>assistant"
+PROMPT_TEXT_TURN_SEPARATOR = "<|im_end|><|im_start|>user"
+
+# Name of the adapter given with --lora_model_path.
+DEFAULT_LORA_NAME = "default"
+
+# Maximum number of decoded text pieces buffered per request before the callback waits for the consumer.
+TOKEN_QUEUE_SIZE = 1024
+
+# Echo every generated token to the console (--no_token_echo turns it off; printing and flushing costs time per token).
+TOKEN_ECHO = True
+
+# Metrics served at /metrics; the run timings are taken in the callback and in RKLLM.run.
+metrics_registry = MetricsRegistry()
+run_metrics = RunMetrics(metrics_registry)
+
+# Every run in progress, by the run id passed to rkllm_run as userdata; the callback delivers to the run's own context.
+run_contexts = RunContextRegistry()
 
-# Set the dynamic library path
-rkllm_lib = ctypes.CDLL('lib/librkllmrt.so')
-
-# Define the structures from the library
-RKLLM_Handle_t = ctypes.c_void_p
-userdata = ctypes.c_void_p(None)
-
-LLMCallState = ctypes.c_int
-LLMCallState.RKLLM_RUN_NORMAL  = 0
-LLMCallState.RKLLM_RUN_WAITING  = 1
-LLMCallState.RKLLM_RUN_FINISH  = 2
-LLMCallState.RKLLM_RUN_ERROR   = 3
-LLMCallState.RKLLM_RUN_GET_LAST_HIDDEN_LAYER = 4
-
-RKLLMInputMode = ctypes.c_int
-RKLLMInputMode.RKLLM_INPUT_PROMPT      = 0
-RKLLMInputMode.RKLLM_INPUT_TOKEN       = 1
-RKLLMInputMode.RKLLM_INPUT_EMBED       = 2
-RKLLMInputMode.RKLLM_INPUT_MULTIMODAL  = 3
-
-RKLLMInferMode = ctypes.c_int
-RKLLMInferMode.RKLLM_INFER_GENERATE = 0
-RKLLMInferMode.RKLLM_INFER_GET_LAST_HIDDEN_LAYER = 1
-
-class RKLLMExtendParam(ctypes.Structure):
-    _fields_ = [
-        ("base_domain_id", ctypes.c_int32),
-        ("reserved", ctypes.c_uint8 * 112)
-    ]
-
-class RKLLMParam(ctypes.Structure):
-    _fields_ = [
-        ("model_path", ctypes.c_char_p),
-        ("max_context_len", ctypes.c_int32),
-        ("max_new_tokens", ctypes.c_int32),
-        ("top_k", ctypes.c_int32),
-        ("top_p", ctypes.c_float),
-        ("temperature", ctypes.c_float),
-        ("repeat_penalty", ctypes.c_float),
-        ("frequency_penalty", ctypes.c_float),
-        ("presence_penalty", ctypes.c_float),
-        ("mirostat", ctypes.c_int32),
-        ("mirostat_tau", ctypes.c_float),
-        ("mirostat_eta", ctypes.c_float),
-        ("skip_special_token", ctypes.c_bool),
-        ("is_async", ctypes.c_bool),
-        ("img_start", ctypes.c_char_p),
-        ("img_end", ctypes.c_char_p),
-        ("img_content", ctypes.c_char_p),
-        ("extend_param", RKLLMExtendParam),
-    ]
-
-class RKLLMLoraAdapter(ctypes.Structure):
-    _fields_ = [
-        ("lora_adapter_path", ctypes.c_char_p),
-        ("lora_adapter_name", ctypes.c_char_p),
-        ("scale", ctypes.c_float)
-    ]
-
-class RKLLMEmbedInput(ctypes.Structure):
-    _fields_ = [
-        ("embed", ctypes.POINTER(ctypes.c_float)),
-        ("n_tokens", ctypes.c_size_t)
-    ]
-
-class RKLLMTokenInput(ctypes.Structure):
-    _fields_ = [
-        ("input_ids", ctypes.POINTER(ctypes.c_int32)),
-        ("n_tokens", ctypes.c_size_t)
-    ]
-
-class RKLLMMultiModelInput(ctypes.Structure):
-    _fields_ = [
-        ("prompt", ctypes.c_char_p),
-        ("image_embed", ctypes.POINTER(ctypes.c_float)),
-        ("n_image_tokens", ctypes.c_size_t)
-    ]
-
-class RKLLMInputUnion(ctypes.Union):
-    _fields_ = [
-        ("prompt_input", ctypes.c_char_p),
-        ("embed_input", RKLLMEmbedInput),
-        ("token_input", RKLLMTokenInput),
-        ("multimodal_input", RKLLMMultiModelInput)
-    ]
-
-class RKLLMInput(ctypes.Structure):
-    _fields_ = [
-        ("input_mode", ctypes.c_int),
-        ("input_data", RKLLMInputUnion)
-    ]
-
-class RKLLMLoraParam(ctypes.Structure):
-    _fields_ = [
-        ("lora_adapter_name", ctypes.c_char_p)
-    ]
-
-class RKLLMPromptCacheParam(ctypes.Structure):
-    _fields_ = [
-        ("save_prompt_cache", ctypes.c_int),
-        ("prompt_cache_path", ctypes.c_char_p)
-    ]
-
-class RKLLMInferParam(ctypes.Structure):
-    _fields_ = [
-        ("mode", RKLLMInferMode),
-        ("lora_params", ctypes.POINTER(RKLLMLoraParam)),
-        ("prompt_cache_params", ctypes.POINTER(RKLLMPromptCacheParam))
-    ]
-
-class RKLLMResultLastHiddenLayer(ctypes.Structure):
-    _fields_ = [
-        ("hidden_states", ctypes.POINTER(ctypes.c_float)),
-        ("embd_size", ctypes.c_int),
-        ("num_tokens", ctypes.c_int)
-    ]
-
-class RKLLMResult(ctypes.Structure):
-    _fields_ = [
-        ("text", ctypes.c_char_p),
-        ("size", ctypes.c_int),
-        ("last_hidden_layer", RKLLMResultLastHiddenLayer)
-    ]
-
-
-# Create a lock to control multi-user access to the server.
-lock = threading.Lock()
-
-# Create a global variable to indicate whether the server is currently in a blocked state.
-is_blocking = False
-
-# Define global variables to store the callback function output for displaying in the Gradio interface
-global_text = []
-global_state = -1
-split_byte_data = bytes(b"") # Used to store the segmented byte data
+# RunContext whose output is consumed by a request thread through a bounded queue. Each item is (state, text, n_tokens)
+# with the number of tokens generated up to it, so the consumer knows how many tokens it has actually received.
+class TokenStream(RunContext):
+    def __init__(self, maxsize=TOKEN_QUEUE_SIZE):
+        RunContext.__init__(self)
+        self.queue = queue.Queue(maxsize)
+
+    def put(self, state, text=None):
+        self.state = state
+        self.queue.put((state, text, self.n_tokens))
+
+    def get(self, timeout=None):
+        # Block until the callback hands over the next piece of text; raises queue.Empty once the timeout expires.
+        return self.queue.get(timeout=timeout)
+
+    def wait_finished(self, timeout=None):
+        # Discard pending output until the runtime reports the end of the run.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                state, _, _ = self.get(remaining)
+            except queue.Empty:
+                return False
+            if state in FINAL_STATES:
+                return True
+
+def open_token_stream():
+    stream = TokenStream()
+    return run_contexts.register(stream), stream
+
+def close_token_stream(stream_id):
+    stream = run_contexts.unregister(stream_id)
+    if stream is not None:
+        # Unblock the callback if it is waiting on a full queue; later callbacks find no stream and drop their output.
+        while not stream.queue.empty():
+            stream.queue.get_nowait()
 
 # Define the callback function
 def callback_impl(result, userdata, state):
-    global global_text, global_state, split_byte_data
-    if state == LLMCallState.RKLLM_RUN_FINISH:
-        global_state = state
-        print("\n")
-        sys.stdout.flush()
-    elif state == LLMCallState.RKLLM_RUN_ERROR:
-        global_state = state
+    context = run_contexts.get(userdata)
+    if context is None:
+        return
+    text = context.handle(result, state)
+    if state == LLMCallState.RKLLM_RUN_ERROR:
         print("run error")
         sys.stdout.flush()
-    elif state == LLMCallState.RKLLM_RUN_GET_LAST_HIDDEN_LAYER:
-        '''
-        If using the GET_LAST_HIDDEN_LAYER function, the callback interface will return the memory pointer: last_hidden_layer, the number of tokens: num_tokens, and the size of the hidden layer: embd_size.
-        With these three parameters, you can retrieve the data from last_hidden_layer.
-        Note: The data needs to be retrieved during the current callback; if not obtained in time, the pointer will be released by the next callback.
-        '''
-        if result.last_hidden_layer.embd_size != 0 and result.last_hidden_layer.num_tokens != 0:
-            data_size = result.last_hidden_layer.embd_size * result.last_hidden_layer.num_tokens * ctypes.sizeof(ctypes.c_float)
-            print(f"data_size: {data_size}")
-            global_text.append(f"data_size: {data_size}\n")
-            output_path = os.getcwd() + "/last_hidden_layer.bin"
-            with open(output_path, "wb") as outFile:
-                data = ctypes.cast(result.last_hidden_layer.hidden_states, ctypes.POINTER(ctypes.c_float))
-                float_array_type = ctypes.c_float * (data_size // ctypes.sizeof(ctypes.c_float))
-                float_array = float_array_type.from_address(ctypes.addressof(data.contents))
-                outFile.write(bytearray(float_array))
-                print(f"Data saved to {output_path} successfully!")
-                global_text.append(f"Data saved to {output_path} successfully!")
-        else:
-            print("Invalid hidden layer data.")
-            global_text.append("Invalid hidden layer data.")
-        global_state = state
-        time.sleep(0.05) # Delay for 0.05 seconds to wait for the output result
-        sys.stdout.flush()
-    else:
-        # Save the output token text and the RKLLM running state
-        global_state = state
-        # Monitor if the current byte data is complete; if incomplete, record it for later parsing
-        try:
-            global_text.append((split_byte_data + result.contents.text).decode('utf-8'))
-            print((split_byte_data + result.contents.text).decode('utf-8'), end='')
-            split_byte_data = bytes(b"")
-        except:
-            split_byte_data += result.contents.text
-        sys.stdout.flush()
+    elif TOKEN_ECHO:
+        if state == LLMCallState.RKLLM_RUN_FINISH:
+            print((text or "") + "\n\n", end='')
+            sys.stdout.flush()
+        elif state == LLMCallState.RKLLM_RUN_NORMAL and text:
+            print(text, end='')
+            sys.stdout.flush()
 
 # Connect the callback function between the Python side and the C++ side
-callback_type = ctypes.CFUNCTYPE(None, ctypes.POINTER(RKLLMResult), ctypes.c_void_p, ctypes.c_int)
 callback = callback_type(callback_impl)
 
 # Define the RKLLM class, which includes initialization, inference, and release operations for the RKLLM model in the dynamic library
 class RKLLM(object):
-    def __init__(self, model_path, lora_model_path = None, prompt_cache_path = None):
-        rkllm_param = RKLLMParam()
-        rkllm_param.model_path = bytes(model_path, 'utf-8')
-
-        rkllm_param.max_context_len = 512
-        rkllm_param.max_new_tokens = -1
-        rkllm_param.skip_special_token = True
-
-        rkllm_param.top_k = 1
-        rkllm_param.top_p = 0.9
-        rkllm_param.temperature = 0.8
-        rkllm_param.repeat_penalty = 1.1
-        rkllm_param.frequency_penalty = 0.0
-        rkllm_param.presence_penalty = 0.0
-
-        rkllm_param.mirostat = 0
-        rkllm_param.mirostat_tau = 5.0
-        rkllm_param.mirostat_eta = 0.1
-
-        rkllm_param.is_async = False
-
-        rkllm_param.img_start = "".encode('utf-8')
-        rkllm_param.img_end = "".encode('utf-8')
-        rkllm_param.img_content = "".encode('utf-8')
-
-        rkllm_param.extend_param.base_domain_id = 0
-        
-        self.handle = RKLLM_Handle_t()
-
-        self.rkllm_init = rkllm_lib.rkllm_init
-        self.rkllm_init.argtypes = [ctypes.POINTER(RKLLM_Handle_t), ctypes.POINTER(RKLLMParam), callback_type]
-        self.rkllm_init.restype = ctypes.c_int
-        self.rkllm_init(ctypes.byref(self.handle), ctypes.byref(rkllm_param), callback)
-
-        self.rkllm_run = rkllm_lib.rkllm_run
-        self.rkllm_run.argtypes = [RKLLM_Handle_t, ctypes.POINTER(RKLLMInput), ctypes.POINTER(RKLLMInferParam), ctypes.c_void_p]
-        self.rkllm_run.restype = ctypes.c_int
-
-        self.rkllm_destroy = rkllm_lib.rkllm_destroy
-        self.rkllm_destroy.argtypes = [RKLLM_Handle_t]
-        self.rkllm_destroy.restype = ctypes.c_int
-
-        self.lora_adapter_path = None
-        self.lora_model_name = None
-        if lora_model_path:
-            self.lora_adapter_path = lora_model_path
-            self.lora_adapter_name = "test"
-
-            lora_adapter = RKLLMLoraAdapter()
-            ctypes.memset(ctypes.byref(lora_adapter), 0, ctypes.sizeof(RKLLMLoraAdapter))
-            lora_adapter.lora_adapter_path = ctypes.c_char_p((self.lora_adapter_path).encode('utf-8'))
-            lora_adapter.lora_adapter_name = ctypes.c_char_p((self.lora_adapter_name).encode('utf-8'))
-            lora_adapter.scale = 1.0
-
-            rkllm_load_lora = rkllm_lib.rkllm_load_lora
-            rkllm_load_lora.argtypes = [RKLLM_Handle_t, ctypes.POINTER(RKLLMLoraAdapter)]
-            rkllm_load_lora.restype = ctypes.c_int
-            rkllm_load_lora(self.handle, ctypes.byref(lora_adapter))
-        
+    def __init__(self, model_path, lora_model_path = None, prompt_cache_path = None, base_domain_id = 0, sampling = None, max_context_len = 512,
+                 max_lora_adapters = 0, image_markers = None):
+        self.model_path = model_path
+        self.image_markers = image_markers or {} # img_start, img_end and img_content of a multimodal model
+        self.base_domain_id = base_domain_id
+        self.max_context_len = max_context_len
+        self.sampling = sampling or SamplingParams()
+        self.hidden_states = None # HiddenStateBuffer reused by the GET_LAST_HIDDEN_LAYER runs of this handle
+        self.reconfigurations = 0
+
+        self.max_lora_adapters = max_lora_adapters # 0 means unlimited
+        self.lora_adapters = OrderedDict() # name -> LoraAdapter loaded on the handle, least recently used first
+        self.lora_adapter_name = None # Adapter applied to the following runs
+        self.lora_loads = 0
+        self.lora_evictions = 0
+
+        self.handle = self._init_handle(self.sampling)
+
         self.prompt_cache_path = None
+        self.default_prompt_cache_path = prompt_cache_path
         if prompt_cache_path:
-            self.prompt_cache_path = prompt_cache_path
-
-            rkllm_load_prompt_cache = rkllm_lib.rkllm_load_prompt_cache
-            rkllm_load_prompt_cache.argtypes = [RKLLM_Handle_t, ctypes.c_char_p]
-            rkllm_load_prompt_cache.restype = ctypes.c_int
-            rkllm_load_prompt_cache(self.handle, ctypes.c_char_p((prompt_cache_path).encode('utf-8')))
-
-    def run(self, prompt):
-        rkllm_lora_params = None
-        if self.lora_model_name:
-            rkllm_lora_params = RKLLMLoraParam()
-            rkllm_lora_params.lora_adapter_name = ctypes.c_char_p((self.lora_model_name).encode('utf-8'))
-        
-        rkllm_infer_params = RKLLMInferParam()
-        ctypes.memset(ctypes.byref(rkllm_infer_params), 0, ctypes.sizeof(RKLLMInferParam))
-        rkllm_infer_params.mode = RKLLMInferMode.RKLLM_INFER_GENERATE
-        rkllm_infer_params.lora_params = ctypes.byref(rkllm_lora_params) if rkllm_lora_params else None
-
-        rkllm_input = RKLLMInput()
-        rkllm_input.input_mode = RKLLMInputMode.RKLLM_INPUT_PROMPT
-        rkllm_input.input_data.prompt_input = ctypes.c_char_p((PROMPT_TEXT_PREFIX + prompt + PROMPT_TEXT_POSTFIX).encode('utf-8'))
-        self.rkllm_run(self.handle, ctypes.byref(rkllm_input), ctypes.byref(rkllm_infer_params), None)
-        return
+            self.use_prompt_cache(prompt_cache_path)
+
+        # The adapter of --lora_model_path is applied to every run unless use_lora() selects another one.
+        if lora_model_path:
+            self.use_lora(LoraAdapter(DEFAULT_LORA_NAME, lora_model_path))
+
+    # A new handle with the given sampling parameters and the adapters in self.lora_adapters loaded.
+    def _init_handle(self, sampling):
+        rkllm_param = default_param(
+            self.model_path,
+            base_domain_id=self.base_domain_id,
+            max_context_len=self.max_context_len,
+            max_new_tokens=-1,
+            skip_special_token=True,
+            is_async=False,
+            **dict(sampling.values, **self.image_markers)
+        )
+        handle = RKLLMHandle(rkllm_param, callback)
+        for adapter in self.lora_adapters.values():
+            if handle.load_lora(adapter.path, adapter.name, adapter.scale) != 0:
+                handle.destroy()
+                raise RKLLMError(f"rkllm_load_lora failed for {adapter.path}")
+        return handle
+
+    def _reinit(self, sampling):
+        self.handle.destroy()
+        self.prompt_cache_path = None
+        self.handle = self._init_handle(sampling)
+        self.use_prompt_cache(self.default_prompt_cache_path)
+
+    # Switch the handle to other sampling parameters. The runtime only reads them in rkllm_init, so the handle is
+    # destroyed and initialized again, which loads the model file again; the prompt cache and adapters are loaded again
+    # as well. Raises RKLLMError if the new handle cannot be initialized; the old parameters are then restored.
+    def configure(self, sampling):
+        if sampling == self.sampling:
+            return
+        try:
+            self._reinit(sampling)
+        except RKLLMError:
+            self._reinit(self.sampling)
+            raise
+        self.sampling = sampling
+        self.reconfigurations += 1
+
+    def has_lora(self, adapter):
+        return self.lora_adapters.get(adapter.name) is adapter
+
+    # Apply adapter to the following runs (None runs the base model), loading it onto the handle first if needed.
+    # The runtime cannot unload an adapter: once max_lora_adapters are loaded, or when an adapter was replaced under the
+    # same name, the handle is initialized again with the most recently used adapters only.
+    # Raises RKLLMError if the adapter cannot be loaded.
+    def use_lora(self, adapter):
+        if adapter is None:
+            self.lora_adapter_name = None
+            return
+        if self.has_lora(adapter):
+            self.lora_adapters.move_to_end(adapter.name)
+            self.lora_adapter_name = adapter.name
+            return
+        self.lora_adapter_name = None
+        replaced = self.lora_adapters.pop(adapter.name, None) is not None
+        full = self.max_lora_adapters and len(self.lora_adapters) >= self.max_lora_adapters
+        if replaced or full:
+            while self.max_lora_adapters and len(self.lora_adapters) >= self.max_lora_adapters:
+                self.lora_adapters.popitem(last=False)
+                self.lora_evictions += 1
+            self._reinit(self.sampling)
+        if self.handle.load_lora(adapter.path, adapter.name, adapter.scale) != 0:
+            raise RKLLMError(f"rkllm_load_lora failed for {adapter.path}")
+        self.lora_adapters[adapter.name] = adapter
+        self.lora_adapter_name = adapter.name
+        self.lora_loads += 1
+
+    # Make the prompt cache at prompt_cache_path the one loaded on this handle (None releases it).
+    def use_prompt_cache(self, prompt_cache_path):
+        if prompt_cache_path == self.prompt_cache_path:
+            return True
+        if self.prompt_cache_path is not None:
+            self.handle.release_prompt_cache()
+            self.prompt_cache_path = None
+        if prompt_cache_path is None:
+            return True
+        if self.handle.load_prompt_cache(prompt_cache_path) != 0:
+            return False
+        self.prompt_cache_path = prompt_cache_path
+        return True
+
+    # With input_ids the prompt is passed to the runtime as token ids (RKLLM_INPUT_TOKEN) instead of text; with image (an
+    # ImageEmbedding) it is a multimodal input whose embedding is passed from its mapping.
+    # run_id is the id of the RunContext in run_contexts that receives the output.
+    def run(self, prompt, run_id=None, save_prompt_cache_path=None, input_ids=None, infer_mode=RKLLMInferMode.RKLLM_INFER_GENERATE,
+            image=None):
+        timer = RunTimer(run_metrics, len(input_ids) if input_ids is not None else None)
+        context = run_contexts.get(run_id)
+        if context is not None:
+            context.timer = timer
+        timer.start()
+        if image is not None:
+            ret = self.handle.run_async(prompt, run_id, None, infer_mode, self.lora_adapter_name, save_prompt_cache_path,
+                                        image.array, image.n_tokens)
+        else:
+            ret = self.handle.run_async(prompt, run_id, input_ids, infer_mode, self.lora_adapter_name, save_prompt_cache_path)
+        if ret != 0:
+            timer.finish(error=True)
+        return ret
+
+    def abort(self):
+        return self.handle.abort()
+
+    def is_running(self):
+        return self.handle.is_running()
 
     def release(self):
-        self.rkllm_destroy(self.handle)
+        self.handle.destroy()
+
+# Seconds to wait for the runtime to confirm an abort before the handle is handed to the next request anyway.
+ABORT_TIMEOUT = 10.0
+
+# One generation on an RKLLM instance. Iterating yields the output text as it is emitted and stops at the end of
+# the run, after max_new_tokens tokens or at the deadline; close() aborts the run if it is still going.
+class ModelRun(object):
+    def __init__(self, rkllm_model, prompt, max_new_tokens=-1, timeout=None, save_prompt_cache_path=None, input_ids=None,
+                 infer_mode=RKLLMInferMode.RKLLM_INFER_GENERATE, hidden_states=None, image=None):
+        self.rkllm_model = rkllm_model
+        self.max_new_tokens = max_new_tokens
+        self.start_time = time.monotonic()
+        self.first_token_time = None
+        self.end_time = None
+        self.deadline = None if timeout is None else self.start_time + timeout
+        self.finish_reason = None
+        self.closed = False
+        self.n_tokens = 0 # Tokens whose output was taken from the stream; the runtime may be ahead until it is aborted
+        self.stream_id, self.stream = open_token_stream()
+        self.stream.hidden_states = hidden_states
+        if rkllm_model.run(prompt, self.stream_id, save_prompt_cache_path, input_ids, infer_mode, image) != 0:
+            self.stream.put(LLMCallState.RKLLM_RUN_ERROR)
+
+    def __iter__(self):
+        return self.chunks(EVERY_TOKEN)
+
+    # Iterate over the output in chunks collected by flush_policy (see stream_writer.FlushPolicy).
+    def chunks(self, flush_policy):
+        pieces = []
+        first_piece_time = None
+        try:
+            while True:
+                now = time.monotonic()
+                remaining = None if self.deadline is None else self.deadline - now
+                if remaining is not None and remaining <= 0:
+                    self.finish_reason = "timeout"
+                    break
+                # With pieces collected, only wait as long as the policy lets them wait.
+                wait = remaining
+                if pieces:
+                    wait = flush_policy.wait(now - first_piece_time)
+                    if remaining is not None:
+                        wait = min(wait, remaining)
+                try:
+                    state, text, self.n_tokens = self.stream.get(wait)
+                except queue.Empty:
+                    if not pieces:
+                        self.finish_reason = "timeout"
+                        break
+                    yield "".join(pieces)
+                    pieces = []
+                    continue
+                if text:
+                    now = time.monotonic()
+                    if self.first_token_time is None:
+                        self.first_token_time = now
+                        yield text
+                    else:
+                        if not pieces:
+                            first_piece_time = now
+                        pieces.append(text)
+                        if flush_policy.full(len(pieces), now - first_piece_time):
+                            yield "".join(pieces)
+                            pieces = []
+                if state == LLMCallState.RKLLM_RUN_FINISH:
+                    self.finish_reason = "stop"
+                    break
+                if state == LLMCallState.RKLLM_RUN_ERROR:
+                    self.finish_reason = "error"
+                    break
+                if self.max_new_tokens > 0 and self.n_tokens >= self.max_new_tokens:
+                    self.finish_reason = "length"
+                    break
+            if pieces:
+                yield "".join(pieces)
+        finally:
+            self.close()
+
+    # A character split over several tokens can carry the count past max_new_tokens with its last piece.
+    @property
+    def completion_tokens(self):
+        if self.max_new_tokens > 0:
+            return min(self.n_tokens, self.max_new_tokens)
+        return self.n_tokens
+
+    # Prefill time (until the first token) and decode time and rate of the run, in the field names of llama.cpp.
+    def timings(self):
+        end_time = self.end_time or time.monotonic()
+        first_token_time = self.first_token_time or end_time
+        decode_seconds = end_time - first_token_time
+        return {
+            "prompt_ms": round((first_token_time - self.start_time) * 1000, 1),
+            "predicted_n": self.completion_tokens,
+            "predicted_ms": round(decode_seconds * 1000, 1),
+            "predicted_per_second": round((self.completion_tokens - 1) / decode_seconds, 2) if decode_seconds > 0 else None,
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.end_time = time.monotonic()
+        # The consumer went away (client disconnect, deadline or token limit): stop decoding right away.
+        if not self.stream.finished():
+            self.rkllm_model.abort()
+            if not self.stream.wait_finished(ABORT_TIMEOUT):
+                print("Warning: RKLLM run did not stop within {}s after abort.".format(ABORT_TIMEOUT))
+                sys.stdout.flush()
+        close_token_stream(self.stream_id)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--rkllm_model_path', type=str, required=True, help='Absolute path of the converted RKLLM model on the Linux board;')
     parser.add_argument('--target_platform', type=str, required=True, help='Target platform: e.g., rk3588/rk3576;')
-    parser.add_argument('--lora_model_path', type=str, help='Absolute path of the lora_model on the Linux board;')
+    parser.add_argument('--lora_model_path', type=str, help='Absolute path of the lora_model on the Linux board; registered as the adapter "default" and applied to requests that select no adapter;')
+    parser.add_argument('--lora_adapters', type=str, help='JSON file mapping LoRA adapter names to their path (or {"path": ..., "scale": ...}); requests select one with "lora_adapter";')
+    parser.add_argument('--default_lora', type=str, help='Adapter applied to requests that select none (default: "default" with --lora_model_path, otherwise none);')
+    parser.add_argument('--lora_dir', type=str, help='Directory of the adapter files POST /rkllm_lora may register; without it, adapters can only be registered at startup;')
+    parser.add_argument('--max_lora_adapters', type=int, default=4, help='Adapters kept loaded on each handle; beyond that the least recently used ones are dropped by initializing the handle again (0 = unlimited);')
     parser.add_argument('--prompt_cache_path', type=str, help='Absolute path of the prompt_cache file on the Linux board;')
+    parser.add_argument('--num_instances', type=int, default=1, help='Number of RKLLM instances serving requests in parallel;')
+    parser.add_argument('--base_domain_ids', type=str, help='Comma-separated base_domain_id for each instance, e.g., 0,1,2 (default: the instance index);')
+    parser.add_argument('--schedule', type=str, default=SCHEDULE_FIFO, choices=[SCHEDULE_FIFO, SCHEDULE_PRIORITY], help='Order in which queued requests get an instance;')
+    parser.add_argument('--queue_timeout', type=float, default=60.0, help='Seconds a request may wait for a free instance before the server answers 503;')
+    parser.add_argument('--lanes', type=str, help='JSON file listing the priority lanes ({"name", "rank", "max_queue", "slo_seconds", "preemptible"}); default: interactive and batch;')
+    parser.add_argument('--api_keys', type=str, help='JSON file mapping API keys to lanes; requests without a listed key are put in the lowest lane;')
+    parser.add_argument('--request_timeout', type=float, default=300.0, help='Seconds after which a running generation is aborted;')
+    parser.add_argument('--max_new_tokens', type=int, default=-1, help='Abort a generation after this many tokens (-1 means no limit); requests may ask for fewer with max_tokens;')
+    parser.add_argument('--max_context_len', type=int, default=512, help='Context length of every RKLLM handle;')
+    parser.add_argument('--reserve_tokens', type=int, default=128, help='Context tokens kept free for the reply of a request without a token limit; the oldest history turns are dropped to make room;')
+    parser.add_argument('--summarize_history', action='store_true', help='Replace the session turns dropped from the context with a summary generated by the model;')
+    parser.add_argument('--history_summary_tokens', type=int, default=96, help='Token limit of a --summarize_history summary;')
+    parser.add_argument('--top_k', type=int, default=1, help='Default top_k; 1 means greedy decoding;')
+    parser.add_argument('--top_p', type=float, default=0.9, help='Default top_p;')
+    parser.add_argument('--temperature', type=float, default=0.8, help='Default temperature;')
+    parser.add_argument('--repeat_penalty', type=float, default=1.1, help='Default repeat_penalty;')
+    parser.add_argument('--frequency_penalty', type=float, default=0.0, help='Default frequency_penalty;')
+    parser.add_argument('--presence_penalty', type=float, default=0.0, help='Default presence_penalty;')
+    parser.add_argument('--request_sampling', action='store_true', help='Apply the sampling parameters of requests; an instance whose handle uses other parameters is re-initialized, which loads the model again;')
+    parser.add_argument('--model_config', type=str, help='Path of model_config.json providing the prompt template of --model_family;')
+    parser.add_argument('--model_family', type=str, help='Family in --model_config whose PROMPT_TEXT_PREFIX/PROMPT_TEXT_POSTFIX are used;')
+    parser.add_argument('--model_config_poll', type=float, default=2.0, help='Seconds between checks of --model_config for changes, which are applied without a restart (0 = never);')
+    parser.add_argument('--no_coalesce', action='store_true', help='Run every /rkllm_chat request on its own instead of attaching identical concurrent requests to one generation;')
+    parser.add_argument('--response_cache_ttl', type=float, default=0, help='Seconds a finished /rkllm_chat response is replayed to identical requests (0 = no response cache);')
+    parser.add_argument('--response_cache_max_mb', type=float, default=16, help='Size limit of the cached response text in MiB;')
+    parser.add_argument('--warm_prompts', type=str, help='JSON lines file of /rkllm_chat requests ({"messages": [...]}) generated at startup and again before their cached responses expire;')
+    parser.add_argument('--freq_mode', type=str, default=FREQ_MODE_GOVERNOR, choices=FREQ_MODES, help='Clock control: governor boosts the NPU/CPU/DDR clocks while requests are queued or running, fixed runs fix_freq_[platform].sh once, none leaves the clocks alone;')
+    parser.add_argument('--sysfs_root', type=str, default='/', help='Directory the sysfs paths of the governor are relative to;')
+    parser.add_argument('--governor_idle_seconds', type=float, default=10.0, help='Seconds without requests after which the governor gives the clocks back to the kernel governors;')
+    parser.add_argument('--governor_sample_interval', type=float, default=1.0, help='Seconds between samples of the current frequencies and thermal zones;')
+    parser.add_argument('--governor_cpuidle', action='store_true', help='Also disable the deep CPU idle state (state1) while the clocks are boosted;')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Address to listen on;')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on;')
+    parser.add_argument('--prompt_cache_dir', type=str, help='Directory where a prompt cache is generated and reused for every distinct prompt prefix;')
+    parser.add_argument('--prompt_cache_max_mb', type=int, default=1024, help='Size limit of --prompt_cache_dir in MB, least recently used caches are deleted first;')
+    parser.add_argument('--prompt_cache_max_files', type=int, default=64, help='Maximum number of cache files kept in --prompt_cache_dir;')
+    parser.add_argument('--tokenizer_path', type=str, help='Hugging Face tokenizer of the model (needs transformers); prompts are then passed as token ids and prompt_tokens is reported;')
+    parser.add_argument('--stream_flush_ms', type=float, default=0, help='Milliseconds a streamed piece of text may wait for more before its chunk is sent (0 = send what has arrived whenever the client is ready);')
+    parser.add_argument('--stream_flush_tokens', type=int, default=0, help='Send a streamed chunk once it holds this many pieces of text (0 = no limit, 1 = one chunk per token);')
+    parser.add_argument('--no_token_echo', action='store_true', help='Do not print the generated tokens to the console;')
+    parser.add_argument('--embedding_pooling', type=str, default=POOLING_MEAN, choices=POOLING_MODES, help='Default pooling of the hidden states for /v1/embeddings;')
+    parser.add_argument('--batch_priority', type=int, default=10, help='Priority of /rkllm_batch items when --schedule priority is used (lower runs first);')
+    parser.add_argument('--image_cache_dir', type=str, help='Directory of the image embedding cache; enables image embeddings in /rkllm_chat and /rkllm_batch (multimodal models);')
+    parser.add_argument('--image_cache_max_mb', type=int, default=1024, help='Size limit of --image_cache_dir in MB, least recently used embeddings are deleted first;')
+    parser.add_argument('--image_cache_max_files', type=int, default=4096, help='Maximum number of embeddings kept in --image_cache_dir;')
+    parser.add_argument('--image_embed_dim', type=int, default=0, help='Values per image token of the model (e.g., 2304); checked on upload and used to size raw float32 uploads (0 = take it from each upload);')
+    parser.add_argument('--img_start', type=str, default='<image>', help='Text that marks the image in a multimodal prompt; prepended to a message with an image that does not contain it;')
+    parser.add_argument('--img_end', type=str, default='</image>\n', help='Text after the image tokens of a multimodal prompt;')
+    parser.add_argument('--img_content', type=str, default='<unk>', help='Placeholder token of the image content;')
+    parser.add_argument('--session_dir', type=str, help='Directory for the prompt caches of chat sessions; without it every session turn prefills the whole history;')
+    parser.add_argument('--session_idle_timeout', type=float, default=600.0, help='Seconds after which an idle session is deleted;')
+    parser.add_argument('--session_max_mb', type=int, default=1024, help='Size limit of the session prompt caches in MB, least recently used sessions are deleted first;')
+    parser.add_argument('--max_sessions', type=int, default=256, help='Maximum number of sessions kept at the same time;')
     args = parser.parse_args()
 
     if not os.path.exists(args.rkllm_model_path):
@@ -315,140 +443,1214 @@ if __name__ == "__main__":
             sys.stdout.flush()
             exit()
 
+    lora_registry = LoraRegistry()
+    try:
+        if args.lora_adapters:
+            for adapter in LoraRegistry.read_config(args.lora_adapters):
+                lora_registry.register(adapter)
+        if args.lora_model_path:
+            lora_registry.register(LoraAdapter(DEFAULT_LORA_NAME, args.lora_model_path))
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        print("Error: Invalid LoRA adapters: {}.".format(e))
+        sys.stdout.flush()
+        exit()
+    default_lora = args.default_lora
+    if default_lora is None and args.lora_model_path:
+        default_lora = DEFAULT_LORA_NAME
+    if default_lora and lora_registry.get(default_lora) is None:
+        print("Error: --default_lora {} is not a registered adapter: {}.".format(default_lora, "/".join(lora_registry.names())))
+        sys.stdout.flush()
+        exit()
+
     if args.prompt_cache_path:
         if not os.path.exists(args.prompt_cache_path):
             print("Error: Please provide the correct prompt_cache_file path, and advise it is the absolute path on the board.")
             sys.stdout.flush()
             exit()
 
-    # Fix frequency
-    command = "sudo bash fix_freq_{}.sh".format(args.target_platform)
-    subprocess.run(command, shell=True)
+    if args.prompt_cache_path and args.prompt_cache_dir:
+        print("Error: --prompt_cache_path and --prompt_cache_dir cannot be used together.")
+        sys.stdout.flush()
+        exit()
+
+    # Prompt template: the built-in one, or the family template from model_config.json, compiled once and recompiled
+    # when the file changes.
+    builtin_template = PromptTemplate(PROMPT_TEXT_PREFIX, PROMPT_TEXT_POSTFIX, PROMPT_TEXT_TURN_SEPARATOR)
+    template_store = None
+    if args.model_config:
+        template_store = TemplateStore(args.model_config, args.model_config_poll, (args.model_family,),
+                                       prefix=PROMPT_TEXT_PREFIX, postfix=PROMPT_TEXT_POSTFIX)
+        if template_store.family_template(args.model_family) is None:
+            print("Error: Please specify a --model_family defined in {}: {}.".format(args.model_config, "/".join(template_store.family_names())))
+            sys.stdout.flush()
+            exit()
+
+    # The template of a request; taken once per request so that a reload never mixes two templates in one prompt.
+    def prompt_template():
+        if template_store is None:
+            return builtin_template
+        return template_store.family_template(args.model_family)
+
+    try:
+        lanes = {lane.name: lane for lane in (read_lanes(args.lanes) if args.lanes else default_lanes())}
+        api_keys = {}
+        if args.api_keys:
+            with open(args.api_keys, "r") as api_keys_file:
+                api_keys = json.load(api_keys_file)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("Error: Invalid --lanes or --api_keys file: {}.".format(e))
+        sys.stdout.flush()
+        exit()
+    unknown_lanes = sorted(set(api_keys.values()) - set(lanes))
+    if not lanes or unknown_lanes:
+        print("Error: --api_keys refers to undefined lanes: {}.".format("/".join(unknown_lanes)) if unknown_lanes else "Error: No lanes defined.")
+        sys.stdout.flush()
+        exit()
+    # Chat requests default to the interactive lane, batch work to the batch lane; without them, the best and worst rank.
+    interactive_lane = lanes.get(LANE_INTERACTIVE) or min(lanes.values(), key=lambda lane: lane.rank)
+    batch_lane = lanes.get(LANE_BATCH) or max(lanes.values(), key=lambda lane: lane.rank)
+
+    if args.num_instances < 1:
+        print("Error: --num_instances must be at least 1.")
+        sys.stdout.flush()
+        exit()
+
+    if args.base_domain_ids:
+        base_domain_ids = [int(domain_id) for domain_id in args.base_domain_ids.split(",")]
+        if len(base_domain_ids) != args.num_instances:
+            print("Error: --base_domain_ids must list one domain id per instance.")
+            sys.stdout.flush()
+            exit()
+    else:
+        base_domain_ids = list(range(args.num_instances))
+
+    try:
+        default_sampling = SamplingParams(top_k=args.top_k, top_p=args.top_p, temperature=args.temperature, repeat_penalty=args.repeat_penalty,
+                                          frequency_penalty=args.frequency_penalty, presence_penalty=args.presence_penalty)
+    except ValueError as e:
+        print("Error: Invalid sampling parameters: {}.".format(e))
+        sys.stdout.flush()
+        exit()
+
+    tokenizer = None
+    if args.tokenizer_path:
+        try:
+            from transformers import AutoTokenizer
+        except ImportError:
+            print("Error: --tokenizer_path needs the transformers package: pip install transformers.")
+            sys.stdout.flush()
+            exit()
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, trust_remote_code=True)
+
+    # Clock control: the governor raises the clocks while there is work and relaxes them when the server is idle;
+    # --freq_mode fixed pins them once with the fix_freq script as before. A governor that cannot write any clock
+    # (e.g. without root) falls back to the script, which runs with sudo.
+    governor = None
+    if args.freq_mode == FREQ_MODE_GOVERNOR:
+        governor = FrequencyGovernor(args.target_platform, args.sysfs_root, args.governor_idle_seconds, args.governor_sample_interval,
+                                     args.governor_cpuidle)
+        if not governor.controls_clocks():
+            print("Warning: the frequency governor cannot write any clock of {}, falling back to --freq_mode fixed.".format(args.target_platform))
+            sys.stdout.flush()
+            governor.close()
+            governor = None
+    if args.freq_mode == FREQ_MODE_FIXED or (args.freq_mode == FREQ_MODE_GOVERNOR and governor is None):
+        command = "sudo bash fix_freq_{}.sh".format(args.target_platform)
+        subprocess.run(command, shell=True)
 
     # Set resource limit
     resource.setrlimit(resource.RLIMIT_NOFILE, (102400, 102400))
 
+    TOKEN_ECHO = not args.no_token_echo
+
     # Initialize RKLLM model
     print("=========init....===========")
     sys.stdout.flush()
     model_path = args.rkllm_model_path
-    rkllm_model = RKLLM(model_path, args.lora_model_path, args.prompt_cache_path)
+    load_start = time.monotonic()
+    # The runtime only reads the image markers in rkllm_init, so they are set on every handle of a multimodal server.
+    image_markers = None
+    if args.image_cache_dir:
+        image_markers = {"img_start": args.img_start, "img_end": args.img_end, "img_content": args.img_content}
+    rkllm_models = [RKLLM(model_path, None, args.prompt_cache_path, domain_id, default_sampling, args.max_context_len, args.max_lora_adapters,
+                          image_markers)
+                    for domain_id in base_domain_ids]
+    # Load the registered adapters onto every handle once; later ones are loaded when a request first selects them.
+    preload_lora = lora_registry.names()
+    if args.max_lora_adapters > 0:
+        preload_lora = preload_lora[:args.max_lora_adapters]
+    for rkllm_model in rkllm_models:
+        for name in preload_lora:
+            rkllm_model.use_lora(lora_registry.get(name))
+    model_load_seconds = time.monotonic() - load_start
+    rkllm_pool = WorkerPool(rkllm_models, args.schedule, governor=governor)
     print("RKLLM Model has been initialized successfully！")
     print("==============================")
     sys.stdout.flush()
 
+    prompt_cache_store = None
+    if args.prompt_cache_dir:
+        prompt_cache_store = PromptCacheStore(args.prompt_cache_dir, args.prompt_cache_max_mb * 2**20, args.prompt_cache_max_files)
+        base_prompt_cache_key = PromptCacheStore.model_key(model_path)
+
+    # The KV cache of a prefix depends on the adapter applied while it was computed.
+    def prompt_cache_model_key(rkllm_model):
+        adapter = rkllm_model.lora_adapters.get(rkllm_model.lora_adapter_name) if rkllm_model.lora_adapter_name else None
+        if adapter is None:
+            return base_prompt_cache_key
+        return base_prompt_cache_key + ":lora:" + adapter.cache_key()
+
+    image_cache = None
+    if args.image_cache_dir:
+        image_cache = ImageEmbeddingCache(args.image_cache_dir, args.image_cache_max_mb * 2**20, args.image_cache_max_files, args.image_embed_dim)
+
+    # Streamed responses collect the pieces of text that arrive close together into one chunk.
+    flush_policy = FlushPolicy(args.stream_flush_ms / 1000.0, args.stream_flush_tokens)
+
+    session_store = SessionStore(args.session_dir, args.session_idle_timeout, args.session_max_mb * 2**20, args.max_sessions)
+
+    # Prompts are kept within --max_context_len minus the tokens reserved for the reply; token counts come from the
+    # tokenizer if there is one.
+    token_counter = TokenCounter(tokenizer)
+    context_window = ContextWindow(args.max_context_len, args.reserve_tokens)
+
+    # Greedy generation (top_k=1) gives identical output for identical requests, so they can share one run.
+    coalescer = None
+    if not args.no_coalesce:
+        coalescer = RequestCoalescer(args.response_cache_ttl, int(args.response_cache_max_mb * 2**20))
+
+    run_metrics.num_instances = len(rkllm_models)
+    metrics_registry.gauge_func("rkllm_instances", "RKLLM handles in the pool.", lambda: rkllm_pool.stats()["instances"])
+    metrics_registry.gauge_func("rkllm_active_handles", "RKLLM handles serving a request.",
+                                lambda: rkllm_pool.stats()["instances"] - rkllm_pool.stats()["idle_instances"])
+    metrics_registry.gauge_func("rkllm_queue_depth", "Requests waiting for a free RKLLM handle.", lambda: rkllm_pool.stats()["queue_depth"])
+    metrics_registry.counter_func("rkllm_queue_timeouts_total", "Requests that gave up waiting for a handle.", lambda: rkllm_pool.stats()["timeouts"])
+    metrics_registry.counter_func("rkllm_admission_rejected_total", "Requests rejected because their lane was full or their predicted wait exceeded its SLO.",
+                                  lambda: rkllm_pool.stats()["rejected"])
+    metrics_registry.counter_func("rkllm_preemptions_total", "Preemptible generations asked to yield to a request of a higher lane.",
+                                  lambda: rkllm_pool.stats()["preemptions"])
+    metrics_registry.gauge_func("rkllm_model_load_seconds", "Seconds it took to initialize the RKLLM handles.", lambda: model_load_seconds)
+    metrics_registry.gauge_func("rkllm_active_runs", "Runs whose callbacks are being delivered.", lambda: len(run_contexts))
+    metrics_registry.counter_func("rkllm_handle_reconfigurations_total", "Handles initialized again for other sampling parameters.",
+                                  lambda: sum(rkllm_model.reconfigurations for rkllm_model in rkllm_models))
+    metrics_registry.counter_func("rkllm_lora_loads_total", "LoRA adapters loaded onto a handle.",
+                                  lambda: sum(rkllm_model.lora_loads for rkllm_model in rkllm_models))
+    metrics_registry.counter_func("rkllm_lora_evictions_total", "LoRA adapters dropped from a handle to stay within --max_lora_adapters.",
+                                  lambda: sum(rkllm_model.lora_evictions for rkllm_model in rkllm_models))
+    if governor is not None:
+        metrics_registry.gauge_func("rkllm_governor_boosted", "1 while the governor holds the clocks at their maximum.",
+                                    lambda: int(governor.stats()["boosted"]))
+        metrics_registry.counter_func("rkllm_governor_boosts_total", "Times the governor raised the clocks for new work.",
+                                      lambda: governor.stats()["boosts"])
+        metrics_registry.counter_func("rkllm_governor_boosted_seconds_total", "Seconds the clocks were held at their maximum.",
+                                      lambda: governor.stats()["boosted_seconds"])
+        metrics_registry.labeled_gauge_func("rkllm_cur_freq", "Current frequency of each clock domain as reported by sysfs (kHz for CPUs, Hz otherwise).",
+                                            "domain", lambda: governor.stats()["cur_freq"])
+        metrics_registry.labeled_gauge_func("rkllm_thermal_zone_celsius", "Temperature of each thermal zone.",
+                                            "zone", lambda: governor.stats()["temperature_c"])
+    metrics_registry.gauge_func("rkllm_sessions", "Open chat sessions.", lambda: session_store.stats()["sessions"])
+    metrics_registry.counter_func("rkllm_session_trimmed_turns_total", "Session turns dropped from the prompt to stay within the context window.",
+                                  lambda: session_store.stats()["trimmed_turns"])
+    if coalescer is not None:
+        metrics_registry.counter_func("rkllm_coalesced_requests_total", "Requests that attached to the generation of an identical request.",
+                                      lambda: coalescer.stats()["coalesced"])
+        metrics_registry.counter_func("rkllm_response_cache_hits_total", "Requests answered from the response cache.",
+                                      lambda: coalescer.stats()["cache_hits"])
+        metrics_registry.counter_func("rkllm_response_cache_misses_total", "Coalescable requests that had to run a generation.",
+                                      lambda: coalescer.stats()["generations"])
+        metrics_registry.counter_func("rkllm_response_cache_evictions_total", "Cached responses dropped to stay within the size limit.",
+                                      lambda: coalescer.stats()["cache_evictions"])
+        metrics_registry.gauge_func("rkllm_response_cache_bytes", "Size of the cached response text.",
+                                    lambda: coalescer.cache_bytes)
+    if image_cache is not None:
+        metrics_registry.counter_func("rkllm_image_cache_hits_total", "Image embeddings found in the cache by their hash.",
+                                      lambda: image_cache.stats()["hits"])
+        metrics_registry.counter_func("rkllm_image_cache_misses_total", "Image hashes that were not in the cache.",
+                                      lambda: image_cache.stats()["misses"])
+        metrics_registry.counter_func("rkllm_image_cache_stores_total", "Image embeddings uploaded and stored in the cache.",
+                                      lambda: image_cache.stats()["stores"])
+        metrics_registry.counter_func("rkllm_image_cache_evictions_total", "Image embeddings deleted to stay within the limits.",
+                                      lambda: image_cache.stats()["evictions"])
+    if prompt_cache_store is not None:
+        metrics_registry.counter_func("rkllm_prompt_cache_hits_total", "Requests whose prompt prefix was restored from a prompt cache.",
+                                      lambda: prompt_cache_store.stats()["hits"])
+        metrics_registry.counter_func("rkllm_prompt_cache_misses_total", "Requests that had to generate a prompt cache.",
+                                      lambda: prompt_cache_store.stats()["misses"])
+        metrics_registry.counter_func("rkllm_prompt_cache_evictions_total", "Prompt cache files deleted to stay within the limits.",
+                                      lambda: prompt_cache_store.stats()["evictions"])
+
+    # Prefill the prefix on its own and let the runtime save its KV cache to path; the first generated token ends the run.
+    def save_prompt_cache(rkllm_model, prefix, path):
+        rkllm_model.use_prompt_cache(None)
+        for _ in ModelRun(rkllm_model, prefix, 1, args.request_timeout, save_prompt_cache_path=path):
+            pass
+
+    # Build the runtime input for one user message. With a prompt cache for the prefix loaded on the handle, only
+    # the message and postfix need to be prefilled. A message with an image is always prefilled as a whole.
+    def build_prompt_input(rkllm_model, template, system_prompt, content, image=None):
+        prefix = template.prefix(system_prompt)
+        body = template.body(content)
+        if image is not None:
+            rkllm_model.use_prompt_cache(None)
+            return prefix + body
+        if prompt_cache_store is None:
+            return prefix + body
+        path = prompt_cache_store.get_or_create(prompt_cache_model_key(rkllm_model), prefix,
+                                                lambda path: save_prompt_cache(rkllm_model, prefix, path))
+        if path is not None and rkllm_model.use_prompt_cache(path):
+            return body
+        rkllm_model.use_prompt_cache(None)
+        return prefix + body
+
+    # Prepare one turn of a request. Returns the runtime input, the full prompt text of the turn and the path its prompt
+    # cache is saved to. Within a session, the history up to the last turn is restored from the session's prompt cache.
+    def prepare_turn(rkllm_model, template, session, system_prompt, content, image=None, max_new_tokens=-1):
+        if session is None:
+            return build_prompt_input(rkllm_model, template, system_prompt, content, image), None, None
+        fit_session(rkllm_model, template, session, content, max_new_tokens)
+        save_path = session_store.next_cache_path(session)
+        if session.context_text is None:
+            full_text = template.render(content, session.system_prompt)
+            return build_prompt_input(rkllm_model, template, session.system_prompt, content), full_text, save_path
+        full_text = session.context_text + template.body(content)
+        if session.cache_path and rkllm_model.use_prompt_cache(session.cache_path):
+            return full_text[len(session.cached_text):], full_text, save_path
+        rkllm_model.use_prompt_cache(None)
+        return full_text, full_text, save_path
+
+    # Summarize the turns dropped from a session on the instance of the request; the previous summary is kept if the
+    # run fails.
+    def summarize_turns(rkllm_model, summary, turns):
+        template = prompt_template()
+        rkllm_model.use_prompt_cache(None)
+        model_run = ModelRun(rkllm_model, template.render(summary_request(summary, turns)), args.history_summary_tokens,
+                             args.request_timeout)
+        new_summary = "".join(model_run).strip()
+        if model_run.finish_reason not in ("stop", "length") or not new_summary:
+            return summary
+        return new_summary
+
+    if args.summarize_history:
+        context_window.summarizer = summarize_turns
+
+    # Make room for the next turn of a session: when its history, the new message and the reserved reply tokens do not
+    # fit into the context, the oldest turns are dropped (and summarized if a summarizer is set).
+    def fit_session(rkllm_model, template, session, content, max_new_tokens):
+        if not session.history:
+            return
+        head = template.prefix(session.system_prompt) + summary_text(session.summary)
+        fixed_tokens = token_counter.count(head) + token_counter.count(template.body(content))
+        dropped = context_window.turns_to_drop(fixed_tokens, [turn.tokens for turn in session.history], max_new_tokens)
+        if not dropped:
+            return
+        summary = session.summary
+        if context_window.summarizer is not None:
+            summary = context_window.summarizer(rkllm_model, summary, session.history[:dropped])
+        session_store.trim(session, dropped, summary, template.prefix(session.system_prompt) + summary_text(summary))
+
+    # The finished turn of a session with its token count: the message and postfix, the generated tokens and the separator.
+    def session_turn(template, content, reply, model_run):
+        body = template.body(content)
+        tokens = token_counter.count(body) + model_run.completion_tokens + token_counter.count(template.separator)
+        return Turn(content, reply, body + reply + template.separator, tokens)
+
+    # Tokenize the runtime input built by build_prompt_input on the server side, reusing the prefix and postfix ids
+    # cached by the template. Returns the token ids to run (without the prefix when it was restored from a prompt cache)
+    # and the token count of the full prompt, or (None, None) without a tokenizer.
+    def encode_prompt(template, system_prompt, content, input_prompt):
+        if tokenizer is None:
+            return None, None
+        prefix_ids, body_ids = template.encode(tokenizer, content, system_prompt)
+        prompt_tokens = len(prefix_ids) + len(body_ids)
+        if len(input_prompt) > len(content) + len(template.postfix):
+            return prefix_ids + body_ids, prompt_tokens
+        return body_ids, prompt_tokens
+
+    # System messages replace the system prompt of the template; every other message is answered independently.
+    def split_messages(template, messages):
+        system_prompt = template.system_prompt
+        for message in messages:
+            if message.get('role') == 'system':
+                system_prompt = message['content']
+        return system_prompt, [message for message in messages if message.get('role') != 'system']
+
+    # Resolve the image of a request entry (a user message or batch item, whose text is under text_key): "image_hash"
+    # names an embedding in the image cache, "image_embed" carries one (base64 of a .npy file, or of raw float32 values
+    # with "n_image_tokens") that is stored in the cache first. Returns a copy of the entry with the ImageEmbedding under
+    # "image" and --img_start in its text, or the entry itself if it has no image. Raises ValueError on an invalid
+    # embedding and UnknownImage for a hash that is not cached.
+    def attach_image(entry, text_key='content'):
+        if entry.get('image_hash') is None and entry.get('image_embed') is None:
+            return entry
+        if image_cache is None:
+            raise ValueError("Image embeddings need a server started with --image_cache_dir")
+        if entry.get('image_embed') is not None:
+            try:
+                image = image_cache.put(base64.b64decode(entry['image_embed'], validate=True), entry.get('n_image_tokens'))
+            except (binascii.Error, TypeError):
+                raise ValueError("image_embed must be base64")
+        else:
+            image = image_cache.get(entry['image_hash'])
+            if image is None:
+                raise UnknownImage(entry['image_hash'])
+        text = entry.get(text_key) or ""
+        if args.img_start not in text:
+            text = args.img_start + text
+        entry = dict(entry, image=image)
+        entry.pop('image_embed', None)
+        entry[text_key] = text
+        return entry
+
+    def unknown_image_response(e):
+        return jsonify({'status': 'error', 'message': 'Unknown image_hash {}: upload the embedding to /rkllm_image first.'.format(e.args[0])}), 404
+
+    # The prompt tokens of an image, in the unit of request_cost.
+    def image_chars(entry):
+        image = entry.get('image')
+        return image.n_tokens * CHARS_PER_TOKEN if image is not None else 0
+
+    # The adapter selected by name: None selects --default_lora, "" the base model. Raises ValueError for an unknown name.
+    def select_lora(name):
+        if name is None:
+            name = default_lora
+        if not name:
+            return None
+        adapter = lora_registry.get(name)
+        if adapter is None:
+            raise ValueError("Unknown lora_adapter: {}".format(name))
+        return adapter
+
+    # The sampling parameters, token limit and LoRA adapter of a request: with --request_sampling the sampling fields of
+    # the request override the defaults, max_tokens (or max_completion_tokens) can only lower --max_new_tokens, and
+    # lora_adapter (or lora_name if given) selects the adapter. Raises ValueError on an invalid value.
+    def request_options(data, lora_name=None):
+        lora_adapter = select_lora(data.get('lora_adapter') if lora_name is None else lora_name)
+        sampling = default_sampling.with_request(data) if args.request_sampling else default_sampling
+        if has_request_context():
+            g.sampling = sampling
+        max_tokens = data.get('max_completion_tokens', data.get('max_tokens'))
+        max_new_tokens = args.max_new_tokens
+        if max_tokens is not None:
+            try:
+                max_tokens = int(max_tokens)
+            except (TypeError, ValueError):
+                raise ValueError("max_tokens must be an integer")
+            if max_tokens < 1:
+                raise ValueError("max_tokens must be at least 1")
+            max_new_tokens = max_tokens if max_new_tokens <= 0 else min(max_tokens, max_new_tokens)
+        return sampling, max_new_tokens, lora_adapter
+
+    # The "priority" of a request body, by which --schedule priority orders the queue. Raises ValueError.
+    def request_priority(data):
+        try:
+            return int(data.get('priority', 0))
+        except (TypeError, ValueError):
+            raise ValueError("priority must be an integer")
+
+    # How well an instance is set up for a request: re-initializing a handle for other sampling parameters costs more
+    # than loading an adapter.
+    def setup_score(rkllm_model, sampling, lora_adapter):
+        score = 2 if rkllm_model.sampling == sampling else 0
+        if lora_adapter is None or rkllm_model.has_lora(lora_adapter):
+            score += 1
+        return score
+
+    # Set up an acquired instance for a request: its sampling parameters and adapter. Raises RKLLMError on failure.
+    def setup_model(rkllm_model, sampling, lora_adapter):
+        rkllm_model.configure(sampling)
+        rkllm_model.use_lora(lora_adapter)
+
+    # The API key of a request, from X-API-Key or Authorization: Bearer; None if there is none.
+    def request_api_key():
+        key = request.headers.get('X-API-Key')
+        authorization = request.headers.get('Authorization', "")
+        if key is None and authorization.startswith("Bearer "):
+            key = authorization[len("Bearer "):].strip()
+        return key
+
+    # Response to a request that changes the server without an API key listed in --api_keys; None if it may go ahead.
+    def unauthorized_response():
+        if api_keys and request_api_key() not in api_keys:
+            return jsonify({'status': 'error', 'message': 'A valid API key is required!'}), 401
+        return None
+
+    # The lane of a request. An API key (Authorization: Bearer or X-API-Key) listed in --api_keys fixes the lane; with
+    # --api_keys, requests without a listed key get the lowest lane. The X-Priority-Class header can choose another
+    # lane, but never one ranked above that of the key. Raises ValueError for an unknown lane.
+    def request_lane(default_lane):
+        key = request_api_key()
+        key_lane = None
+        if api_keys:
+            key_lane = lanes.get(api_keys.get(key)) or max(lanes.values(), key=lambda lane: lane.rank)
+        lane = key_lane or default_lane
+        requested = request.headers.get('X-Priority-Class')
+        if requested:
+            if requested not in lanes:
+                raise ValueError("Unknown priority class: {}".format(requested))
+            if key_lane is None or lanes[requested].rank >= key_lane.rank:
+                lane = lanes[requested]
+        return lane
+
+    # A response to a generation request reports the sampling parameters it was run with, which are the defaults unless
+    # --request_sampling is set.
+    @app.after_request
+    def report_sampling(response):
+        sampling = g.get('sampling')
+        if sampling is not None:
+            response.headers['X-RKLLM-Sampling'] = json.dumps(sampling.values, separators=(',', ':'))
+        return response
+
+    # Response to a request rejected by admission control.
+    def rejected_response(e):
+        return jsonify({'status': 'error', 'message': '{}. Maybe you can try again later.'.format(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+    # Take an instance for a request, preferring one whose handle already uses its sampling parameters and has its
+    # adapter loaded; otherwise the instance is set up for it. Raises PoolTimeout, AdmissionRejected, or RKLLMError if
+    # the handle could not be set up.
+    def acquire_model(priority, sampling, lora_adapter, lane, cost):
+        rkllm_model = rkllm_pool.acquire(timeout=args.queue_timeout, priority=priority,
+                                         match=lambda rkllm_model: setup_score(rkllm_model, sampling, lora_adapter), lane=lane, cost=cost)
+        try:
+            setup_model(rkllm_model, sampling, lora_adapter)
+        except RKLLMError:
+            rkllm_pool.release(rkllm_model)
+            raise
+        return rkllm_model
+
+    # Report the state of the instance pool: queue depth, idle instances and wait times.
+    @app.route('/rkllm_status', methods=['GET'])
+    def pool_status():
+        status = rkllm_pool.stats()
+        if prompt_cache_store is not None:
+            status["prompt_cache"] = prompt_cache_store.stats()
+        if image_cache is not None:
+            status["image_cache"] = image_cache.stats()
+        status["sessions"] = session_store.stats()
+        status["request_sampling"] = args.request_sampling
+        status["lanes"] = [lane.describe() for lane in sorted(lanes.values(), key=lambda lane: lane.rank)]
+        status["sampling"] = [dict(rkllm_model.sampling.values) for rkllm_model in rkllm_models]
+        status["lora_adapters"] = [list(rkllm_model.lora_adapters) for rkllm_model in rkllm_models]
+        status["stream_flush"] = flush_policy.describe()
+        if governor is not None:
+            status["governor"] = governor.stats()
+        if coalescer is not None:
+            status["coalescer"] = coalescer.stats()
+        return jsonify(status), 200
+
+    # Prometheus metrics of the runtime, the instance pool and the caches.
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(metrics_registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+    # Run the answers to user_messages on rkllm_model for every request subscribed to generation, then release the
+    # instance. Stops early once all of them went away.
+    def produce_chat(rkllm_model, generation, template, system_prompt, user_messages, max_new_tokens):
+        try:
+            for index, message in enumerate(user_messages):
+                input_prompt = build_prompt_input(rkllm_model, template, system_prompt, message['content'], message.get('image'))
+                model_run = ModelRun(rkllm_model, input_prompt, max_new_tokens, args.request_timeout, image=message.get('image'))
+                try:
+                    for text in model_run:
+                        generation.publish(index, text)
+                        if generation.cancelled:
+                            break
+                finally:
+                    model_run.close()
+                generation.finish_choice(index, model_run.finish_reason or "abort")
+                if generation.cancelled:
+                    break
+        finally:
+            rkllm_pool.release(rkllm_model)
+            coalescer.complete(generation)
+
+    # Attach to the running or cached generation of an identical request, or start one on a free instance.
+    # Only for greedy sampling, where identical requests have identical output. Returns the subscribed SharedGeneration,
+    # or None if no instance became free within the queue timeout; raises RKLLMError if the handle could not be set up.
+    def coalesced_chat(template, system_prompt, user_messages, options, lane, priority=0, use_cache=True):
+        sampling, max_new_tokens, lora_adapter = options
+        prompts = [template.render(message['content'], system_prompt) for message in user_messages]
+        images = [message['image'].digest if message.get('image') is not None else None for message in user_messages]
+        lora_key = lora_adapter.cache_key() if lora_adapter is not None else None
+        key = RequestCoalescer.make_key(model_path, lora_key, prompts, images, sampling.key, max_new_tokens)
+        generation = coalescer.lookup(key, use_cache)
+        if generation is not None:
+            return generation
+        try:
+            rkllm_model = acquire_model(priority, sampling, lora_adapter, lane,
+                                        sum(request_cost(len(prompt) + image_chars(message), max_new_tokens)
+                                            for prompt, message in zip(prompts, user_messages)))
+        except PoolTimeout:
+            return None
+        # Another request may have started the same generation while this one was queued.
+        generation, producer = coalescer.join(key, use_cache)
+        if not producer:
+            rkllm_pool.release(rkllm_model)
+            return generation
+        threading.Thread(target=produce_chat, args=(rkllm_model, generation, template, system_prompt, user_messages, max_new_tokens),
+                         daemon=True).start()
+        return generation
+
+    # Generate the --warm_prompts requests, and with a response cache generate them again shortly before their
+    # responses expire, so the canned prompts are always answered from the cache.
+    def warm_prompts(requests):
+        while True:
+            for data in requests:
+                template = prompt_template()
+                system_prompt, user_messages = split_messages(template, data['messages'])
+                try:
+                    generation = coalesced_chat(template, system_prompt, user_messages, request_options(data), batch_lane, use_cache=False)
+                except (ValueError, OSError, RKLLMError, AdmissionRejected) as e:
+                    print("Error: warming a prompt failed: {}".format(e))
+                    sys.stdout.flush()
+                    continue
+                if generation is not None:
+                    for _ in generation.follow():
+                        pass
+                    generation.unsubscribe()
+            if args.response_cache_ttl <= 0:
+                return
+            time.sleep(args.response_cache_ttl * 0.9)
+
+    # Answer a /rkllm_chat request without a session from a shared generation.
+    def coalesced_response(data, options, lane, priority, rkllm_responses):
+        template = prompt_template()
+        system_prompt, user_messages = split_messages(template, data['messages'])
+        try:
+            generation = coalesced_chat(template, system_prompt, user_messages, options, lane, priority)
+        except AdmissionRejected as e:
+            return rejected_response(e)
+        except (OSError, RKLLMError) as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+        if generation is None:
+            return jsonify({'status': 'error', 'message': 'RKLLM_Server is busy! Maybe you can try again later.'}), 503
+
+        if not data.get("stream"):
+            try:
+                replies = [[] for _ in user_messages]
+                for index, text in generation.follow():
+                    replies[index].append(text)
+            finally:
+                generation.unsubscribe()
+            for index, reply in enumerate(replies):
+                rkllm_responses["choices"].append(
+                    {"index": index,
+                    "message": {
+                        "role": "assistant",
+                        "content": "".join(reply),
+                    },
+                    "logprobs": None,
+                    "finish_reason": generation.finish_reasons.get(index)
+                    }
+                )
+            return jsonify(rkllm_responses), 200
+
+        unsubscribed = []
+        def unsubscribe():
+            if not unsubscribed:
+                unsubscribed.append(True)
+                generation.unsubscribe()
+
+        chunks = CumulativeChunks(rkllm_responses)
+
+        def generate():
+            try:
+                for events in generation.follow_chunks(flush_policy):
+                    for index, text in events:
+                        yield chunks.render(index, text)
+            finally:
+                unsubscribe()
+
+        response = Response(generate(), content_type='text/plain')
+        response.call_on_close(unsubscribe)
+        return response
+
+    # The registered LoRA adapters and the ones loaded on each handle.
+    @app.route('/rkllm_lora', methods=['GET'])
+    def list_lora():
+        return jsonify({
+            "adapters": lora_registry.describe(),
+            "default": default_lora,
+            "loaded": [list(rkllm_model.lora_adapters) for rkllm_model in rkllm_models],
+        }), 200
+
+    # Register an adapter, or replace the file of a registered name, while the server runs: {"name", "path", "scale"}.
+    # The path must lie in --lora_dir, and with --api_keys the request needs a listed key.
+    # Handles load it when a request first selects it; a replaced adapter is reloaded the same way.
+    @app.route('/rkllm_lora', methods=['POST'])
+    def register_lora():
+        unauthorized = unauthorized_response()
+        if unauthorized is not None:
+            return unauthorized
+        if not args.lora_dir:
+            return jsonify({'status': 'error', 'message': 'Registering adapters needs --lora_dir!'}), 403
+        data = request.get_json(silent=True) or {}
+        if not (isinstance(data.get("name"), str) and data["name"] and isinstance(data.get("path"), str)):
+            return jsonify({'status': 'error', 'message': 'Expected {"name": ..., "path": ...}!'}), 400
+        try:
+            path = adapter_path(args.lora_dir, data["path"])
+            adapter = lora_registry.register(LoraAdapter(data["name"], path, data.get("scale", 1.0)))
+        except (TypeError, ValueError) as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        return jsonify({'status': 'ok', 'adapter': adapter.describe()}), 200
+
+    # Requests can no longer select the adapter; handles drop it as it becomes least recently used.
+    @app.route('/rkllm_lora/<name>', methods=['DELETE'])
+    def unregister_lora(name):
+        unauthorized = unauthorized_response()
+        if unauthorized is not None:
+            return unauthorized
+        if name == default_lora:
+            return jsonify({'status': 'error', 'message': 'The default adapter cannot be removed!'}), 409
+        if lora_registry.unregister(name) is None:
+            return jsonify({'status': 'error', 'message': 'Unknown lora_adapter!'}), 404
+        return jsonify({'status': 'ok'}), 200
+
+    # Upload an image embedding into the image cache: the body is a .npy file or raw float32 values (then with
+    # ?n_image_tokens=N unless --image_embed_dim is set), or a multipart file. Returns its image_hash, which requests pass
+    # instead of the embedding from then on.
+    @app.route('/rkllm_image', methods=['POST'])
+    def upload_image():
+        if image_cache is None:
+            return jsonify({'status': 'error', 'message': 'Image embeddings need a server started with --image_cache_dir!'}), 404
+        data = request.files['file'].read() if 'file' in request.files else request.get_data(cache=False)
+        try:
+            image = image_cache.put(data, request.values.get('n_image_tokens'))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        except OSError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+        return jsonify(dict(image.describe(), status='ok')), 200
+
+    # Whether an embedding is cached, so a client can skip uploading it.
+    @app.route('/rkllm_image/<image_hash>', methods=['GET'])
+    def get_image(image_hash):
+        image = image_cache.get(image_hash) if image_cache is not None else None
+        if image is None:
+            return jsonify({'status': 'error', 'message': 'Unknown image_hash!'}), 404
+        return jsonify(dict(image.describe(), status='ok')), 200
+
+    # Start a multi-turn chat session; pass the returned session_id to /rkllm_chat to continue it.
+    @app.route('/rkllm_session', methods=['POST'])
+    def create_session():
+        data = request.get_json(silent=True) or {}
+        try:
+            lora_adapter = select_lora(data.get("lora_adapter"))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        session = session_store.create(data.get("system_prompt", prompt_template().system_prompt),
+                                       lora_adapter.name if lora_adapter is not None else "")
+        return jsonify({'session_id': session.session_id}), 200
+
+    @app.route('/rkllm_session/<session_id>', methods=['DELETE'])
+    def delete_session(session_id):
+        if not session_store.delete(session_id):
+            return jsonify({'status': 'error', 'message': 'Unknown session_id!'}), 404
+        return jsonify({'status': 'ok'}), 200
+
     # Create a function to receive data sent by the user using a request
     @app.route('/rkllm_chat', methods=['POST'])
     def receive_message():
-        # Link global variables to retrieve the output information from the callback function
-        global global_text, global_state
-        global is_blocking
+        # Get JSON data from the POST request.
+        data = request.json
+        if not (data and 'messages' in data):
+            return jsonify({'status': 'error', 'message': 'Invalid JSON data!'}), 400
+
+        # A session keeps the adapter it was created with.
+        session = session_store.get(data["session_id"]) if data.get("session_id") else None
+        if data.get("session_id") and session is None:
+            return jsonify({'status': 'error', 'message': 'Unknown session_id!'}), 404
+        try:
+            options = request_options(data, session.lora_adapter if session is not None else None)
+            priority = request_priority(data)
+            lane = request_lane(interactive_lane)
+            data['messages'] = [attach_image(message) for message in data['messages']]
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        except UnknownImage as e:
+            return unknown_image_response(e)
+        except OSError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+        if session is not None and any(message.get('image') is not None for message in data['messages']):
+            return jsonify({'status': 'error', 'message': 'Images are not supported in sessions!'}), 400
+        sampling, max_new_tokens, lora_adapter = options
 
-        # If the server is in a blocking state, return a specific response.
-        if is_blocking or global_state==0:
+        # Identical greedy requests without a session share one generation.
+        if coalescer is not None and session is None and sampling.greedy:
+            print("Received messages:", data['messages'])
+            return coalesced_response(data, options, lane, priority, {
+                "id": "rkllm_chat",
+                "object": "rkllm_chat",
+                "created": None,
+                "choices": [],
+                "usage": {
+                "prompt_tokens": None,
+                "completion_tokens": None,
+                "total_tokens": None
+                }
+            })
+
+        # Turns of one session run one after another.
+        if session is not None:
+            if not session.lock.acquire(timeout=args.queue_timeout):
+                return jsonify({'status': 'error', 'message': 'The session is busy with another request!'}), 409
+
+        # Queue for a free instance; only give up once the queue timeout has passed.
+        history_chars = len(session.context_text or "") if session is not None else 0
+        cost = sum(request_cost(history_chars + len(message.get('content') or "") + image_chars(message), max_new_tokens)
+                   for message in data['messages'] if message.get('role') != 'system')
+        try:
+            rkllm_model = acquire_model(priority, sampling, lora_adapter, lane, cost)
+        except (PoolTimeout, AdmissionRejected, RKLLMError) as e:
+            if session is not None:
+                session.lock.release()
+            if isinstance(e, AdmissionRejected):
+                return rejected_response(e)
+            if isinstance(e, RKLLMError):
+                return jsonify({'status': 'error', 'message': str(e)}), 500
             return jsonify({'status': 'error', 'message': 'RKLLM_Server is busy! Maybe you can try again later.'}), 503
-        
-        lock.acquire()
+
+        def release_request():
+            rkllm_pool.release(rkllm_model)
+            if session is not None:
+                session.lock.release()
+
+        release_model = True
         try:
-            # Set the server to a blocking state.
-            is_blocking = True
-
-            # Get JSON data from the POST request.
-            data = request.json
-            if data and 'messages' in data:
-                # Reset global variables.
-                global_text = []
-                global_state = -1
-
-                # Define the structure for the returned response.
-                rkllm_responses = {
-                    "id": "rkllm_chat",
-                    "object": "rkllm_chat",
-                    "created": None,
-                    "choices": [],
-                    "usage": {
-                    "prompt_tokens": None,
-                    "completion_tokens": None,
-                    "total_tokens": None
-                    }
+            # Define the structure for the returned response.
+            rkllm_responses = {
+                "id": "rkllm_chat",
+                "object": "rkllm_chat",
+                "created": None,
+                "choices": [],
+                "usage": {
+                "prompt_tokens": None,
+                "completion_tokens": None,
+                "total_tokens": None
                 }
+            }
 
-                if not "stream" in data.keys() or data["stream"] == False:
-                    # Process the received data here.
-                    messages = data['messages']
-                    print("Received messages:", messages)
-                    for index, message in enumerate(messages):
-                        input_prompt = message['content']
-                        rkllm_output = ""
-                        
-                        # Create a thread for model inference.
-                        model_thread = threading.Thread(target=rkllm_model.run, args=(input_prompt,))
-                        model_thread.start()
-
-                        # Wait for the model to finish running and periodically check the inference thread of the model.
-                        model_thread_finished = False
-                        while not model_thread_finished:
-                            while len(global_text) > 0:
-                                rkllm_output += global_text.pop(0)
-                                time.sleep(0.005)
-
-                            model_thread.join(timeout=0.005)
-                            model_thread_finished = not model_thread.is_alive()
-                        
-                        rkllm_responses["choices"].append(
-                            {"index": index,
-                            "message": {
-                                "role": "assistant",
-                                "content": rkllm_output,
-                            },
-                            "logprobs": None,
-                            "finish_reason": "stop"
-                            }
-                        )
-                    return jsonify(rkllm_responses), 200
-                else:
-                    messages = data['messages']
-                    print("Received messages:", messages)
-                    for index, message in enumerate(messages):
-                        input_prompt = message['content']
-                        rkllm_output = ""
-                        
-                        def generate():
-                            model_thread = threading.Thread(target=rkllm_model.run, args=(input_prompt,))
-                            model_thread.start()
-
-                            model_thread_finished = False
-                            while not model_thread_finished:
-                                while len(global_text) > 0:
-                                    rkllm_output = global_text.pop(0)
-
-                                    rkllm_responses["choices"].append(
-                                        {"index": index,
-                                        "delta": {
-                                            "role": "assistant",
-                                            "content": rkllm_output,
-                                        },
-                                        "logprobs": None,
-                                        "finish_reason": "stop" if global_state == 1 else None,
-                                        }
-                                    )
-                                    yield f"{json.dumps(rkllm_responses)}\n\n"
-
-                                model_thread.join(timeout=0.005)
-                                model_thread_finished = not model_thread.is_alive()
-
-                    return Response(generate(), content_type='text/plain')
+            if not "stream" in data.keys() or data["stream"] == False:
+                # Process the received data here.
+                messages = data['messages']
+                print("Received messages:", messages)
+                template = prompt_template()
+                system_prompt, user_messages = split_messages(template, messages)
+                for index, message in enumerate(user_messages):
+                    input_prompt, turn_text, save_path = prepare_turn(rkllm_model, template, session, system_prompt, message['content'],
+                                                                      message.get('image'), max_new_tokens)
+                    model_run = ModelRun(rkllm_model, input_prompt, max_new_tokens, args.request_timeout, save_path, image=message.get('image'))
+                    rkllm_output = "".join(model_run)
+                    if session is not None:
+                        session_store.commit_turn(session, turn_text, rkllm_output, template.separator, save_path,
+                                                  session_turn(template, message['content'], rkllm_output, model_run))
+
+                    rkllm_responses["choices"].append(
+                        {"index": index,
+                        "message": {
+                            "role": "assistant",
+                            "content": rkllm_output,
+                        },
+                        "logprobs": None,
+                        "finish_reason": model_run.finish_reason
+                        }
+                    )
+                return jsonify(rkllm_responses), 200
             else:
-                return jsonify({'status': 'error', 'message': 'Invalid JSON data!'}), 400
+                messages = data['messages']
+                print("Received messages:", messages)
+                template = prompt_template()
+                system_prompt, user_messages = split_messages(template, messages)
+
+                chunks = CumulativeChunks(rkllm_responses)
+
+                def generate():
+                    # Messages are answered one after another in the same stream.
+                    for index, message in enumerate(user_messages):
+                        # Closing this generator (e.g. when the client disconnects) aborts the run.
+                        input_prompt, turn_text, save_path = prepare_turn(rkllm_model, template, session, system_prompt, message['content'],
+                                                                          message.get('image'), max_new_tokens)
+                        model_run = ModelRun(rkllm_model, input_prompt, max_new_tokens, args.request_timeout, save_path,
+                                             image=message.get('image'))
+                        reply = []
+                        try:
+                            for rkllm_output in model_run.chunks(flush_policy):
+                                reply.append(rkllm_output)
+                                yield chunks.render(index, rkllm_output)
+                        finally:
+                            model_run.close()
+                            if session is not None:
+                                session_store.commit_turn(session, turn_text, "".join(reply), template.separator, save_path,
+                                                          session_turn(template, message['content'], "".join(reply), model_run))
+
+                # The instance (and session) stay reserved until the stream has been fully sent to the client.
+                response = Response(generate(), content_type='text/plain')
+                response.call_on_close(release_request)
+                release_model = False
+                return response
+        finally:
+            if release_model:
+                release_request()
+
+    openai_model_name = os.path.basename(model_path)
+
+    def openai_error(message, status, error_type="invalid_request_error"):
+        return jsonify({"error": {"message": message, "type": error_type, "param": None, "code": None}}), status
+
+    def openai_finish_reason(finish_reason):
+        return "length" if finish_reason in ("length", "timeout") else "stop"
+
+    @app.route('/v1/models', methods=['GET'])
+    def list_models():
+        models = [{"id": openai_model_name, "object": "model", "created": 0, "owned_by": "rkllm"}]
+        models += [{"id": name, "object": "model", "created": 0, "owned_by": "rkllm", "parent": openai_model_name}
+                   for name in lora_registry.names()]
+        return jsonify({"object": "list", "data": models}), 200
+
+    # OpenAI-compatible chat completions. Streaming responses are Server-Sent Events carrying only the new text of each
+    # chunk, terminated by "data: [DONE]".
+    @app.route('/v1/chat/completions', methods=['POST'])
+    def chat_completions():
+        data = request.get_json(silent=True)
+        if not (data and isinstance(data.get('messages'), list)):
+            return openai_error("'messages' is required.", 400)
+        # Unlike /rkllm_chat, an OpenAI request is one conversation: earlier user and assistant messages are rendered into
+        # the prompt with the turn separator and only the last user message is answered.
+        template = prompt_template()
+        if template.conversation(data['messages']) is None:
+            return openai_error("The last message must have the role 'user'.", 400)
+        # As with other OpenAI-compatible servers, a "model" naming a registered adapter selects it.
+        lora_name = data.get('lora_adapter')
+        if lora_name is None and lora_registry.get(data.get('model') or "") is not None:
+            lora_name = data['model']
+        try:
+            sampling, max_new_tokens, lora_adapter = request_options(data, lora_name)
+            priority = request_priority(data)
+            lane = request_lane(interactive_lane)
+        except ValueError as e:
+            return openai_error(str(e), 400)
+        # The oldest messages are dropped when the conversation does not fit into the context with the reply.
+        fixed_tokens = token_counter.count(template.prefix()) + token_counter.count(template.postfix)
+        messages = fit_messages(context_window, token_counter, data['messages'], fixed_tokens,
+                                token_counter.count(template.postfix + template.separator), max_new_tokens)
+        conversation = template.conversation(messages)
+
+        queued = time.monotonic()
+        try:
+            rkllm_model = acquire_model(priority, sampling, lora_adapter, lane,
+                                        request_cost(len(conversation[0]) + len(conversation[1]), max_new_tokens))
+        except PoolTimeout:
+            return openai_error("RKLLM_Server is busy! Maybe you can try again later.", 503, "server_error")
+        except AdmissionRejected as e:
+            response, status = openai_error("{}. Maybe you can try again later.".format(e), 503, "server_error")
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, status
+        except RKLLMError as e:
+            return openai_error(str(e), 500, "server_error")
+        queue_ms = round((time.monotonic() - queued) * 1000, 1)
+
+        release_model = True
+        try:
+            system_prompt, content = conversation
+            input_prompt = build_prompt_input(rkllm_model, template, system_prompt, content)
+            input_ids, prompt_tokens = encode_prompt(template, system_prompt, content, input_prompt)
+            model_run = ModelRun(rkllm_model, input_prompt, max_new_tokens, args.request_timeout, input_ids=input_ids)
+            completion_id = "chatcmpl-" + uuid.uuid4().hex
+            created = int(time.time())
+
+            def usage():
+                return {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": model_run.completion_tokens,
+                    "total_tokens": prompt_tokens + model_run.completion_tokens if prompt_tokens is not None else None,
+                }
+
+            def timings():
+                return dict(model_run.timings(), queue_ms=queue_ms)
+
+            if not data.get("stream"):
+                text = "".join(model_run)
+                if model_run.finish_reason == "error":
+                    return openai_error("Error occurred during LLM inference.", 500, "server_error")
+                return jsonify({
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": openai_model_name,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "logprobs": None,
+                        "finish_reason": openai_finish_reason(model_run.finish_reason),
+                    }],
+                    "usage": usage(),
+                    "timings": timings(),
+                }), 200
+
+            include_usage = bool((data.get("stream_options") or {}).get("include_usage"))
+
+            def chunk(delta, finish_reason=None):
+                return "data: " + json.dumps({
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": openai_model_name,
+                    "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}],
+                }) + "\n\n"
+
+            content_chunk = ChunkTemplate({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": openai_model_name,
+                "choices": [{"index": 0, "delta": {"content": CONTENT_MARKER}, "logprobs": None, "finish_reason": None}],
+            }, "data: ", "\n\n")
+
+            def generate():
+                # Closing this generator (e.g. when the client disconnects) aborts the run.
+                try:
+                    yield chunk({"role": "assistant", "content": ""})
+                    for text in model_run.chunks(flush_policy):
+                        yield content_chunk.render(text)
+                finally:
+                    model_run.close()
+                if model_run.finish_reason == "error":
+                    yield "data: " + json.dumps({"error": {"message": "Error occurred during LLM inference.", "type": "server_error"}}) + "\n\n"
+                else:
+                    yield chunk({}, openai_finish_reason(model_run.finish_reason))
+                if include_usage:
+                    yield "data: " + json.dumps({
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": openai_model_name,
+                        "choices": [],
+                        "usage": usage(),
+                        "timings": timings(),
+                    }) + "\n\n"
+                yield "data: [DONE]\n\n"
+
+            response = Response(generate(), content_type='text/event-stream')
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            # The run is aborted here as well in case the client went away before the stream was started.
+            def release_request():
+                model_run.close()
+                rkllm_pool.release(rkllm_model)
+
+            response.call_on_close(release_request)
+            release_model = False
+            return response
         finally:
-            lock.release()
-            is_blocking = False
-        
-    # Start the Flask application.
+            if release_model:
+                rkllm_pool.release(rkllm_model)
+
+    # Run one embeddings input in RKLLM_INFER_GET_LAST_HIDDEN_LAYER mode. The input is embedded as-is, without the chat
+    # template, and any prompt cache is released first so the hidden states cover the whole input.
+    def run_embedding(rkllm_model, options, cancelled):
+        text, pooling, normalize = options
+        rkllm_model.use_lora(select_lora(None))
+        rkllm_model.use_prompt_cache(None)
+        if rkllm_model.hidden_states is None:
+            rkllm_model.hidden_states = HiddenStateBuffer()
+        hidden_states = rkllm_model.hidden_states
+        hidden_states.reset()
+        input_ids = tokenizer.encode(text, add_special_tokens=False) if tokenizer is not None else None
+        model_run = ModelRun(rkllm_model, text, -1, args.request_timeout, input_ids=input_ids,
+                             infer_mode=RKLLMInferMode.RKLLM_INFER_GET_LAST_HIDDEN_LAYER, hidden_states=hidden_states)
+        for _ in model_run:
+            pass
+        states = hidden_states.states()
+        if model_run.finish_reason != "stop" or states is None or len(states) == 0:
+            return {"error": "Failed to get the last hidden layer: {}".format(model_run.finish_reason)}
+        return {"vector": embeddings.pool(states, pooling, normalize), "num_tokens": hidden_states.num_tokens}
+
+    # OpenAI-compatible embeddings from the last hidden layer of the model. A list of inputs is spread over the instances.
+    @app.route('/v1/embeddings', methods=['POST'])
+    @app.route('/embeddings', methods=['POST'])
+    def create_embeddings():
+        if embeddings.np is None:
+            return openai_error("Embeddings need numpy: pip install numpy.", 501, "server_error")
+        data = request.get_json(silent=True) or {}
+        inputs = data.get("input")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if not (isinstance(inputs, list) and inputs and all(isinstance(text, str) and text for text in inputs)):
+            return openai_error("'input' must be a non-empty string or a list of non-empty strings.", 400)
+        pooling = data.get("pooling", args.embedding_pooling)
+        encoding_format = data.get("encoding_format", ENCODING_FLOAT)
+        if pooling not in POOLING_MODES:
+            return openai_error("'pooling' must be one of: {}.".format(", ".join(POOLING_MODES)), 400)
+        if encoding_format not in (ENCODING_FLOAT, ENCODING_BASE64):
+            return openai_error("'encoding_format' must be 'float' or 'base64'.", 400)
+        normalize = bool(data.get("normalize", True))
+
+        try:
+            priority = request_priority(data)
+            lane = request_lane(interactive_lane)
+        except ValueError as e:
+            return openai_error(str(e), 400)
+
+        items = [(text, pooling, normalize) for text in inputs]
+        # An embedding generates no tokens; only its prefill counts.
+        runner = BatchRunner(rkllm_pool, items, run_embedding, len(rkllm_models), priority, args.queue_timeout,
+                             lane=lane, cost=lambda item: request_cost(len(item[0]), 1))
+        results = dict(runner)
+        failed = [result for result in results.values() if "error" in result]
+        if failed:
+            return openai_error(failed[0]["error"], 503 if failed[0].get("queue_timeout") else 500, "server_error")
+        prompt_tokens = sum(result["num_tokens"] for result in results.values())
+        return jsonify({
+            "object": "list",
+            "data": [{"object": "embedding", "index": index, "embedding": embeddings.encode(results[index]["vector"], encoding_format)}
+                     for index in range(len(items))],
+            "model": openai_model_name,
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        }), 200
+
+    # Read the items of a batch request: a JSON body {"prompts": [...]} or an uploaded JSONL file, one item per line.
+    # An item is a prompt string or an object with "prompt" and optionally "id" and "system_prompt". Returns (items,
+    # options), with items None if they are not a list of prompts; raises ValueError naming a JSONL line that is not JSON.
+    def read_batch_items():
+        if 'file' in request.files:
+            items = []
+            for number, line in enumerate(request.files['file'].read().decode('utf-8').splitlines(), 1):
+                if not line.strip():
+                    continue
+                try:
+                    items.append(json.loads(line))
+                except ValueError as e:
+                    raise ValueError("Invalid JSON on line {}: {}".format(number, e))
+            options = request.form
+        else:
+            data = request.get_json(silent=True) or {}
+            items = data.get("prompts")
+            options = data
+        if not isinstance(items, list):
+            return None, options
+        items = [item if isinstance(item, dict) else {"prompt": item} for item in items]
+        if not all(isinstance(item.get("prompt"), str) for item in items):
+            return None, options
+        return items, options
+
+    # The number of instances a batch may use at once, from its max_instances option. Raises ValueError.
+    def batch_concurrency(options):
+        try:
+            concurrency = int(options.get("max_instances", len(rkllm_models)))
+        except (TypeError, ValueError):
+            raise ValueError("max_instances must be an integer")
+        if concurrency < 1:
+            raise ValueError("max_instances must be at least 1")
+        return concurrency
+
+    # Run one batch item on an instance and measure its decode throughput.
+    def run_batch_item(rkllm_model, item, cancelled, sampling, max_new_tokens, lora_adapter):
+        setup_model(rkllm_model, sampling, lora_adapter)
+        start = time.monotonic()
+        template = prompt_template()
+        input_prompt = build_prompt_input(rkllm_model, template, item.get("system_prompt", template.system_prompt), item["prompt"],
+                                          item.get("image"))
+        model_run = ModelRun(rkllm_model, input_prompt, max_new_tokens, args.request_timeout, image=item.get("image"))
+        output = []
+        stopped = False
+        try:
+            for text in model_run:
+                output.append(text)
+                if cancelled.is_set():
+                    stopped = True
+                    break
+        finally:
+            model_run.close()
+        seconds = time.monotonic() - start
+        return {
+            "content": "".join(output),
+            "finish_reason": "cancelled" if stopped else model_run.finish_reason,
+            "completion_tokens": model_run.completion_tokens,
+            "seconds": round(seconds, 3),
+            "tokens_per_second": round(model_run.completion_tokens / seconds, 2) if seconds > 0 else None,
+        }
+
+    # Offline batch processing: the items are spread over the instances and each result is streamed back as one NDJSON
+    # line as soon as it is finished, followed by a summary line with the aggregate throughput.
+    @app.route('/rkllm_batch', methods=['POST'])
+    def receive_batch():
+        try:
+            items, options = read_batch_items()
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        if not items:
+            return jsonify({'status': 'error', 'message': 'Invalid batch: expected a list of prompts or a JSONL file!'}), 400
+        try:
+            sampling, max_new_tokens, lora_adapter = request_options(options)
+            lane = request_lane(batch_lane)
+            items = [attach_image(item, 'prompt') for item in items]
+            concurrency = batch_concurrency(options)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        except UnknownImage as e:
+            return unknown_image_response(e)
+        except OSError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+        # All items of a batch use the same sampling parameters and adapter, so they keep to the instances set up for them.
+        # In a preemptible lane, an item is aborted when a request of a higher lane is waiting and runs again later.
+        runner = BatchRunner(rkllm_pool, items,
+                             lambda rkllm_model, item, cancelled: run_batch_item(rkllm_model, item, cancelled, sampling, max_new_tokens, lora_adapter),
+                             concurrency, args.batch_priority, args.request_timeout,
+                             lambda rkllm_model: setup_score(rkllm_model, sampling, lora_adapter),
+                             lane, lambda item: request_cost(len(item["prompt"]) + image_chars(item), max_new_tokens))
+
+        def generate():
+            completion_tokens = 0
+            for index, result in runner:
+                completion_tokens += result.get("completion_tokens", 0)
+                result.update({"object": "rkllm_batch.item", "index": index, "id": items[index].get("id", index)})
+                yield json.dumps(result) + "\n"
+            seconds = time.monotonic() - runner.started
+            yield json.dumps({
+                "object": "rkllm_batch.summary",
+                "items": len(items),
+                "completion_tokens": completion_tokens,
+                "seconds": round(seconds, 3),
+                "tokens_per_second": round(completion_tokens / seconds, 2) if seconds > 0 else None,
+            }) + "\n"
+
+        response = Response(generate(), content_type='application/x-ndjson')
+        response.call_on_close(runner.close)
+        return response
+
+    if args.warm_prompts:
+        if coalescer is None:
+            print("Error: --warm_prompts cannot be used with --no_coalesce.")
+            sys.stdout.flush()
+            exit()
+        warm_requests = []
+        with open(args.warm_prompts, "r") as warm_file:
+            for number, line in enumerate(warm_file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    data = json.loads(line)
+                except ValueError as e:
+                    print("Error: line {} of {} is not valid JSON: {}".format(number, args.warm_prompts, e))
+                    sys.stdout.flush()
+                    exit()
+                if not isinstance(data, dict) or not isinstance(data.get('messages'), list):
+                    print("Error: line {} of {} is not a request with a list of messages.".format(number, args.warm_prompts))
+                    sys.stdout.flush()
+                    exit()
+                warm_requests.append(data)
+        threading.Thread(target=warm_prompts, args=(warm_requests,), daemon=True).start()
+
+    # SIGTERM stops the server like Ctrl-C, so the instances are released and the clocks relaxed below.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    # Start the Flask application. Connections are kept open between requests (see keep_alive.py), so clients such as
+    # rkllm_client.py do not connect again for every request.
     # app.run(host='0.0.0.0', port=8080)
-    app.run(host='0.0.0.0', port=8080, threaded=True, debug=False)
+    app.run(host=args.host, port=args.port, threaded=True, debug=False, request_handler=KeepAliveRequestHandler)
 
     print("====================")
     print("RKLLM model inference completed, releasing RKLLM model resources...")
-    rkllm_model.release()
+    rkllm_pool.close()
+    if governor is not None:
+        governor.close()
     print("====================")
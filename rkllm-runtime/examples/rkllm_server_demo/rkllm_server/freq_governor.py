@@ -0,0 +1,342 @@
+import atexit
+import errno
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+# How the servers control the clocks (--freq_mode).
+FREQ_MODE_GOVERNOR = "governor"
+FREQ_MODE_FIXED = "fixed"
+FREQ_MODE_NONE = "none"
+FREQ_MODES = [FREQ_MODE_GOVERNOR, FREQ_MODE_FIXED, FREQ_MODE_NONE]
+
+CPUFREQ = "cpufreq"
+DEVFREQ = "devfreq"
+
+# The frequency domains pinned by fix_freq_<platform>.sh: (name, kind, sysfs directory relative to the root).
+PLATFORM_DOMAINS = {
+    "rk3588": [
+        ("npu", DEVFREQ, "sys/class/devfreq/fdab0000.npu"),
+        ("cpu0", CPUFREQ, "sys/devices/system/cpu/cpufreq/policy0"),
+        ("cpu4", CPUFREQ, "sys/devices/system/cpu/cpufreq/policy4"),
+        ("cpu6", CPUFREQ, "sys/devices/system/cpu/cpufreq/policy6"),
+        ("ddr", DEVFREQ, "sys/class/devfreq/dmc"),
+    ],
+    "rk3576": [
+        ("npu", DEVFREQ, "sys/class/devfreq/27700000.npu"),
+        ("cpu0", CPUFREQ, "sys/devices/system/cpu/cpufreq/policy0"),
+        ("cpu4", CPUFREQ, "sys/devices/system/cpu/cpufreq/policy4"),
+    ],
+}
+
+# File names of a domain directory: governor, frequency to set under the userspace governor, current frequency and
+# available frequencies.
+DOMAIN_FILES = {
+    CPUFREQ: ("scaling_governor", "scaling_setspeed", "scaling_cur_freq", "scaling_available_frequencies"),
+    DEVFREQ: ("governor", "userspace/set_freq", "cur_freq", "available_frequencies"),
+}
+
+USERSPACE_GOVERNOR = "userspace"
+
+# Files listing the governors a domain can use, and the kernel governors a domain found in userspace at startup is given
+# back to, most preferred first.
+AVAILABLE_GOVERNORS_FILES = {CPUFREQ: "scaling_available_governors", DEVFREQ: "available_governors"}
+KERNEL_GOVERNORS = {
+    CPUFREQ: ["schedutil", "interactive", "ondemand", "conservative"],
+    DEVFREQ: ["dmc_ondemand", "rknpu_ondemand", "simple_ondemand"],
+}
+
+# The settings the domains had before the governor first touched them, relative to the root. /run is emptied at boot,
+# like the sysfs settings, so a server that starts after one that died while boosted restores the same settings.
+STATE_FILE = "run/rkllm_freq_governor.json"
+
+# The idle state whose wake-up latency fix_freq_rk3588.sh in scripts/ avoids by disabling it.
+CPUIDLE_STATE = "sys/devices/system/cpu/cpu[0-9]*/cpuidle/state1/disable"
+THERMAL_ZONES = "sys/class/thermal/thermal_zone[0-9]*"
+
+
+def read_sysfs(path):
+    with open(path, "r") as sysfs_file:
+        return sysfs_file.read().strip()
+
+
+def write_sysfs(path, value):
+    with open(path, "w") as sysfs_file:
+        sysfs_file.write(str(value))
+
+
+# Raises OSError unless the process may write every path, e.g. because it does not run as root.
+def check_writable(*paths):
+    for path in paths:
+        if not os.access(path, os.W_OK):
+            raise OSError(errno.EACCES, "not writable", path)
+
+
+# A cpufreq policy or devfreq device. boost() pins it to its highest available frequency with the userspace governor;
+# relax() gives it back to its original governor: the one saved by an earlier server (original), or the one it has at
+# startup. A domain found in userspace without a saved governor was left pinned by a fix_freq script or a server that
+# died while boosted, and is given the preferred kernel governor it supports; only if it supports none is it set to its
+# lowest frequency instead.
+class FrequencyDomain(object):
+    def __init__(self, name, kind, path, original=None):
+        self.name = name
+        self.path = path
+        governor_file, set_file, cur_file, available_file = DOMAIN_FILES[kind]
+        self.governor_path = os.path.join(path, governor_file)
+        self.set_path = os.path.join(path, set_file)
+        self.cur_path = os.path.join(path, cur_file)
+        available = sorted(int(freq) for freq in read_sysfs(os.path.join(path, available_file)).split())
+        if not available:
+            raise ValueError("{} lists no available frequencies".format(path))
+        self.min_freq, self.max_freq = available[0], available[-1]
+        check_writable(self.governor_path, self.set_path)
+        self.original = original or read_sysfs(self.governor_path)
+        if self.original == USERSPACE_GOVERNOR:
+            self.original = self.kernel_governor(kind) or USERSPACE_GOVERNOR
+
+    def kernel_governor(self, kind):
+        try:
+            available = read_sysfs(os.path.join(self.path, AVAILABLE_GOVERNORS_FILES[kind])).split()
+        except OSError:
+            return None
+        for governor in KERNEL_GOVERNORS[kind]:
+            if governor in available:
+                return governor
+        return None
+
+    def boost(self):
+        write_sysfs(self.governor_path, USERSPACE_GOVERNOR)
+        write_sysfs(self.set_path, self.max_freq)
+
+    def relax(self):
+        if self.original == USERSPACE_GOVERNOR:
+            write_sysfs(self.set_path, self.min_freq)
+        else:
+            write_sysfs(self.governor_path, self.original)
+
+    def cur_freq(self):
+        try:
+            return int(read_sysfs(self.cur_path))
+        except (OSError, ValueError):
+            return None
+
+    def describe(self):
+        return {"name": self.name, "min_freq": self.min_freq, "max_freq": self.max_freq, "governor": self.original}
+
+
+# The cpuidle state of one CPU, disabled while boosted and restored to its original setting on relax().
+class IdleState(object):
+    def __init__(self, path, original=None):
+        self.name = path.split(os.sep)[-4] # cpuN
+        self.path = path
+        check_writable(path)
+        self.original = original or read_sysfs(path)
+
+    def boost(self):
+        write_sysfs(self.path, 1)
+
+    def relax(self):
+        write_sysfs(self.path, self.original)
+
+
+# Holds the NPU, CPU and DDR clocks at their maximum while the server has work, and hands them back to the kernel
+# governors once it has been idle for idle_seconds. The worker pool reports the number of requests queued or running
+# with set_active(), which only wakes a background thread, so the caller never waits for sysfs. The thread boosts the
+# clocks as soon as there is work, relaxes them after the idle period and samples the current frequencies and the
+# thermal zones every sample_interval seconds. root is the directory the sysfs paths are relative to ("/" on the board),
+# so the governor can run against a fake tree. Domains that do not exist or cannot be written are left alone with a
+# warning. The original settings are saved in STATE_FILE until close(), which also runs at interpreter exit.
+class FrequencyGovernor(object):
+    def __init__(self, platform, root="/", idle_seconds=10.0, sample_interval=1.0, cpuidle=False):
+        self.platform = platform
+        self.root = root
+        self.idle_seconds = idle_seconds
+        self.sample_interval = sample_interval
+        self.state_path = os.path.join(root, STATE_FILE)
+        self.state_saved = False
+        saved = self.read_state()
+        self.domains = []
+        for name, kind, path in PLATFORM_DOMAINS.get(platform, []):
+            path = os.path.join(root, path)
+            try:
+                self.domains.append(FrequencyDomain(name, kind, path, saved.get(path)))
+            except (OSError, ValueError) as e:
+                self.warn("Frequency domain {} is not managed: {}".format(name, e))
+        if cpuidle:
+            for path in sorted(glob.glob(os.path.join(root, CPUIDLE_STATE))):
+                try:
+                    self.domains.append(IdleState(path, saved.get(path)))
+                except OSError as e:
+                    self.warn("Idle state {} is not managed: {}".format(path, e))
+        if self.domains:
+            self.write_state()
+        self.thermal_zones = []
+        for path in sorted(glob.glob(os.path.join(root, THERMAL_ZONES))):
+            try:
+                self.thermal_zones.append((read_sysfs(os.path.join(path, "type")), os.path.join(path, "temp")))
+            except OSError:
+                pass
+
+        self.lock = threading.Lock()
+        self.closed = False
+        self.active = 0
+        self.boosted = False
+        self.idle_since = time.monotonic()
+        self.boosted_since = None
+        self.boosted_seconds = 0.0
+        self.boosts = 0
+        self.relaxes = 0
+        self.errors = 0
+        self.frequencies = {}
+        self.temperatures = {}
+        self.sample()
+
+        self.stop = threading.Event()
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def warn(self, message):
+        print("Warning: " + message)
+        sys.stdout.flush()
+
+    # Whether any clock is under control; False if e.g. the server does not run as root.
+    def controls_clocks(self):
+        return any(isinstance(domain, FrequencyDomain) for domain in self.domains)
+
+    def read_state(self):
+        try:
+            with open(self.state_path, "r") as state_file:
+                saved = json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+        return saved if isinstance(saved, dict) else {}
+
+    def write_state(self):
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path, "w") as state_file:
+                json.dump({domain.path: domain.original for domain in self.domains}, state_file)
+            self.state_saved = True
+        except OSError as e:
+            self.warn("Cannot save the original clock settings in {}: {}".format(self.state_path, e))
+
+    # count is the number of requests queued or running. Called by the worker pools with their lock held.
+    def set_active(self, count):
+        with self.lock:
+            self.active = count
+            boost = count > 0 and not self.boosted
+            if count > 0:
+                self.idle_since = None
+            elif self.idle_since is None:
+                self.idle_since = time.monotonic()
+        if boost:
+            self.wake.set()
+
+    # Called by the background thread, or by close() once it has stopped. A domain that fails is dropped, so a
+    # read-only sysfs costs one warning per domain.
+    def _apply(self, action):
+        failed = []
+        for domain in self.domains:
+            try:
+                getattr(domain, action)()
+            except OSError as e:
+                failed.append(domain)
+                self.warn("Cannot {} {}, leaving it alone: {}".format(action, domain.name, e))
+                if action == "boost":
+                    # The governor may have been switched before setting the frequency failed.
+                    try:
+                        domain.relax()
+                    except OSError:
+                        pass
+        now = time.monotonic()
+        with self.lock:
+            self.errors += len(failed)
+            self.domains = [domain for domain in self.domains if domain not in failed]
+            if action == "boost":
+                self.boosted = True
+                self.boosted_since = now
+                self.boosts += 1
+            else:
+                self.boosted = False
+                self.boosted_seconds += now - self.boosted_since
+                self.relaxes += 1
+
+    # The action due now: "boost" while there is work and the clocks are not up, "relax" once they have been idle for
+    # idle_seconds, else None. Called with self.lock held.
+    def _due(self):
+        if self.active > 0 and not self.boosted:
+            return "boost"
+        if self.boosted and self.idle_since is not None and time.monotonic() - self.idle_since >= self.idle_seconds:
+            return "relax"
+        return None
+
+    def _run(self):
+        while True:
+            with self.lock:
+                wait = self.sample_interval
+                if self._due() is not None:
+                    wait = 0.0
+                elif self.boosted and self.idle_since is not None:
+                    wait = min(wait, max(0.0, self.idle_since + self.idle_seconds - time.monotonic()))
+            self.wake.wait(wait)
+            self.wake.clear()
+            if self.stop.is_set():
+                return
+            with self.lock:
+                action = self._due()
+            if action is not None:
+                self._apply(action)
+            self.sample()
+
+    # Read the current frequencies (Hz for devfreq, kHz for cpufreq as in sysfs) and temperatures (degrees Celsius).
+    def sample(self):
+        frequencies = {domain.name: domain.cur_freq() for domain in self.domains if isinstance(domain, FrequencyDomain)}
+        temperatures = {}
+        for zone, path in self.thermal_zones:
+            try:
+                temperatures[zone] = int(read_sysfs(path)) / 1000.0
+            except (OSError, ValueError):
+                pass
+        with self.lock:
+            self.frequencies = frequencies
+            self.temperatures = temperatures
+
+    # Stop the background thread, give the clocks back to their original governors and delete the saved settings.
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stop.set()
+        self.wake.set()
+        self.thread.join()
+        if self.boosted:
+            self._apply("relax")
+        if self.state_saved:
+            try:
+                os.remove(self.state_path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            boosted_seconds = self.boosted_seconds
+            if self.boosted:
+                boosted_seconds += time.monotonic() - self.boosted_since
+            return {
+                "platform": self.platform,
+                "boosted": self.boosted,
+                "active_requests": self.active,
+                "boosts": self.boosts,
+                "relaxes": self.relaxes,
+                "errors": self.errors,
+                "boosted_seconds": round(boosted_seconds, 1),
+                "idle_seconds": self.idle_seconds,
+                "domains": [domain.describe() for domain in self.domains if isinstance(domain, FrequencyDomain)],
+                "cur_freq": dict(self.frequencies),
+                "temperature_c": dict(self.temperatures),
+            }
@@ -1,56 +1,36 @@
-import ctypes
 import os
-import json
+import queue
 import threading
-import time
 import gradio as gr
-from collections import deque  # For buffer memory
+from model_manager import ModelManager, model_size_bytes
+from run_context import RunContext, RunContextRegistry, FINAL_STATES
+from prompt_template import TemplateStore
+from context_window import ContextWindow, TokenCounter
+from metrics import MetricsRegistry, RunMetrics, RunTimer, start_http_server
+from rkllm_runtime import LLMCallState, RKLLMHandle, callback_type, default_param
 
 # Paths
 MODEL_PATH = "/models"
-CONFIG_PATH = "/rkllm-runtime/examples/rkllm_api_demo/src/models_config.json"
-
-# Global variables for callback
-global_text = []
-global_state = -1
-split_byte_data = bytes(b"")
-BUFFER_MEMORY_SIZE = 10  # Max exchanges in buffer memory
-memory_buffer = deque(maxlen=BUFFER_MEMORY_SIZE)  # Session-specific memory
-
-# Load model configurations from JSON
-def load_model_config(model_name):
-    if not os.path.exists(CONFIG_PATH):
-        return {}
-    with open(CONFIG_PATH, "r") as config_file:
-        configs = json.load(config_file)
-
-    # Check if the model exists
-    if "models" in configs and model_name in configs["models"]:
-        model_config = configs["models"][model_name]
-
-        # Inherit family-level defaults
-        family_name = model_config.get("family")
-        if family_name and "families" in configs and family_name in configs["families"]:
-            family_config = configs["families"][family_name]
-            for key, value in family_config.items():
-                if key not in model_config:
-                    model_config[key] = value
-        return model_config
-    return {}
-
-# Interpolate the system prompt into the prefix
-def interpolate_prompt(template_str, system_prompt):
-    """Replace {{system_prompt}} placeholder in the prompt template."""
-    return template_str.replace("{{system_prompt}}", system_prompt)
-
-# Construct prompt with memory
-def construct_prompt_with_memory(prefix, memory, user_input, postfix):
-    """Add memory and current user input to the prompt."""
-    full_prompt = prefix
-    for mem in memory:
-        full_prompt += mem + postfix
-    full_prompt += user_input + postfix
-    return full_prompt
+CONFIG_PATH = "/rkllm-runtime/examples/rkllm_api_demo/src/model_config.json"
+CONFIG_POLL_SECONDS = float(os.environ.get("RKLLM_MODEL_CONFIG_POLL", "2"))  # 0 = load once, never reload
+
+# Model residency: loaded models stay in memory until the budget forces the least recently used one out
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get("RKLLM_MODEL_MEMORY_BUDGET_MB", "0"))  # 0 = unlimited
+PRELOAD_MODELS = [name for name in os.environ.get("RKLLM_PRELOAD_MODELS", "").split(",") if name]
+
+# Prometheus metrics are served at http://[board_ip]:RKLLM_METRICS_PORT/metrics
+METRICS_PORT = int(os.environ.get("RKLLM_METRICS_PORT", "0"))  # 0 = disabled
+metrics_registry = MetricsRegistry()
+run_metrics = RunMetrics(metrics_registry)
+
+# Every run in progress, by the run id passed to rkllm_run as userdata
+run_contexts = RunContextRegistry()
+# Buffer memory is kept per browser session in a gr.State and trimmed, oldest exchanges first, to the context length of
+# the model minus its max_new_tokens; token counts are estimated from the text length.
+token_counter = TokenCounter()
+
+# Model configurations and prompt templates from JSON, loaded once and reloaded when the file changes
+template_store = TemplateStore(CONFIG_PATH, CONFIG_POLL_SECONDS)
 
 # Get available models in the /models directory
 def get_available_models():
@@ -61,91 +41,132 @@ def get_available_models():
 # RKLLM wrapper class
 class RKLLM:
     def __init__(self, model_path, config):
-        self.rkllm_lib = ctypes.CDLL('lib/librkllmrt.so')
-        rkllm_param = RKLLMParam()
-
         # Set parameters from JSON config
-        rkllm_param.model_path = bytes(model_path, 'utf-8')
-        rkllm_param.max_context_len = config.get("max_context_len", 512)
-        rkllm_param.max_new_tokens = config.get("max_new_tokens", 256)
-        rkllm_param.temperature = config.get("temperature", 0.8)
-        rkllm_param.top_k = config.get("top_k", 40)
-        rkllm_param.top_p = config.get("top_p", 0.9)
+        rkllm_param = default_param(
+            model_path,
+            max_context_len=config.get("max_context_len", 512),
+            max_new_tokens=config.get("max_new_tokens", 256),
+            temperature=config.get("temperature", 0.8),
+            top_k=config.get("top_k", 40),
+            top_p=config.get("top_p", 0.9),
+        )
 
         # Initialize model
-        self.handle = ctypes.c_void_p()
-        self.rkllm_lib.rkllm_init(ctypes.byref(self.handle), ctypes.byref(rkllm_param), None)
+        self.handle = RKLLMHandle(rkllm_param, callback)
 
-    def run(self, prompt):
-        rkllm_input = RKLLMInput()
-        rkllm_input.input_mode = 0
-        rkllm_input.input_data.prompt_input = bytes(prompt, 'utf-8')
-        self.rkllm_lib.rkllm_run(self.handle, ctypes.byref(rkllm_input), None, None)
+    # Run to completion on the calling thread; the output goes to context.
+    def run(self, prompt, context):
+        run_id = run_contexts.register(context)
+        try:
+            context.timer = RunTimer(run_metrics)
+            context.timer.start()
+            self.handle.run(prompt, run_id)
+            if not context.finished(): # rkllm_run failed without reporting the end of the run
+                context.timer.finish(error=True)
+                context.put(LLMCallState.RKLLM_RUN_ERROR)
+        finally:
+            run_contexts.unregister(run_id)
+
+    def abort(self):
+        self.handle.abort()
 
     def release(self):
-        self.rkllm_lib.rkllm_destroy(self.handle)
+        self.handle.destroy()
+
+# Output of one chat turn, read by the Gradio generator of that turn
+class ChatRun(RunContext):
+    def __init__(self):
+        RunContext.__init__(self)
+        self.queue = queue.Queue()
+
+    def put(self, state, text=None):
+        self.state = state
+        if state == LLMCallState.RKLLM_RUN_ERROR:
+            text = "Error occurred during LLM inference."
+        self.queue.put((state, text))
 
 # Callback implementation
 def callback_impl(result, userdata, state):
-    global global_text, global_state, split_byte_data
-    if state == 2:  # RKLLM_RUN_FINISH
-        global_state = state
-    elif state == 3:  # RKLLM_RUN_ERROR
-        global_state = state
-        global_text.append("Error occurred during LLM inference.")
-    else:
-        try:
-            global_text.append((split_byte_data + result.contents.text).decode('utf-8'))
-            split_byte_data = bytes(b"")
-        except:
-            split_byte_data += result.contents.text
+    context = run_contexts.get(userdata)
+    if context is not None:
+        context.handle(result, state)
 
-# Callback type
-callback_type = ctypes.CFUNCTYPE(None, ctypes.POINTER(RKLLMResult), ctypes.c_void_p, ctypes.c_int)
+# Connect the callback function between the Python side and the C++ side
+callback = callback_type(callback_impl)
 
 # Record user input
-def get_user_input(user_message, history, selected_model):
+def get_user_input(user_message, history, selected_model, memory):
     if not selected_model or selected_model == "No models available":
         history = history + [["Please select a model from the dropdown.", None]]
-        return "", history
+        return "", history, memory
 
-    # Load model config
-    config = load_model_config(selected_model)
-    prompt_prefix = interpolate_prompt(config.get("PROMPT_TEXT_PREFIX", ""), config.get("system_prompt", ""))
-    prompt_postfix = config.get("PROMPT_TEXT_POSTFIX", "")
-    
-    # Construct the full prompt with memory
-    full_prompt = construct_prompt_with_memory(prompt_prefix, memory_buffer, user_message, prompt_postfix)
+    # Construct the full prompt with the memory of this browser session that fits into the context
+    template = template_store.model_template(selected_model)
+    memory = fit_memory(template, template_store.model_config(selected_model), memory, user_message)
+    full_prompt = template.render_history(memory, user_message)
     
-    # Update history
+    # Update history; the reply of the pending exchange is filled in by get_RKLLM_output
     history = history + [[f"Model: {selected_model}\nUser: {user_message}", None]]
-    return full_prompt, history
+    memory = memory + [[user_message, None]]
+    return full_prompt, history, memory
+
+# Drop the oldest exchanges of memory until it fits with user_message and the reply tokens of the model
+def fit_memory(template, config, memory, user_message):
+    window = ContextWindow(config.get("max_context_len", 512), config.get("max_new_tokens", 256))
+    turn_tokens = token_counter.count(template.postfix) + token_counter.count(template.separator)
+    fixed_tokens = token_counter.count(template.prefix()) + token_counter.count(user_message) + token_counter.count(template.postfix)
+    dropped = window.turns_to_drop(fixed_tokens, [token_counter.count(previous_message) + token_counter.count(reply) + turn_tokens
+                                                  for previous_message, reply in memory])
+    return memory[dropped:]
+
+# Load a model into a resident RKLLM handle
+def load_model(model_name, config):
+    return RKLLM(os.path.join(MODEL_PATH, model_name), config)
+
+model_manager = ModelManager(
+    load_model,
+    lambda model_name: model_size_bytes(os.path.join(MODEL_PATH, model_name)),
+    MODEL_MEMORY_BUDGET_MB * 2**20,
+)
 
 # Stream model output
-def get_RKLLM_output(history, prompt, selected_model):
-    global global_text, global_state
-    global_text = []
-    global_state = -1
-
-    model_path = os.path.join(MODEL_PATH, selected_model)
-    config = load_model_config(selected_model)
-    rkllm_model = RKLLM(model_path, config)
-
-    model_thread = threading.Thread(target=rkllm_model.run, args=(prompt,))
-    model_thread.start()
-
-    history[-1][1] = ""
-    model_thread_finished = False
-    while not model_thread_finished:
-        while len(global_text) > 0:
-            history[-1][1] += global_text.pop(0)
-            time.sleep(0.005)
-            yield history
-
-        model_thread.join(timeout=0.005)
-        model_thread_finished = not model_thread.is_alive()
-
-    rkllm_model.release()
+def get_RKLLM_output(history, prompt, selected_model, memory):
+    config = template_store.model_config(selected_model)
+    with model_manager.use(selected_model, config) as rkllm_model:
+        chat_run = ChatRun()
+        model_thread = threading.Thread(target=rkllm_model.run, args=(prompt, chat_run))
+        model_thread.start()
+
+        history[-1][1] = ""
+        try:
+            while True:
+                state, text = chat_run.queue.get()
+                if text:
+                    history[-1][1] += text
+                    yield history, memory
+                if state in FINAL_STATES:
+                    break
+        finally:
+            # The client went away: stop the run. Keep the handle reserved until the run is over.
+            if not chat_run.finished():
+                rkllm_model.abort()
+            model_thread.join()
+
+    if memory and memory[-1][1] is None:
+        memory[-1][1] = history[-1][1]
+    yield history, memory
+
+metrics_registry.gauge_func("rkllm_resident_models", "Models loaded in memory.", lambda: len(model_manager.stats()["resident_models"]))
+metrics_registry.gauge_func("rkllm_active_handles", "Loaded models serving or waiting for a request.", lambda: model_manager.stats()["active_models"])
+metrics_registry.counter_func("rkllm_model_loads_total", "Model loads.", lambda: model_manager.stats()["loads"])
+metrics_registry.counter_func("rkllm_model_evictions_total", "Models released to stay within the memory budget.", lambda: model_manager.stats()["evictions"])
+metrics_registry.counter_func("rkllm_model_load_seconds_total", "Seconds spent loading models.", lambda: model_manager.stats()["load_seconds_total"])
+metrics_registry.gauge_func("rkllm_model_load_seconds", "Seconds the last model load took.", lambda: model_manager.stats()["load_seconds_last"])
+if METRICS_PORT:
+    start_http_server(metrics_registry, METRICS_PORT)
+
+# Load the models that should be resident before the first request
+model_manager.preload([(model_name, template_store.model_config(model_name)) for model_name in PRELOAD_MODELS])
 
 # Create Gradio interface
 with gr.Blocks(title="Chat with RKLLM") as chatRKLLM:
@@ -157,11 +178,16 @@ with gr.Blocks(title="Chat with RKLLM") as chatRKLLM:
     rkllmServer = gr.Chatbot(height=600)
     msg = gr.Textbox(placeholder="Please input your question here...", label="Input")
     clear = gr.Button("Clear")
+    memory = gr.State([])  # [user_message, reply] exchanges of this browser session
+    with gr.Accordion("Model cache", open=False):
+        model_stats = gr.JSON(label="Resident models, loads and evictions")
+        refresh_stats = gr.Button("Refresh")
 
-    msg.submit(get_user_input, [msg, rkllmServer, model_dropdown], [msg, rkllmServer]).then(
-        get_RKLLM_output, [rkllmServer, msg, model_dropdown], rkllmServer
+    msg.submit(get_user_input, [msg, rkllmServer, model_dropdown, memory], [msg, rkllmServer, memory]).then(
+        get_RKLLM_output, [rkllmServer, msg, model_dropdown, memory], [rkllmServer, memory]
     )
-    clear.click(lambda: None, None, rkllmServer, queue=False)
+    clear.click(lambda: (None, []), None, [rkllmServer, memory], queue=False)
+    refresh_stats.click(model_manager.stats, None, model_stats, queue=False)
 
     chatRKLLM.queue()
     chatRKLLM.launch()
@@ -170,7 +196,8 @@ with gr.Blocks(title="Chat with RKLLM") as chatRKLLM:
 try:
     print("====================")
     print("RKLLM model inference completed, releasing RKLLM model resources...")
-    rkllm_model.release()
+    print(model_manager.stats())
+    model_manager.close()
     print("====================")
 except Exception as e:
     print(f"Error releasing RKLLM model resources: {e}")
@@ -0,0 +1,220 @@
+import ast
+import ctypes
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict
+
+IMAGE_EMBED_SUFFIX = ".npy"
+
+NPY_MAGIC = b"\x93NUMPY"
+NPY_ALIGNMENT = 64
+FLOAT32_SIZE = 4
+# RKLLMMultiModelInput.image_embed is a float*; the boards are little-endian.
+FLOAT32_DESCR = "<f4"
+
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class UnknownImage(LookupError):
+    pass
+
+
+# The offset of the data and the shape of a .npy file of float32 values. data is any buffer holding at least the
+# header (bytes, memoryview or mmap). Raises ValueError if it is not such a file.
+def parse_npy(data):
+    if bytes(data[:len(NPY_MAGIC)]) != NPY_MAGIC or len(data) < 10:
+        raise ValueError("not a .npy file")
+    major = data[6]
+    if major == 1:
+        header_len, = struct.unpack("<H", bytes(data[8:10]))
+        start = 10
+    elif major in (2, 3):
+        header_len, = struct.unpack("<I", bytes(data[8:12]))
+        start = 12
+    else:
+        raise ValueError("unsupported .npy version {}".format(major))
+    try:
+        header = ast.literal_eval(bytes(data[start:start + header_len]).decode("latin1"))
+        descr, fortran_order, shape = header["descr"], header["fortran_order"], tuple(header["shape"])
+    except (ValueError, SyntaxError, KeyError, TypeError):
+        raise ValueError("invalid .npy header")
+    if descr != FLOAT32_DESCR:
+        raise ValueError("image embeddings must be little-endian float32, not {}".format(descr))
+    if fortran_order and len(shape) > 1:
+        raise ValueError("image embeddings must be in C order")
+    return start + header_len, shape
+
+
+# The header of a version 1.0 .npy file of float32 values with the given shape, padded so that the data is aligned.
+def npy_header(shape):
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(FLOAT32_DESCR, tuple(shape))
+    padding = -(len(NPY_MAGIC) + 4 + len(header) + 1) % NPY_ALIGNMENT
+    header = (header + " " * padding + "\n").encode("latin1")
+    return NPY_MAGIC + b"\x01\x00" + struct.pack("<H", len(header)) + header
+
+
+# One embedding of the cache, mapped into memory. array is a ctypes float array over the mapping that is passed to the
+# runtime as image_embed, so the values are never copied into Python memory; the pages are those of the page cache,
+# shared by every run and every instance that uses the image.
+class ImageEmbedding(object):
+    def __init__(self, digest, path):
+        self.digest = digest
+        with open(path, "rb") as embed_file:
+            # ctypes can only wrap a writable buffer. ACCESS_COPY maps the file privately with write permission; nothing
+            # writes to it, so no page is ever copied and the file is never modified.
+            self.mapping = mmap.mmap(embed_file.fileno(), 0, access=mmap.ACCESS_COPY)
+        offset, shape = parse_npy(self.mapping)
+        self.n_tokens, self.n_embed = shape
+        self.nbytes = self.n_tokens * self.n_embed * FLOAT32_SIZE
+        if offset + self.nbytes > len(self.mapping):
+            raise ValueError("truncated image embedding file: {}".format(path))
+        self.array = (ctypes.c_float * (self.n_tokens * self.n_embed)).from_buffer(self.mapping, offset)
+
+    def describe(self):
+        return {"image_hash": self.digest, "n_image_tokens": self.n_tokens, "n_embed": self.n_embed}
+
+    def __repr__(self):
+        return "ImageEmbedding({}, {}x{})".format(self.digest[:12], self.n_tokens, self.n_embed)
+
+
+# On-disk store of image embeddings, one .npy file per embedding named after the SHA-256 of its float32 values, so a
+# client that has uploaded an image once only sends the hash afterwards. Files are evicted least recently used first
+# once the directory exceeds max_bytes or max_files. embed_dim (0 = any) is the embedding size of the model; it also
+# gives the token count of raw float32 uploads.
+class ImageEmbeddingCache(object):
+    def __init__(self, cache_dir, max_bytes=0, max_files=0, embed_dim=0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes # 0 means unlimited
+        self.max_files = max_files # 0 means unlimited
+        self.embed_dim = embed_dim
+        self.lock = threading.Lock()
+        self.files = OrderedDict() # digest -> size, least recently used first
+        self.mapped = {} # digest -> ImageEmbedding of the files mapped so far
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        # Pick up the embeddings of previous runs, oldest first.
+        os.makedirs(cache_dir, exist_ok=True)
+        existing = []
+        for name in os.listdir(cache_dir):
+            digest = name[:-len(IMAGE_EMBED_SUFFIX)]
+            if name.endswith(IMAGE_EMBED_SUFFIX) and DIGEST_PATTERN.match(digest):
+                path = os.path.join(cache_dir, name)
+                existing.append((os.path.getmtime(path), digest, os.path.getsize(path)))
+        for _, digest, size in sorted(existing):
+            self.files[digest] = size
+        with self.lock:
+            self._evict()
+
+    def path_for(self, digest):
+        return os.path.join(self.cache_dir, digest + IMAGE_EMBED_SUFFIX)
+
+    # The float32 values of an upload and their (n_tokens, n_embed) shape. data is a .npy file, or raw float32 values
+    # whose token count is n_tokens or follows from embed_dim. The values are a view of data, not a copy.
+    # Raises ValueError if data is not a valid embedding.
+    def decode(self, data, n_tokens=None):
+        data = memoryview(data).cast("B")
+        if bytes(data[:len(NPY_MAGIC)]) == NPY_MAGIC:
+            offset, shape = parse_npy(data)
+            values = data[offset:]
+            if len(shape) == 1 and self.embed_dim:
+                shape = (shape[0] // self.embed_dim, self.embed_dim)
+            if len(shape) != 2 or shape[0] * shape[1] * FLOAT32_SIZE != len(values):
+                raise ValueError("image embeddings must be a (n_image_tokens, n_embed) array, not of shape {}".format(shape))
+        else:
+            values = data
+            n_values = len(values) // FLOAT32_SIZE
+            if n_tokens is not None:
+                n_tokens = int(n_tokens)
+            elif self.embed_dim:
+                n_tokens = n_values // self.embed_dim
+            else:
+                raise ValueError("raw float32 image embeddings need n_image_tokens")
+            if n_tokens < 1 or len(values) % (n_tokens * FLOAT32_SIZE):
+                raise ValueError("{} bytes of float32 values cannot hold {} image tokens".format(len(values), n_tokens))
+            shape = (n_tokens, n_values // n_tokens)
+        if shape[0] < 1 or shape[1] < 1:
+            raise ValueError("empty image embedding")
+        if self.embed_dim and shape[1] != self.embed_dim:
+            raise ValueError("image embeddings of this model have {} values per token, not {}".format(self.embed_dim, shape[1]))
+        return values, shape
+
+    # Store an uploaded embedding (see decode) unless it is cached already, and return it mapped.
+    # Raises ValueError if data is not a valid embedding.
+    def put(self, data, n_tokens=None):
+        values, shape = self.decode(data, n_tokens)
+        digest = hashlib.sha256(values).hexdigest()
+        with self.lock:
+            if digest in self.files:
+                self.files.move_to_end(digest)
+                self.hits += 1
+                return self._open(digest)
+
+        path = self.path_for(digest)
+        temp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temp_path, "wb") as embed_file:
+            embed_file.write(npy_header(shape))
+            embed_file.write(values)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.files[digest] = os.path.getsize(path)
+            self.stores += 1
+            self._evict(keep=digest)
+            return self._open(digest)
+
+    # The cached embedding with the given SHA-256, mapped; None if it is not cached.
+    def get(self, digest):
+        if not isinstance(digest, str) or not DIGEST_PATTERN.match(digest):
+            return None
+        with self.lock:
+            if digest not in self.files:
+                self.misses += 1
+                return None
+            self.files.move_to_end(digest)
+            self.hits += 1
+            return self._open(digest)
+
+    def _open(self, digest):
+        # Called with self.lock held.
+        embedding = self.mapped.get(digest)
+        if embedding is None:
+            embedding = self.mapped[digest] = ImageEmbedding(digest, self.path_for(digest))
+        return embedding
+
+    def _evict(self, keep=None):
+        # Called with self.lock held. A run still holding an evicted embedding keeps its mapping: the pages stay valid
+        # after the file is deleted, and are freed once the last reference is gone.
+        while self.files and ((self.max_bytes and sum(self.files.values()) > self.max_bytes) or
+                              (self.max_files and len(self.files) > self.max_files)):
+            digest = next(iter(self.files))
+            if digest == keep:
+                if len(self.files) == 1:
+                    break
+                self.files.move_to_end(digest)
+                digest = next(iter(self.files))
+            del self.files[digest]
+            self.mapped.pop(digest, None)
+            self.evictions += 1
+            try:
+                os.remove(self.path_for(digest))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "files": len(self.files),
+                "mib": round(sum(self.files.values()) / 2**20, 1),
+                "mapped": len(self.mapped),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,47 @@
+import io
+
+from werkzeug.serving import WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
+
+# Seconds an idle keep-alive connection (or a client that stopped reading its response) holds its server thread.
+KEEP_ALIVE_TIMEOUT = 75
+
+
+# The request handler of the Flask development server with HTTP/1.1 keep-alive. Werkzeug sends "Connection: close"
+# with every response, because it cannot tell where the body of a request ends when the application did not read all
+# of it, and after each response it discards whatever the client sent next. Here the body of an HTTP/1.1 request with a
+# Content-Length is read through a stream of that length and the rest of it is skipped after the response, so the
+# connection stays open for the next request. Requests with a chunked body, HTTP/1.0 requests and "Connection: close"
+# are served as before.
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+    request_body = None # The body stream of the request being answered, if its connection is kept alive
+
+    def run_wsgi(self):
+        rfile = self.rfile
+        try:
+            WSGIRequestHandler.run_wsgi(self)
+        finally:
+            self.rfile = rfile
+            request_body, self.request_body = self.request_body, None
+        if request_body is not None and not self.close_connection:
+            request_body.exhaust()
+
+    def make_environ(self):
+        environ = WSGIRequestHandler.make_environ(self)
+        if self.close_connection or self.request_version != "HTTP/1.1" or "HTTP_TRANSFER_ENCODING" in environ:
+            return environ
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            return environ
+        self.request_body = environ["wsgi.input"] = LimitedStream(self.rfile, length)
+        # Werkzeug reads self.rfile after the response to discard the rest of the request; the next request is kept.
+        self.rfile = io.BytesIO()
+        return environ
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == "connection" and value.lower() == "close" and self.request_body is not None:
+            return
+        WSGIRequestHandler.send_header(self, keyword, value)
@@ -0,0 +1,73 @@
+import json
+import os
+import threading
+
+
+# One LoRA adapter file. Registering a name again creates a new LoraAdapter, so a handle can tell that the adapter it
+# loaded under that name is out of date.
+class LoraAdapter(object):
+    def __init__(self, name, path, scale=1.0):
+        self.name = name
+        self.path = path
+        self.scale = float(scale)
+
+    # Identifies the adapter file, e.g. for the prompt caches computed with the adapter applied.
+    def cache_key(self):
+        stat = os.stat(self.path)
+        return f"{self.name}:{os.path.realpath(self.path)}:{stat.st_size}:{int(stat.st_mtime)}:{self.scale}"
+
+    def describe(self):
+        return {"name": self.name, "path": self.path, "scale": self.scale}
+
+
+# The real path of an adapter file named by a client, which must lie inside directory; a relative path is taken from it.
+# Symbolic links are resolved first, so a link cannot lead out of the directory. Raises ValueError otherwise.
+def adapter_path(directory, path):
+    root = os.path.realpath(directory)
+    real = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, real]) != root:
+        raise ValueError(f"LoRA adapter files must be inside the adapter directory: {path}")
+    return real
+
+
+# The LoRA adapters a server can apply, by name. Adapters can be added, replaced and removed while the server runs; the
+# handles load them when a request first asks for them (see RKLLM.use_lora).
+class LoraRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.adapters = {}
+
+    # Read an adapter file: a JSON object mapping each name to its path or to {"path": ..., "scale": ...}.
+    @staticmethod
+    def read_config(path):
+        with open(path, "r") as config_file:
+            config = json.load(config_file)
+        adapters = []
+        for name, entry in config.items():
+            if isinstance(entry, str):
+                entry = {"path": entry}
+            adapters.append(LoraAdapter(name, entry["path"], entry.get("scale", 1.0)))
+        return adapters
+
+    # Raises ValueError if the adapter file does not exist.
+    def register(self, adapter):
+        if not os.path.exists(adapter.path):
+            raise ValueError(f"LoRA adapter file not found: {adapter.path}")
+        with self.lock:
+            self.adapters[adapter.name] = adapter
+        return adapter
+
+    def unregister(self, name):
+        with self.lock:
+            return self.adapters.pop(name, None)
+
+    def get(self, name):
+        return self.adapters.get(name)
+
+    def names(self):
+        with self.lock:
+            return sorted(self.adapters)
+
+    def describe(self):
+        with self.lock:
+            return [self.adapters[name].describe() for name in sorted(self.adapters)]
@@ -0,0 +1,212 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Content type of the Prometheus text exposition format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter(object):
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter", f"{self.name} {format_value(self.value)}"]
+
+
+class Histogram(object):
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # The last slot counts the observations above every bucket
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{format_value(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {format_value(total)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+# A gauge or counter whose value is read from func() when the metrics are scraped.
+class CallbackMetric(object):
+    def __init__(self, name, help_text, metric_type, func):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.func = func
+
+    def render(self):
+        value = self.func()
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}", f"{self.name} {format_value(value)}"]
+
+
+# A gauge with one sample per label value, read from func() as a {label value: value} dict when the metrics are scraped.
+class LabeledCallbackMetric(object):
+    def __init__(self, name, help_text, label, func):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.func = func
+
+    def render(self):
+        values = self.func()
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for label_value, value in sorted(values.items()):
+            if value is not None:
+                lines.append(f'{self.name}{{{self.label}="{label_value}"}} {format_value(value)}')
+        return lines if len(lines) > 2 else []
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self.register(Counter(name, help_text))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def gauge_func(self, name, help_text, func):
+        return self.register(CallbackMetric(name, help_text, "gauge", func))
+
+    def counter_func(self, name, help_text, func):
+        return self.register(CallbackMetric(name, help_text, "counter", func))
+
+    def labeled_gauge_func(self, name, help_text, label, func):
+        return self.register(LabeledCallbackMetric(name, help_text, label, func))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of the generations run on the RKLLM handles of one process. They are fed by RunTimer from the runtime
+# callback, so they measure the runtime itself and not the HTTP layer.
+class RunMetrics(object):
+    def __init__(self, registry, num_instances=1):
+        self.started = time.monotonic()
+        self.num_instances = num_instances
+        self.ttft = registry.histogram("rkllm_time_to_first_token_seconds", "Time from rkllm_run to the first generated token.")
+        self.itl = registry.histogram("rkllm_inter_token_latency_seconds", "Time between two consecutive generated tokens.")
+        self.prefill_rate = registry.histogram("rkllm_prefill_tokens_per_second", "Prompt tokens prefilled per second (only for prompts with a known token count).", RATE_BUCKETS)
+        self.decode_rate = registry.histogram("rkllm_decode_tokens_per_second", "Tokens generated per second after the first token.", RATE_BUCKETS)
+        self.tokens = registry.counter("rkllm_generated_tokens_total", "Tokens generated by the runtime.")
+        self.runs = registry.counter("rkllm_runs_total", "Finished generations, including aborted ones.")
+        self.errors = registry.counter("rkllm_run_errors_total", "Generations that ended with RKLLM_RUN_ERROR.")
+        self.busy = registry.counter("rkllm_npu_busy_seconds_total", "Seconds the RKLLM handles spent running a generation.")
+        registry.gauge_func("rkllm_npu_busy_ratio", "Share of the time the RKLLM handles were running since the server started.", self.busy_ratio)
+
+    def busy_ratio(self):
+        elapsed = (time.monotonic() - self.started) * max(1, self.num_instances)
+        return min(1.0, self.busy.value / elapsed) if elapsed > 0 else 0.0
+
+
+# Timing of one generation. start() is called by the RKLLM wrapper right before the run is submitted; token() and
+# finish() are called from the runtime callback.
+class RunTimer(object):
+    def __init__(self, run_metrics, prompt_tokens=None):
+        self.run_metrics = run_metrics
+        self.prompt_tokens = prompt_tokens
+        self.start_time = None
+        self.first_token_time = None
+        self.last_token_time = None
+        self.n_tokens = 0
+        self.finished = False
+
+    def start(self):
+        self.start_time = time.monotonic()
+
+    def token(self):
+        now = time.monotonic()
+        if self.last_token_time is None:
+            self.first_token_time = now
+            self.run_metrics.ttft.observe(now - self.start_time)
+        else:
+            self.run_metrics.itl.observe(now - self.last_token_time)
+        self.last_token_time = now
+        self.n_tokens += 1
+        self.run_metrics.tokens.inc()
+
+    def finish(self, error=False):
+        if self.finished or self.start_time is None:
+            return
+        self.finished = True
+        now = time.monotonic()
+        self.run_metrics.runs.inc()
+        if error:
+            self.run_metrics.errors.inc()
+        self.run_metrics.busy.inc(now - self.start_time)
+        if self.first_token_time is not None:
+            prefill_seconds = self.first_token_time - self.start_time
+            if self.prompt_tokens and prefill_seconds > 0:
+                self.run_metrics.prefill_rate.observe(self.prompt_tokens / prefill_seconds)
+            decode_seconds = self.last_token_time - self.first_token_time
+            if self.n_tokens > 1 and decode_seconds > 0:
+                self.run_metrics.decode_rate.observe((self.n_tokens - 1) / decode_seconds)
+
+
+# Serve registry.render() at http://host:port/metrics from a background thread, for servers without their own HTTP routes.
+def start_http_server(registry, port, host="0.0.0.0"):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
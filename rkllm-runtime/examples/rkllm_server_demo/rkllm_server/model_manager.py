@@ -0,0 +1,157 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+# Approximate the memory a model needs by the size of its files on disk.
+def model_size_bytes(model_path):
+    if os.path.isdir(model_path):
+        total = 0
+        for root, _, files in os.walk(model_path):
+            for name in files:
+                total += os.path.getsize(os.path.join(root, name))
+        return total
+    if os.path.exists(model_path):
+        return os.path.getsize(model_path)
+    return 0
+
+
+class ModelEntry(object):
+    def __init__(self, key, model, size):
+        self.key = key
+        self.model = model
+        self.size = size
+        self.lock = threading.Lock() # Serializes runs on this handle
+        self.users = 0 # Requests holding or waiting for this handle; such entries are never evicted
+
+
+# Keep loaded RKLLM handles resident, keyed by model name and config.
+# When loading a model would exceed memory_budget bytes, the least recently used idle models are released first.
+# loader(model_name, config) must return an object with a release() method; size_of(model_name) its size in bytes.
+class ModelManager(object):
+    def __init__(self, loader, size_of, memory_budget=0):
+        self.loader = loader
+        self.size_of = size_of
+        self.memory_budget = memory_budget # 0 means unlimited
+        self.entries = OrderedDict() # Least recently used first
+        self.lock = threading.Lock()
+        self.loading = {} # key -> Event set when a concurrent load of that key has finished
+
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+        self.evict_seconds = 0.0
+        self.last_load_seconds = 0.0
+
+    @staticmethod
+    def make_key(model_name, config):
+        return (model_name, json.dumps(config, sort_keys=True))
+
+    def resident_bytes(self):
+        return sum(entry.size for entry in self.entries.values())
+
+    def _evict_for(self, size):
+        # Called with self.lock held; returns the entries to release outside of the lock.
+        evicted = []
+        if self.memory_budget <= 0:
+            return evicted
+        for key, entry in list(self.entries.items()):
+            if self.resident_bytes() + size <= self.memory_budget:
+                break
+            if entry.users == 0:
+                del self.entries[key]
+                evicted.append(entry)
+        return evicted
+
+    def _release(self, entries):
+        for entry in entries:
+            start = time.monotonic()
+            entry.model.release()
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.evictions += 1
+                self.evict_seconds += elapsed
+            print(f"Evicted model {entry.key[0]} ({entry.size / 2**20:.0f} MiB) in {elapsed:.2f}s")
+
+    def _acquire_entry(self, model_name, config):
+        key = self.make_key(model_name, config)
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    entry.users += 1
+                    self.hits += 1
+                    return entry
+                pending = self.loading.get(key)
+                if pending is None:
+                    pending = self.loading[key] = threading.Event()
+                    size = self.size_of(model_name)
+                    evicted = self._evict_for(size)
+                    over_budget = self.memory_budget > 0 and self.resident_bytes() + size > self.memory_budget
+                    break
+            # Another request is loading the same model; wait for it instead of loading a second copy.
+            pending.wait()
+
+        try:
+            self._release(evicted)
+            if over_budget:
+                print(f"Warning: loading {model_name} exceeds the memory budget, all resident models are in use.")
+            start = time.monotonic()
+            model = self.loader(model_name, config)
+            elapsed = time.monotonic() - start
+            with self.lock:
+                entry = ModelEntry(key, model, size)
+                entry.users += 1
+                self.entries[key] = entry
+                self.loads += 1
+                self.load_seconds += elapsed
+                self.last_load_seconds = elapsed
+            print(f"Loaded model {model_name} ({size / 2**20:.0f} MiB) in {elapsed:.2f}s")
+            return entry
+        finally:
+            with self.lock:
+                del self.loading[key]
+            pending.set()
+
+    # Context manager handing out the handle for (model_name, config) with exclusive access for the duration.
+    @contextlib.contextmanager
+    def use(self, model_name, config):
+        entry = self._acquire_entry(model_name, config)
+        try:
+            with entry.lock:
+                yield entry.model
+        finally:
+            with self.lock:
+                entry.users -= 1
+
+    def preload(self, models):
+        for model_name, config in models:
+            with self.use(model_name, config):
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "resident_models": [key[0] for key in self.entries],
+                "resident_mib": round(self.resident_bytes() / 2**20, 1),
+                "active_models": sum(1 for entry in self.entries.values() if entry.users > 0),
+                "memory_budget_mib": round(self.memory_budget / 2**20, 1),
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "load_seconds_total": round(self.load_seconds, 3),
+                "load_seconds_last": round(self.last_load_seconds, 3),
+                "evict_seconds_total": round(self.evict_seconds, 3),
+            }
+
+    def close(self):
+        with self.lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+        for entry in entries:
+            entry.model.release()
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+PROMPT_CACHE_SUFFIX = ".rkllm_cache"
+
+
+# On-disk store of RKLLM prompt caches, one file per (model, prompt prefix).
+# Files are evicted least recently used first once the directory exceeds max_bytes or max_files.
+class PromptCacheStore(object):
+    def __init__(self, cache_dir, max_bytes=0, max_files=0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes # 0 means unlimited
+        self.max_files = max_files # 0 means unlimited
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.files = OrderedDict() # path -> size, least recently used first
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Pick up the caches of previous runs, oldest first.
+        os.makedirs(cache_dir, exist_ok=True)
+        existing = []
+        for name in os.listdir(cache_dir):
+            if name.endswith(PROMPT_CACHE_SUFFIX):
+                path = os.path.join(cache_dir, name)
+                existing.append((os.path.getmtime(path), path, os.path.getsize(path)))
+        for _, path, size in sorted(existing):
+            self.files[path] = size
+        with self.lock:
+            self._evict()
+
+    @staticmethod
+    def model_key(model_path):
+        # A rebuilt model file invalidates its caches.
+        stat = os.stat(model_path)
+        return f"{os.path.realpath(model_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+    def path_for(self, model_key, prefix):
+        digest = hashlib.sha256((model_key + "\0" + prefix).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + PROMPT_CACHE_SUFFIX)
+
+    # Return the cache file for prefix, calling build(path) to create it on a miss.
+    # Returns None if build did not produce a file.
+    def get_or_create(self, model_key, prefix, build):
+        path = self.path_for(model_key, prefix)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(path, threading.Lock())
+
+        # Only one request builds a given cache; the others wait and then hit.
+        with key_lock:
+            with self.lock:
+                if path in self.files and os.path.exists(path):
+                    self.files.move_to_end(path)
+                    self.hits += 1
+                    hit = True
+                else:
+                    self.files.pop(path, None)
+                    self.misses += 1
+                    hit = False
+            if hit:
+                os.utime(path)
+                return path
+
+            build(path)
+            if not os.path.exists(path):
+                return None
+            with self.lock:
+                self.files[path] = os.path.getsize(path)
+                self._evict(keep=path)
+            return path
+
+    def _evict(self, keep=None):
+        # Called with self.lock held.
+        while self.files and ((self.max_bytes and sum(self.files.values()) > self.max_bytes) or
+                              (self.max_files and len(self.files) > self.max_files)):
+            path = next(iter(self.files))
+            if path == keep:
+                if len(self.files) == 1:
+                    break
+                self.files.move_to_end(path)
+                path = next(iter(self.files))
+            del self.files[path]
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "files": len(self.files),
+                "mib": round(sum(self.files.values()) / 2**20, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,194 @@
+import json
+import os
+import sys
+import threading
+
+SYSTEM_PROMPT_PLACEHOLDER = "{{system_prompt}}"
+
+# Rendered prefixes / token ids kept per template; the cache is cleared when it is full.
+MAX_CACHED_PREFIXES = 64
+
+
+# OpenAI message content is either a string or a list of parts, of which only the text parts are used.
+def message_text(message):
+    content = message.get('content') or ""
+    if isinstance(content, list):
+        return "".join(part.get('text', "") for part in content if part.get('type') == 'text')
+    return content
+
+
+# The PROMPT_TEXT_PREFIX / PROMPT_TEXT_POSTFIX / PROMPT_TEXT_TURN_SEPARATOR template of a model, split around the
+# {{system_prompt}} placeholder once so that rendering a request only joins the user text with prebuilt strings.
+class PromptTemplate(object):
+    def __init__(self, prefix, postfix, separator="", system_prompt=""):
+        self.prefix_head, placeholder, self.prefix_tail = prefix.partition(SYSTEM_PROMPT_PLACEHOLDER)
+        self.has_placeholder = bool(placeholder)
+        self.postfix = postfix
+        self.separator = separator
+        self.system_prompt = system_prompt
+        self.default_prefix = self._render_prefix(system_prompt)
+        self.prefixes = {system_prompt: self.default_prefix}
+        self.token_ids = {}
+
+    # Build a template from a (family or model) entry of model_config.json; missing keys take the given defaults.
+    @classmethod
+    def from_config(cls, config, prefix="", postfix="", separator="", system_prompt=""):
+        return cls(config.get("PROMPT_TEXT_PREFIX", prefix), config.get("PROMPT_TEXT_POSTFIX", postfix),
+                   config.get("PROMPT_TEXT_TURN_SEPARATOR", separator), config.get("system_prompt", system_prompt))
+
+    def _render_prefix(self, system_prompt):
+        if not self.has_placeholder:
+            return self.prefix_head
+        return self.prefix_head + system_prompt + self.prefix_tail
+
+    def prefix(self, system_prompt=None):
+        if system_prompt is None:
+            return self.default_prefix
+        prefix = self.prefixes.get(system_prompt)
+        if prefix is None:
+            if len(self.prefixes) >= MAX_CACHED_PREFIXES:
+                self.prefixes = {self.system_prompt: self.default_prefix}
+            prefix = self.prefixes[system_prompt] = self._render_prefix(system_prompt)
+        return prefix
+
+    # The text after the prefix: one user message and the postfix opening the reply.
+    def body(self, content):
+        return content + self.postfix
+
+    def render(self, content, system_prompt=None):
+        return "".join((self.prefix(system_prompt), content, self.postfix))
+
+    # The prompt of a conversation of finished (user_message, reply) exchanges followed by user_message.
+    def render_history(self, history, user_message, system_prompt=None):
+        parts = [self.prefix(system_prompt)]
+        for previous_message, reply in history:
+            if reply is not None: # Skip an exchange whose reply never arrived
+                parts += (previous_message, self.postfix, reply, self.separator)
+        parts += (user_message, self.postfix)
+        return "".join(parts)
+
+    # Render OpenAI-style messages as one conversation: system messages replace the system prompt, earlier user and
+    # assistant messages are joined with the turn separator. Returns (system_prompt, content) where content ends with
+    # the last user message, or None if the conversation does not end with a user message.
+    def conversation(self, messages):
+        system_prompt = self.system_prompt
+        parts = []
+        last_role = None
+        for message in messages:
+            role = message.get('role')
+            if role == 'system':
+                system_prompt = message_text(message)
+                continue
+            if role == 'assistant':
+                parts += (self.postfix, message_text(message), self.separator)
+            else:
+                parts.append(message_text(message))
+            last_role = role
+        if last_role != 'user':
+            return None
+        return system_prompt, "".join(parts)
+
+    def _static_ids(self, tokenizer, text):
+        key = (id(tokenizer), text)
+        ids = self.token_ids.get(key)
+        if ids is None:
+            if len(self.token_ids) >= MAX_CACHED_PREFIXES:
+                self.token_ids = {}
+            ids = self.token_ids[key] = tokenizer.encode(text, add_special_tokens=False)
+        return ids
+
+    # Token ids of a rendered prompt as (prefix ids, body ids). The prefix and postfix are encoded once and cached, only
+    # the content is encoded per request. The pieces are encoded separately, so the ids can differ from encoding the
+    # whole string only where a token would span a piece boundary.
+    def encode(self, tokenizer, content, system_prompt=None):
+        body_ids = tokenizer.encode(content, add_special_tokens=False) + self._static_ids(tokenizer, self.postfix)
+        return self._static_ids(tokenizer, self.prefix(system_prompt)), body_ids
+
+
+# One parsed model_config.json: the family and model entries with family inheritance resolved and their templates
+# compiled. Never modified after construction, so readers need no lock.
+class ModelConfigs(object):
+    def __init__(self, configs, **template_defaults):
+        families = configs.get("families", {})
+        self.families = {}
+        for name, family_config in families.items():
+            self.families[name] = (family_config, PromptTemplate.from_config(family_config, **template_defaults))
+        self.models = {}
+        for name, model_config in configs.get("models", {}).items():
+            # Inherit family-level defaults
+            resolved = dict(families.get(model_config.get("family"), {}))
+            resolved.update(model_config)
+            self.models[name] = (resolved, PromptTemplate.from_config(resolved, **template_defaults))
+
+
+# model_config.json, loaded once and reloaded in the background when the file changes.
+# Lookups only read the current ModelConfigs; a file that fails to parse, or no longer defines one of
+# required_families, keeps the previous configuration.
+class TemplateStore(object):
+    def __init__(self, config_path, poll_interval=2.0, required_families=(), **template_defaults):
+        self.config_path = config_path
+        self.poll_interval = poll_interval # 0 disables watching
+        self.required_families = required_families
+        self.template_defaults = template_defaults
+        self.empty_template = PromptTemplate.from_config({}, **template_defaults)
+        self.configs = ModelConfigs({}, **template_defaults)
+        self.mtime = None
+        self.reloads = 0
+        self.reload()
+        if poll_interval > 0:
+            threading.Thread(target=self._watch, daemon=True).start()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    # Parse the file again; returns False if it is missing or invalid.
+    # required_families is only enforced on a reload, the first load reports what the file defines.
+    def reload(self):
+        mtime = self._stat()
+        self.mtime = mtime
+        if mtime is None:
+            return False
+        try:
+            with open(self.config_path, "r") as config_file:
+                configs = ModelConfigs(json.load(config_file), **self.template_defaults)
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Error loading {self.config_path}: {e}")
+            sys.stdout.flush()
+            return False
+        missing = [name for name in self.required_families if name not in configs.families]
+        if missing and self.reloads:
+            print(f"Error loading {self.config_path}: family {'/'.join(missing)} is not defined")
+            sys.stdout.flush()
+            return False
+        self.configs = configs
+        self.reloads += 1
+        return True
+
+    def _watch(self):
+        stop = threading.Event()
+        while not stop.wait(self.poll_interval):
+            if self._stat() != self.mtime:
+                if self.reload():
+                    print(f"Reloaded {self.config_path}")
+                    sys.stdout.flush()
+
+    def family_names(self):
+        return list(self.configs.families)
+
+    def family_config(self, name):
+        return self.configs.families.get(name, ({}, None))[0]
+
+    # The template of a family, or None if the family is not defined.
+    def family_template(self, name):
+        return self.configs.families.get(name, (None, None))[1]
+
+    # The configuration of a model with its family defaults applied ({} for an unknown model).
+    def model_config(self, name):
+        return self.configs.models.get(name, ({}, None))[0]
+
+    def model_template(self, name):
+        return self.configs.models.get(name, (None, self.empty_template))[1]
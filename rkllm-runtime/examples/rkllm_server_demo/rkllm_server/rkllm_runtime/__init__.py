@@ -0,0 +1,55 @@
+# Python binding of the RKLLM runtime API (rkllm.h), shared by the RKLLM servers.
+# librkllmrt.so is loaded on first use from the path given to configure(), RKLLM_LIB_PATH or lib/librkllmrt.so.
+
+from .structs import (
+    RKLLM_Handle_t,
+    LLMCallState,
+    RKLLMInputMode,
+    RKLLMInferMode,
+    RKLLMExtendParam,
+    RKLLMParam,
+    RKLLMLoraAdapter,
+    RKLLMEmbedInput,
+    RKLLMTokenInput,
+    RKLLMMultiModelInput,
+    RKLLMInputUnion,
+    RKLLMInput,
+    RKLLMLoraParam,
+    RKLLMPromptCacheParam,
+    RKLLMInferParam,
+    RKLLMResultLastHiddenLayer,
+    RKLLMResult,
+    callback_type,
+)
+from .library import LIB_PATH_ENV, DEFAULT_LIB_PATH, Library, configure, library_path, load_library
+from .handle import RKLLMError, RKLLMHandle, default_param
+
+__all__ = [
+    "RKLLM_Handle_t",
+    "LLMCallState",
+    "RKLLMInputMode",
+    "RKLLMInferMode",
+    "RKLLMExtendParam",
+    "RKLLMParam",
+    "RKLLMLoraAdapter",
+    "RKLLMEmbedInput",
+    "RKLLMTokenInput",
+    "RKLLMMultiModelInput",
+    "RKLLMInputUnion",
+    "RKLLMInput",
+    "RKLLMLoraParam",
+    "RKLLMPromptCacheParam",
+    "RKLLMInferParam",
+    "RKLLMResultLastHiddenLayer",
+    "RKLLMResult",
+    "callback_type",
+    "LIB_PATH_ENV",
+    "DEFAULT_LIB_PATH",
+    "Library",
+    "configure",
+    "library_path",
+    "load_library",
+    "RKLLMError",
+    "RKLLMHandle",
+    "default_param",
+]
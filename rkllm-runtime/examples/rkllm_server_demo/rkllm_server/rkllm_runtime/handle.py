@@ -0,0 +1,128 @@
+import ctypes
+
+from .library import load_library
+from .structs import (RKLLM_Handle_t, RKLLMLoraAdapter, RKLLMInput, RKLLMInputMode, RKLLMInferMode, RKLLMInferParam,
+                      RKLLMLoraParam, RKLLMPromptCacheParam)
+
+
+class RKLLMError(Exception):
+    pass
+
+
+# An RKLLMParam filled with the runtime defaults of rkllm_createDefaultParam(), then with the given fields.
+# base_domain_id is a field of extend_param; strings are encoded to UTF-8.
+def default_param(model_path, lib_path=None, base_domain_id=0, **fields):
+    param = load_library(lib_path).rkllm_createDefaultParam()
+    param.model_path = model_path.encode('utf-8')
+    param.img_start = b""
+    param.img_end = b""
+    param.img_content = b""
+    param.extend_param.base_domain_id = base_domain_id
+    for name, value in fields.items():
+        setattr(param, name, value.encode('utf-8') if isinstance(value, str) else value)
+    return param
+
+
+# One model instance of the runtime (LLMHandle).
+# The RKLLMInput and RKLLMInferParam structs are allocated once and refilled for every run. Runs on one handle never
+# overlap, and the runtime may read the inputs of rkllm_run_async after it has returned, so the buffers of a run stay
+# referenced until the next run starts.
+class RKLLMHandle(object):
+    def __init__(self, param, callback, lib_path=None):
+        self.lib = load_library(lib_path)
+        self.param = param
+        self.callback = callback # Must stay referenced as long as the runtime may call it
+        self.handle = RKLLM_Handle_t()
+        ret = self.lib.rkllm_init(ctypes.byref(self.handle), ctypes.byref(param), callback)
+        if ret != 0:
+            raise RKLLMError(f"rkllm_init failed for {param.model_path.decode('utf-8')} ({ret})")
+
+        self.rkllm_input = RKLLMInput()
+        self.infer_params = RKLLMInferParam()
+        self.lora_params = RKLLMLoraParam()
+        self.prompt_cache_params = RKLLMPromptCacheParam()
+        self.lora_params_pointer = ctypes.pointer(self.lora_params)
+        self.prompt_cache_params_pointer = ctypes.pointer(self.prompt_cache_params)
+        self.run_buffers = None
+
+    def load_lora(self, lora_adapter_path, lora_adapter_name, scale=1.0):
+        lora_adapter = RKLLMLoraAdapter()
+        lora_adapter.lora_adapter_path = lora_adapter_path.encode('utf-8')
+        lora_adapter.lora_adapter_name = lora_adapter_name.encode('utf-8')
+        lora_adapter.scale = scale
+        return self.lib.rkllm_load_lora(self.handle, ctypes.byref(lora_adapter))
+
+    def load_prompt_cache(self, prompt_cache_path):
+        return self.lib.rkllm_load_prompt_cache(self.handle, prompt_cache_path.encode('utf-8'))
+
+    def release_prompt_cache(self):
+        return self.lib.rkllm_release_prompt_cache(self.handle)
+
+    # Fill the preallocated input structs for one run. Exactly one of prompt or input_ids is used. With image_embed (a
+    # ctypes float array of n_image_tokens embeddings, or a pointer to one) the prompt is a multimodal input; the array
+    # is passed to the runtime as it is, without a copy.
+    def _prepare(self, prompt, input_ids, infer_mode, lora_adapter_name, save_prompt_cache_path, image_embed=None,
+                 n_image_tokens=0):
+        rkllm_input = self.rkllm_input
+        buffers = []
+        if image_embed is not None:
+            prompt_bytes = prompt.encode('utf-8')
+            buffers.extend((prompt_bytes, image_embed))
+            rkllm_input.input_mode = RKLLMInputMode.RKLLM_INPUT_MULTIMODAL
+            rkllm_input.input_data.multimodal_input.prompt = prompt_bytes
+            rkllm_input.input_data.multimodal_input.image_embed = ctypes.cast(image_embed, ctypes.POINTER(ctypes.c_float))
+            rkllm_input.input_data.multimodal_input.n_image_tokens = n_image_tokens
+        elif input_ids is not None:
+            token_ids = (ctypes.c_int32 * len(input_ids))(*input_ids)
+            buffers.append(token_ids)
+            rkllm_input.input_mode = RKLLMInputMode.RKLLM_INPUT_TOKEN
+            rkllm_input.input_data.token_input.input_ids = token_ids
+            rkllm_input.input_data.token_input.n_tokens = len(input_ids)
+        else:
+            prompt_bytes = prompt.encode('utf-8')
+            buffers.append(prompt_bytes)
+            rkllm_input.input_mode = RKLLMInputMode.RKLLM_INPUT_PROMPT
+            rkllm_input.input_data.prompt_input = prompt_bytes
+
+        infer_params = self.infer_params
+        infer_params.mode = infer_mode
+        if lora_adapter_name:
+            name_bytes = lora_adapter_name.encode('utf-8')
+            buffers.append(name_bytes)
+            self.lora_params.lora_adapter_name = name_bytes
+            infer_params.lora_params = self.lora_params_pointer
+        else:
+            infer_params.lora_params = None
+        if save_prompt_cache_path:
+            path_bytes = save_prompt_cache_path.encode('utf-8')
+            buffers.append(path_bytes)
+            self.prompt_cache_params.save_prompt_cache = 1
+            self.prompt_cache_params.prompt_cache_path = path_bytes
+            infer_params.prompt_cache_params = self.prompt_cache_params_pointer
+        else:
+            infer_params.prompt_cache_params = None
+        self.run_buffers = buffers
+
+    # Run to completion; the callback is invoked on the calling thread.
+    def run(self, prompt=None, userdata=None, input_ids=None, infer_mode=RKLLMInferMode.RKLLM_INFER_GENERATE,
+            lora_adapter_name=None, save_prompt_cache_path=None, image_embed=None, n_image_tokens=0):
+        self._prepare(prompt, input_ids, infer_mode, lora_adapter_name, save_prompt_cache_path, image_embed, n_image_tokens)
+        return self.lib.rkllm_run(self.handle, ctypes.byref(self.rkllm_input), ctypes.byref(self.infer_params), userdata)
+
+    # Start the run and return at once; the callback is invoked from a runtime thread.
+    def run_async(self, prompt=None, userdata=None, input_ids=None, infer_mode=RKLLMInferMode.RKLLM_INFER_GENERATE,
+                  lora_adapter_name=None, save_prompt_cache_path=None, image_embed=None, n_image_tokens=0):
+        self._prepare(prompt, input_ids, infer_mode, lora_adapter_name, save_prompt_cache_path, image_embed, n_image_tokens)
+        return self.lib.rkllm_run_async(self.handle, ctypes.byref(self.rkllm_input), ctypes.byref(self.infer_params), userdata)
+
+    def abort(self):
+        return self.lib.rkllm_abort(self.handle)
+
+    # rkllm_is_running returns 0 while a run is in progress.
+    def is_running(self):
+        return self.lib.rkllm_is_running(self.handle) == 0
+
+    def destroy(self):
+        if self.handle:
+            self.lib.rkllm_destroy(self.handle)
+            self.handle = RKLLM_Handle_t()
@@ -0,0 +1,59 @@
+import ctypes
+import os
+import threading
+
+from .structs import (RKLLM_Handle_t, RKLLMParam, RKLLMLoraAdapter, RKLLMInput, RKLLMInferParam, callback_type)
+
+# Environment variable overriding the location of librkllmrt.so.
+LIB_PATH_ENV = "RKLLM_LIB_PATH"
+DEFAULT_LIB_PATH = "lib/librkllmrt.so"
+
+# Signature of every function of rkllm.h: name -> (restype, argtypes).
+PROTOTYPES = {
+    "rkllm_createDefaultParam": (RKLLMParam, []),
+    "rkllm_init": (ctypes.c_int, [ctypes.POINTER(RKLLM_Handle_t), ctypes.POINTER(RKLLMParam), callback_type]),
+    "rkllm_load_lora": (ctypes.c_int, [RKLLM_Handle_t, ctypes.POINTER(RKLLMLoraAdapter)]),
+    "rkllm_load_prompt_cache": (ctypes.c_int, [RKLLM_Handle_t, ctypes.c_char_p]),
+    "rkllm_release_prompt_cache": (ctypes.c_int, [RKLLM_Handle_t]),
+    "rkllm_destroy": (ctypes.c_int, [RKLLM_Handle_t]),
+    "rkllm_run": (ctypes.c_int, [RKLLM_Handle_t, ctypes.POINTER(RKLLMInput), ctypes.POINTER(RKLLMInferParam), ctypes.c_void_p]),
+    "rkllm_run_async": (ctypes.c_int, [RKLLM_Handle_t, ctypes.POINTER(RKLLMInput), ctypes.POINTER(RKLLMInferParam), ctypes.c_void_p]),
+    "rkllm_abort": (ctypes.c_int, [RKLLM_Handle_t]),
+    "rkllm_is_running": (ctypes.c_int, [RKLLM_Handle_t]),
+}
+
+_configured_path = None
+_libraries = {}
+_lock = threading.Lock()
+
+
+# Set the library path used when no path is passed to load_library(); takes precedence over RKLLM_LIB_PATH.
+def configure(lib_path):
+    global _configured_path
+    _configured_path = lib_path
+
+
+def library_path(lib_path=None):
+    return lib_path or _configured_path or os.environ.get(LIB_PATH_ENV) or DEFAULT_LIB_PATH
+
+
+# librkllmrt.so with the prototypes of rkllm.h set on every function.
+class Library(object):
+    def __init__(self, path):
+        self.path = path
+        self.cdll = ctypes.CDLL(path)
+        for name, (restype, argtypes) in PROTOTYPES.items():
+            function = getattr(self.cdll, name)
+            function.restype = restype
+            function.argtypes = argtypes
+            setattr(self, name, function)
+
+
+# Load the library on first use and return the same Library for the same path afterwards.
+def load_library(lib_path=None):
+    path = os.path.abspath(library_path(lib_path))
+    with _lock:
+        library = _libraries.get(path)
+        if library is None:
+            library = _libraries[path] = Library(path)
+        return library
@@ -0,0 +1,88 @@
+import itertools
+import sys
+import threading
+from abc import ABC, abstractmethod
+
+from rkllm_runtime import LLMCallState
+from token_decoder import TokenDecoder
+
+FINAL_STATES = (LLMCallState.RKLLM_RUN_FINISH, LLMCallState.RKLLM_RUN_ERROR)
+
+
+# The state of one rkllm_run call: its decoder, timer, token count and hidden-state buffer. The runtime callback finds
+# it through the run id passed as userdata, so runs on different handles never share state.
+# Subclasses implement put() to hand the output to their consumer (a thread queue, an event loop, ...).
+class RunContext(ABC):
+    def __init__(self):
+        self.run_id = None # Set by RunContextRegistry.register
+        self.state = -1
+        self.n_tokens = 0 # Number of tokens generated so far, counted per callback
+        self.decoder = TokenDecoder() # Holds back multi-byte characters split over several tokens
+        self.timer = None # RunTimer of the run, set when the run starts
+        self.hidden_states = None # HiddenStateBuffer receiving the last hidden layer in RKLLM_INFER_GET_LAST_HIDDEN_LAYER mode
+
+    # Hand the state of a callback and its decoded text (if any) to the consumer; called from the callback thread.
+    @abstractmethod
+    def put(self, state, text=None):
+        pass
+
+    def finished(self):
+        return self.state in FINAL_STATES
+
+    # Process one callback of the run. Returns the text handed to the consumer, if any.
+    def handle(self, result, state):
+        if state == LLMCallState.RKLLM_RUN_FINISH:
+            if self.timer is not None:
+                self.timer.finish()
+            text = self.decoder.flush()
+            if text:
+                self.put(LLMCallState.RKLLM_RUN_NORMAL, text)
+            self.put(state)
+            return text
+        if state == LLMCallState.RKLLM_RUN_ERROR:
+            if self.timer is not None:
+                self.timer.finish(error=True)
+            self.put(state)
+            return None
+        if state == LLMCallState.RKLLM_RUN_GET_LAST_HIDDEN_LAYER:
+            # The hidden layer must be copied during this callback; the runtime releases it afterwards.
+            if self.hidden_states is None or not self.hidden_states.copy_from(result.contents.last_hidden_layer):
+                print("Invalid hidden layer data.")
+                sys.stdout.flush()
+                self.put(LLMCallState.RKLLM_RUN_ERROR)
+                return None
+            self.put(state)
+            return None
+        self.n_tokens += 1
+        if self.timer is not None:
+            self.timer.token()
+        text = self.decoder.decode(result.contents.text)
+        if text:
+            self.put(state, text)
+        return text
+
+
+# Run id -> RunContext of every run in progress. Ids are never reused, so a late callback of a finished run finds
+# nothing instead of the context of a newer run. Lookups from the callback thread take no lock.
+class RunContextRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.run_ids = itertools.count(1) # 0 would be passed to the runtime as a NULL userdata
+        self.contexts = {}
+
+    def register(self, context):
+        with self.lock:
+            run_id = next(self.run_ids)
+            self.contexts[run_id] = context
+        context.run_id = run_id
+        return run_id
+
+    def get(self, run_id):
+        return self.contexts.get(run_id)
+
+    def unregister(self, run_id):
+        with self.lock:
+            return self.contexts.pop(run_id, None)
+
+    def __len__(self):
+        return len(self.contexts)
@@ -0,0 +1,73 @@
+# Sampling fields of RKLLMParam that a request may set, with their types and the values the servers used so far.
+SAMPLING_DEFAULTS = (
+    ("top_k", int, 1),
+    ("top_p", float, 0.9),
+    ("temperature", float, 0.8),
+    ("repeat_penalty", float, 1.1),
+    ("frequency_penalty", float, 0.0),
+    ("presence_penalty", float, 0.0),
+    ("mirostat", int, 0),
+    ("mirostat_tau", float, 5.0),
+    ("mirostat_eta", float, 0.1),
+)
+
+# Float fields are rounded to this many decimals, so that requests asking for 0.7 and 0.7000001 use the same handle.
+SAMPLING_DECIMALS = 2
+
+
+# The sampling configuration of an RKLLM handle. The runtime reads these values only in rkllm_init, so every distinct
+# configuration is a separately initialized handle; key identifies it. Instances are never modified.
+class SamplingParams(object):
+    def __init__(self, **values):
+        resolved = []
+        for name, field_type, default in SAMPLING_DEFAULTS:
+            try:
+                value = field_type(values.pop(name, default))
+            except (TypeError, ValueError):
+                raise ValueError("{} must be a number".format(name))
+            if field_type is float:
+                value = round(value, SAMPLING_DECIMALS)
+            resolved.append((name, value))
+        if values:
+            raise ValueError("Unknown sampling parameter: {}".format(", ".join(sorted(values))))
+        self.values = dict(resolved)
+        self.key = tuple(resolved)
+        self._check()
+
+    def _check(self):
+        if self.values["top_k"] < 1:
+            raise ValueError("top_k must be at least 1")
+        if not 0.0 < self.values["top_p"] <= 1.0:
+            raise ValueError("top_p must be in (0, 1]")
+        if self.values["temperature"] < 0.0:
+            raise ValueError("temperature must not be negative")
+        if self.values["mirostat"] not in (0, 1, 2):
+            raise ValueError("mirostat must be 0, 1 or 2")
+
+    # The parameters of a request: the sampling fields present in data override self. Raises ValueError on a value of
+    # the wrong type or range. OpenAI's temperature 0 means greedy decoding and is mapped to top_k 1.
+    def with_request(self, data):
+        values = dict(self.values)
+        for name, _, _ in SAMPLING_DEFAULTS:
+            if data.get(name) is not None:
+                values[name] = data[name]
+        if values["temperature"] in (0, 0.0):
+            values["top_k"] = 1
+        return SamplingParams(**values)
+
+    # With top_k 1 the runtime always picks the most likely token, so identical prompts give identical output.
+    @property
+    def greedy(self):
+        return self.values["top_k"] == 1 and self.values["mirostat"] == 0
+
+    def __eq__(self, other):
+        return isinstance(other, SamplingParams) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return "SamplingParams({})".format(", ".join("{}={!r}".format(name, value) for name, value in self.key))
@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+SESSION_CACHE_SUFFIX = ".rkllm_session"
+
+
+# A multi-turn conversation.
+# context_text is the prompt text of every finished turn (prefix, messages and replies); cache_path, if set, is a
+# prompt cache holding the KV state of cached_text, so a new turn only needs the text after it to be prefilled.
+# history holds the turns still in context_text with their token counts; summary, if set, stands in for the turns
+# dropped from it to stay within the context window.
+class Session(object):
+    def __init__(self, session_id, system_prompt, lora_adapter=""):
+        self.session_id = session_id
+        self.system_prompt = system_prompt
+        self.lora_adapter = lora_adapter # Name of the adapter every turn runs with, "" for the base model
+        self.context_text = None # None until the first turn has finished
+        self.cached_text = ""
+        self.cache_path = None
+        self.cache_size = 0
+        self.turns = 0
+        self.history = [] # context_window.Turn of every turn in context_text, oldest first
+        self.summary = ""
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock() # Held while a turn of this session runs
+
+
+# Sessions are evicted when idle for longer than idle_timeout seconds, and least recently used first when their
+# prompt caches exceed max_bytes or there are more than max_sessions.
+class SessionStore(object):
+    def __init__(self, session_dir=None, idle_timeout=600, max_bytes=0, max_sessions=0):
+        self.session_dir = session_dir # None keeps only the text history, every turn is prefilled in full
+        self.idle_timeout = idle_timeout
+        self.max_bytes = max_bytes # 0 means unlimited
+        self.max_sessions = max_sessions # 0 means unlimited
+        self.sessions = OrderedDict() # Least recently used first
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.trimmed_turns = 0
+        if session_dir:
+            os.makedirs(session_dir, exist_ok=True)
+            # Caches of a previous server process cannot be matched to a session any more.
+            for name in os.listdir(session_dir):
+                if name.endswith(SESSION_CACHE_SUFFIX):
+                    os.remove(os.path.join(session_dir, name))
+
+    def create(self, system_prompt, lora_adapter=""):
+        session = Session(uuid.uuid4().hex, system_prompt, lora_adapter)
+        with self.lock:
+            self.sessions[session.session_id] = session
+            evicted = self._evict()
+        self._remove_caches(evicted)
+        return session
+
+    def get(self, session_id):
+        with self.lock:
+            evicted = self._evict()
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+                self.sessions.move_to_end(session_id)
+        self._remove_caches(evicted)
+        return session
+
+    def delete(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self._remove_caches([session])
+        return session is not None
+
+    # Path the runtime should save the prompt cache of the next turn to, or None without a session directory.
+    def next_cache_path(self, session):
+        if not self.session_dir:
+            return None
+        return os.path.join(self.session_dir, f"{session.session_id}-{session.turns + 1}{SESSION_CACHE_SUFFIX}")
+
+    # Record a finished turn: input_text is the full prompt of the turn, reply the generated text and cache_path the
+    # prompt cache saved while prefilling input_text; turn, if given, is added to the history of the session.
+    def commit_turn(self, session, input_text, reply, separator, cache_path=None, turn=None):
+        old_cache_path = session.cache_path
+        with self.lock:
+            session.context_text = input_text + reply + separator
+            session.turns += 1
+            if turn is not None:
+                session.history.append(turn)
+            session.last_used = time.monotonic()
+            if cache_path and os.path.exists(cache_path):
+                session.cached_text = input_text
+                session.cache_path = cache_path
+                session.cache_size = os.path.getsize(cache_path)
+            else:
+                session.cached_text = ""
+                session.cache_path = None
+                session.cache_size = 0
+            if self.sessions.get(session.session_id) is not session:
+                # The session was evicted or deleted while the turn was running.
+                evicted = [session]
+            else:
+                evicted = self._evict()
+        if old_cache_path and old_cache_path != session.cache_path and os.path.exists(old_cache_path):
+            os.remove(old_cache_path)
+        self._remove_caches(evicted)
+
+    # Drop the oldest turns of a session's history: head is the prompt text in front of the remaining turns (prefix and
+    # summary). The prompt cache no longer matches the start of the context and is removed.
+    def trim(self, session, dropped, summary, head):
+        with self.lock:
+            old_cache_path = session.cache_path
+            session.history = session.history[dropped:]
+            session.summary = summary
+            session.context_text = head + "".join(turn.text for turn in session.history)
+            session.cached_text = ""
+            session.cache_path = None
+            session.cache_size = 0
+            self.trimmed_turns += dropped
+        if old_cache_path and os.path.exists(old_cache_path):
+            os.remove(old_cache_path)
+
+    def _evict(self):
+        # Called with self.lock held; sessions with a running turn are skipped.
+        evicted = []
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            if now - session.last_used > self.idle_timeout and not session.lock.locked():
+                evicted.append(self.sessions.pop(session_id))
+        for session_id, session in list(self.sessions.items()):
+            over_bytes = self.max_bytes and sum(s.cache_size for s in self.sessions.values()) > self.max_bytes
+            over_count = self.max_sessions and len(self.sessions) > self.max_sessions
+            if not (over_bytes or over_count):
+                break
+            if not session.lock.locked():
+                evicted.append(self.sessions.pop(session_id))
+        self.evictions += len(evicted)
+        return evicted
+
+    def _remove_caches(self, sessions):
+        for session in sessions:
+            if session.cache_path and os.path.exists(session.cache_path):
+                os.remove(session.cache_path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "cache_mib": round(sum(s.cache_size for s in self.sessions.values()) / 2**20, 1),
+                "evictions": self.evictions,
+                "trimmed_turns": self.trimmed_turns,
+            }
@@ -0,0 +1,64 @@
+import json
+
+# Stands in for the text of a chunk while a chunk template is serialized; json.dumps escapes the NUL characters, so the
+# encoded marker cannot occur in any other encoded value.
+CONTENT_MARKER = "\x00rkllm_content\x00"
+
+
+# When a streamed response sends the text generated so far. Pieces of text are collected into one chunk until it holds
+# max_tokens pieces (0 = no limit) or interval seconds have passed since its first piece; with interval 0, a chunk is
+# sent as soon as no further piece is waiting. The first piece of a stream is always sent at once, so the time to the
+# first token does not change. FlushPolicy() sends every piece in a chunk of its own.
+class FlushPolicy(object):
+    def __init__(self, interval=0.0, max_tokens=1):
+        self.interval = interval
+        self.max_tokens = max_tokens
+
+    # Whether a chunk whose first piece arrived waited seconds ago is sent without waiting for further pieces.
+    def full(self, n_pieces, waited):
+        if self.max_tokens > 0 and n_pieces >= self.max_tokens:
+            return True
+        return self.interval > 0 and waited >= self.interval
+
+    # How long to wait for the next piece of a chunk whose first piece arrived waited seconds ago; the chunk is sent if
+    # none arrives in time.
+    def wait(self, waited):
+        return max(0.0, self.interval - waited)
+
+    def describe(self):
+        return {"interval_ms": round(self.interval * 1000, 3), "max_tokens": self.max_tokens}
+
+
+EVERY_TOKEN = FlushPolicy()
+
+
+# A JSON payload serialized once with CONTENT_MARKER in place of the text, so a chunk only encodes its own text.
+# render(text) gives the same string as json.dumps of the payload holding text.
+class ChunkTemplate(object):
+    def __init__(self, payload, prefix="", suffix=""):
+        head, marker, tail = json.dumps(payload).partition(json.dumps(CONTENT_MARKER))
+        if not marker:
+            raise ValueError("the payload does not contain CONTENT_MARKER")
+        self.head = prefix + head
+        self.tail = tail + suffix
+
+    def render(self, text):
+        return self.head + json.dumps(text) + self.tail
+
+
+# The /rkllm_chat stream of the Flask server: every chunk repeats the choices of the chunks before it. Each choice is
+# encoded once when it is added, and a chunk only joins the encoded choices.
+class CumulativeChunks(object):
+    def __init__(self, response, suffix="\n\n"):
+        self.head, _, self.tail = json.dumps(dict(response, choices=CONTENT_MARKER)).partition(json.dumps(CONTENT_MARKER))
+        self.tail += suffix
+        self.choices = []
+        self.templates = {}
+
+    def render(self, index, text):
+        template = self.templates.get(index)
+        if template is None:
+            template = self.templates[index] = ChunkTemplate({"index": index, "delta": {"role": "assistant", "content": CONTENT_MARKER},
+                                                              "logprobs": None, "finish_reason": None})
+        self.choices.append(template.render(text))
+        return self.head + "[" + ", ".join(self.choices) + "]" + self.tail
@@ -0,0 +1,21 @@
+import codecs
+
+_Utf8Decoder = codecs.getincrementaldecoder("utf-8")
+
+
+# Decode the byte pieces of one generation to text as they arrive from the runtime callback.
+# A multi-byte character split over several tokens is held back until it is complete; bytes that can never form a
+# valid character (e.g. a stream that starts mid-character) become U+FFFD, so at most 3 bytes are ever buffered.
+class TokenDecoder(object):
+    def __init__(self):
+        self.decoder = _Utf8Decoder(errors="replace")
+
+    # Return the text completed by data, possibly "".
+    def decode(self, data):
+        if not data:
+            return ""
+        return self.decoder.decode(data)
+
+    # Return what is left at the end of the generation (a truncated character becomes U+FFFD) and reset.
+    def flush(self):
+        return self.decoder.decode(b"", final=True)
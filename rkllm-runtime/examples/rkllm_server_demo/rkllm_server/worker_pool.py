@@ -0,0 +1,200 @@
+import heapq
+import itertools
+import threading
+import time
+
+from admission import AdmissionRejected, CostModel, retry_after
+
+# Scheduling policies supported by the worker pool.
+SCHEDULE_FIFO = "fifo"
+SCHEDULE_PRIORITY = "priority"
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Hand out a fixed set of RKLLM instances to requests.
+# Waiting requests are served in arrival order (fifo) or by ascending priority value, ties broken by arrival (priority).
+# A request may pass match(worker) to prefer an idle instance that is already set up for it (e.g. with its sampling
+# parameters or LoRA adapter): the idle instance with the highest score is taken, and any idle one if none scores above 0.
+# A request may also belong to a Lane: lanes are served by rank before the schedule applies within a lane, and a request
+# is rejected right away (AdmissionRejected) when its lane queue is full or its predicted wait exceeds the lane's SLO.
+# The wait is predicted from the cost of the requests ahead and of the running ones, in seconds learned by cost_model.
+# When a request of a non-preemptible lane waits and no instance is idle, one instance running a preemptible lane of a
+# higher rank is asked to yield; its holder checks should_yield() and aborts its generation. Only holders that
+# acquired with preemptible=True are asked, as only they check should_yield(); one is asked per waiting request of a
+# non-preemptible lane.
+# governor, if given, is told the number of requests queued or running whenever it changes (see freq_governor).
+class WorkerPool(object):
+    def __init__(self, workers, schedule=SCHEDULE_FIFO, cost_model=None, governor=None):
+        if schedule not in (SCHEDULE_FIFO, SCHEDULE_PRIORITY):
+            raise ValueError(f"Unknown schedule: {schedule}")
+        self.workers = list(workers)
+        self.schedule = schedule
+        self.idle = list(self.workers)
+        self.waiters = []
+        self.tickets = itertools.count()
+        self.cond = threading.Condition()
+        self.cost_model = cost_model or CostModel()
+        self.waiting = {} # ticket -> (lane, cost)
+        self.running = {} # worker -> (lane, cost, start time, preemptible)
+        self.preempting = set() # Workers asked to yield to a request of a higher lane
+        self.governor = governor
+
+        # Statistics exposed through stats().
+        self.served = 0
+        self.timeouts = 0
+        self.matched = 0
+        self.mismatched = 0
+        self.rejected = 0
+        self.preemptions = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self, timeout=None, priority=0, match=None, lane=None, cost=0.0, preemptible=False):
+        rank = lane.rank if lane is not None else 0
+        ticket = (rank, priority if self.schedule == SCHEDULE_PRIORITY else 0, next(self.tickets))
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self.cond:
+            if lane is not None:
+                self._admit(lane, cost)
+            heapq.heappush(self.waiters, ticket)
+            self.waiting[ticket] = (lane, cost)
+            self._report_activity()
+            try:
+                while not (self.idle and self.waiters[0] == ticket):
+                    if not self.idle and lane is not None and not lane.preemptible:
+                        self._preempt(rank)
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(f"No RKLLM instance became available within {timeout}s")
+                    self.cond.wait(remaining)
+                heapq.heappop(self.waiters)
+                worker = self._take_idle(match)
+            except PoolTimeout:
+                self.waiters.remove(ticket)
+                heapq.heapify(self.waiters)
+                del self.waiting[ticket]
+                self._report_activity()
+                raise
+            finally:
+                self.waiting.pop(ticket, None)
+                # Another waiter may now be at the head of the queue.
+                self.cond.notify_all()
+
+            self.running[worker] = (lane, cost, time.monotonic(), preemptible and lane is not None and lane.preemptible)
+            waited = time.monotonic() - start
+            self.served += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            return worker
+
+    # Seconds until a request of the given rank would get an instance: the requests of its rank or better ahead of it,
+    # plus what is left of the running ones except those it may preempt, spread over all instances.
+    # Called with self.cond held.
+    def predicted_wait(self, rank):
+        if self.idle and not any(ticket[0] <= rank for ticket in self.waiters):
+            return 0.0
+        queued = sum(cost for ticket, (_, cost) in self.waiting.items() if ticket[0] <= rank)
+        now = time.monotonic()
+        running = 0.0
+        for lane, cost, started, preemptible in self.running.values():
+            if preemptible and lane.rank > rank:
+                continue
+            running += max(0.0, self.cost_model.seconds(cost) - (now - started))
+        return (self.cost_model.seconds(queued) + running) / max(1, len(self.workers))
+
+    # Called with self.cond held; raises AdmissionRejected.
+    def _admit(self, lane, cost):
+        wait = self.predicted_wait(lane.rank)
+        if lane.max_queue and sum(1 for queued_lane, _ in self.waiting.values()
+                                  if queued_lane is not None and queued_lane.name == lane.name) >= lane.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(f"The {lane.name} queue is full", retry_after(wait))
+        if lane.slo_seconds and self.cost_model.calibrated and wait > lane.slo_seconds:
+            self.rejected += 1
+            raise AdmissionRejected(f"The predicted wait of {wait:.1f}s exceeds the {lane.name} SLO of {lane.slo_seconds}s",
+                                    retry_after(wait - lane.slo_seconds))
+
+    # Ask the most recently started preemptible generation of a higher rank to yield, unless enough are yielding already
+    # for the waiting requests of non-preemptible lanes. Called with self.cond held.
+    def _preempt(self, rank):
+        waiting = sum(1 for lane, _ in self.waiting.values() if lane is not None and not lane.preemptible)
+        if len(self.preempting) >= waiting:
+            return
+        candidates = [(started, index, worker) for index, (worker, (lane, _, started, preemptible)) in enumerate(self.running.items())
+                      if preemptible and lane.rank > rank and worker not in self.preempting]
+        if candidates:
+            self.preempting.add(max(candidates)[2])
+            self.preemptions += 1
+
+    # Polled by the holder of a preemptible instance while it generates.
+    def should_yield(self, worker):
+        return worker in self.preempting
+
+    # Called with self.cond held.
+    def _take_idle(self, match):
+        if match is not None:
+            best_index, best_score = None, 0
+            for index in range(len(self.idle) - 1, -1, -1):
+                score = match(self.idle[index])
+                if score > best_score:
+                    best_index, best_score = index, score
+            if best_index is not None:
+                self.matched += 1
+                return self.idle.pop(best_index)
+            self.mismatched += 1
+        return self.idle.pop()
+
+    def release(self, worker):
+        with self.cond:
+            _, cost, started, _ = self.running.pop(worker, (None, 0.0, None, False))
+            preempted = worker in self.preempting
+            self.preempting.discard(worker)
+            self.idle.append(worker)
+            self._report_activity()
+            self.cond.notify_all()
+        if started is not None and not preempted:
+            self.cost_model.observe(cost, time.monotonic() - started)
+
+    # Called with self.cond held.
+    def _report_activity(self):
+        if self.governor is not None:
+            self.governor.set_active(len(self.waiting) + len(self.running))
+
+    # Called with self.cond held.
+    def _lane_depths(self):
+        depths = {}
+        for lane, _ in self.waiting.values():
+            if lane is not None:
+                depths[lane.name] = depths.get(lane.name, 0) + 1
+        return depths
+
+    def stats(self):
+        with self.cond:
+            return {
+                "schedule": self.schedule,
+                "instances": len(self.workers),
+                "idle_instances": len(self.idle),
+                "queue_depth": len(self.waiters),
+                "lane_queue_depth": self._lane_depths(),
+                "served": self.served,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "preemptions": self.preemptions,
+                "seconds_per_cost_unit": round(self.cost_model.seconds_per_unit, 4),
+                "matched": self.matched,
+                "mismatched": self.mismatched,
+                "avg_wait_seconds": self.total_wait / self.served if self.served else 0.0,
+                "max_wait_seconds": self.max_wait,
+            }
+
+    def close(self):
+        with self.cond:
+            for worker in self.workers:
+                worker.release()
+            self.workers = []
+            self.idle = []
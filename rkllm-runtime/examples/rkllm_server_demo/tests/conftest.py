@@ -0,0 +1,94 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import pytest
+
+# The server modules import each other as top-level modules, as they do when a server script is run from rkllm_server/.
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEMO_DIR = os.path.dirname(TESTS_DIR)
+SERVER_DIR = os.path.join(DEMO_DIR, "rkllm_server")
+BENCH_DIR = os.path.join(DEMO_DIR, "benchmark")
+STUB_LIB_PATH = os.path.join(BENCH_DIR, "build", "librkllmrt.so")
+sys.path.insert(0, SERVER_DIR)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# A server started with run_stub_server.py on the stub librkllmrt.so (built by benchmark/build_stub.sh).
+class StubServer(object):
+    def __init__(self, script, server_args, env):
+        if not os.path.exists(STUB_LIB_PATH):
+            pytest.skip("the stub librkllmrt.so is not built; run benchmark/build_stub.sh")
+        self.workdir = tempfile.TemporaryDirectory()
+        model_path = os.path.join(self.workdir.name, "stub.rkllm")
+        open(model_path, "a").close()
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.log_path = os.path.join(self.workdir.name, "server.log")
+        command = [sys.executable, os.path.join(BENCH_DIR, "run_stub_server.py"), script,
+                   "--rkllm_model_path", model_path, "--target_platform", "rk3588", "--no_token_echo",
+                   "--freq_mode", "none", "--port", str(self.port)] + list(server_args)
+        with open(self.log_path, "w") as log_file:
+            self.process = subprocess.Popen(command, env=dict(os.environ, **env), cwd=self.workdir.name,
+                                            stdout=log_file, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"The server exited with code {self.process.returncode}:\n{self.log()}")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.5).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        self.close()
+        raise RuntimeError("The server did not start listening within 60 seconds.")
+
+    def log(self):
+        with open(self.log_path) as log_file:
+            return log_file.read()
+
+    def request(self, method, path, body=None, headers=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request(self.url + path, data=data, method=method,
+                                     headers=dict({"Content-Type": "application/json"}, **(headers or {})))
+        try:
+            with urllib.request.urlopen(req, timeout=30) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def close(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.workdir.cleanup()
+
+
+# start_server(script="flask_server.py", *server_args, **stub_env) starts a stub server that is stopped after the test;
+# stub_env sets RKLLM_STUB_<NAME> variables, e.g. tokens=8.
+@pytest.fixture
+def start_server():
+    servers = []
+
+    def start(script="flask_server.py", *server_args, **stub_env):
+        env = {"RKLLM_STUB_" + name.upper(): str(value) for name, value in stub_env.items()}
+        server = StubServer(script, server_args, env)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
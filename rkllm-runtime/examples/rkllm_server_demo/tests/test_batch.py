@@ -0,0 +1,44 @@
+import json
+import urllib.request
+
+STUB = {"tokens": 4, "token_us": 0}
+
+
+# POST a JSONL file to /rkllm_batch as multipart/form-data; returns (status, body text).
+def upload_batch(server, lines, **form):
+    boundary = "rkllm-test-boundary"
+    parts = ["--{}\r\nContent-Disposition: form-data; name=\"{}\"\r\n\r\n{}\r\n".format(boundary, name, value)
+             for name, value in form.items()]
+    parts.append("--{}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"batch.jsonl\"\r\n"
+                 "Content-Type: application/jsonl\r\n\r\n{}\r\n".format(boundary, "\n".join(lines)))
+    body = ("".join(parts) + "--{}--\r\n".format(boundary)).encode("utf-8")
+    req = urllib.request.Request(server.url + "/rkllm_batch", data=body,
+                                 headers={"Content-Type": "multipart/form-data; boundary=" + boundary})
+    try:
+        with urllib.request.urlopen(req, timeout=30) as response:
+            return response.status, response.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode("utf-8")
+
+
+def test_batch_file(start_server):
+    server = start_server("flask_server.py", **STUB)
+    status, body = upload_batch(server, ['{"prompt": "Hello"}', "", '"World"'])
+    assert status == 200
+    results = [json.loads(line) for line in body.splitlines()]
+    assert sorted(result["id"] for result in results if result["object"] == "rkllm_batch.item") == [0, 1]
+
+
+def test_malformed_batch_line_is_rejected(start_server):
+    server = start_server("flask_server.py", **STUB)
+    status, body = upload_batch(server, ['{"prompt": "Hello"}', '{"prompt": '])
+    assert status == 400
+    assert "line 2" in json.loads(body)["message"]
+
+
+def test_invalid_max_instances_is_rejected(start_server):
+    server = start_server("flask_server.py", **STUB)
+    for value in ("two", None, 0):
+        status, response = server.request("POST", "/rkllm_batch", {"prompts": ["Hello"], "max_instances": value})
+        assert status == 400, value
+        assert "max_instances" in response["message"]
@@ -0,0 +1,55 @@
+import asyncio
+import sys
+
+import pytest
+
+from conftest import DEMO_DIR
+
+sys.path.insert(0, DEMO_DIR)
+from rkllm_client import RKLLMClient, AsyncRKLLMClient  # noqa: E402
+
+STUB = {"tokens": 8, "token_us": 0}
+
+
+def test_client_reuses_connections(start_server):
+    server = start_server("flask_server.py", **STUB)
+    with RKLLMClient(server.url, max_retries=0) as client:
+        for _ in range(5):
+            assert client.chat("Hello", max_tokens=4).content.count("tok") == 4
+        stream = client.stream_chat("Hello", max_tokens=4)
+        assert "".join(stream).count("tok") == 4
+        assert client.pool.connects == 1
+
+
+def test_async_client_reuses_connections(start_server):
+    server = start_server("flask_server.py", **STUB)
+
+    async def run():
+        async with AsyncRKLLMClient(server.url, max_retries=0) as client:
+            for _ in range(5):
+                assert (await client.chat("Hello", max_tokens=4)).content.count("tok") == 4
+            stream = await client.stream_chat("Hello", max_tokens=4)
+            assert "".join([delta async for delta in stream]).count("tok") == 4
+            return client.pool.connects
+    assert asyncio.run(run()) == 1
+
+
+# A server that sends the headers of a reply and then stops sending must not block the client beyond its timeout.
+def test_async_client_times_out_on_stalled_body():
+    async def stall(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n{")
+        await writer.drain()
+        await asyncio.sleep(5)
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(stall, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            async with AsyncRKLLMClient(f"http://127.0.0.1:{port}", timeout=0.5, max_retries=0) as client:
+                started = asyncio.get_running_loop().time()
+                with pytest.raises(asyncio.TimeoutError):
+                    await client.chat("Hello")
+                return asyncio.get_running_loop().time() - started
+    assert asyncio.run(run()) < 3
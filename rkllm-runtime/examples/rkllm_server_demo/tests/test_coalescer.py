@@ -0,0 +1,54 @@
+import pytest
+
+from coalescer import RequestCoalescer
+
+
+def run_generation(coalescer, key, text="Hello", finish_reason="stop"):
+    generation, producer = coalescer.join(key)
+    if producer:
+        generation.publish(0, text)
+        generation.finish_choice(0, finish_reason)
+        coalescer.complete(generation)
+    events = list(generation.follow())
+    generation.unsubscribe()
+    return producer, events
+
+
+def test_repeat_is_served_from_cache():
+    coalescer = RequestCoalescer(cache_ttl=60)
+    key = RequestCoalescer.make_key("model", ["Hi"])
+    assert run_generation(coalescer, key) == (True, [(0, "Hello")])
+    assert run_generation(coalescer, key) == (False, [(0, "Hello")])
+    stats = coalescer.stats()
+    assert stats["generations"] == 1
+    assert stats["cache_hits"] == 1
+    assert stats["cache_entries"] == 1
+
+
+def test_failed_generation_is_not_cached():
+    coalescer = RequestCoalescer(cache_ttl=60)
+    key = RequestCoalescer.make_key("model", ["Hi"])
+    run_generation(coalescer, key, finish_reason="error")
+    producer, _ = run_generation(coalescer, key)
+    assert producer
+    assert coalescer.stats()["cache_hits"] == 0
+
+
+def test_identical_requests_hit_the_response_cache(start_server):
+    server = start_server("flask_server.py", "--response_cache_ttl", "60", tokens=8)
+    body = {"model": "stub", "messages": [{"role": "user", "content": "Hello"}], "stream": False}
+    first_status, first = server.request("POST", "/rkllm_chat", body)
+    second_status, second = server.request("POST", "/rkllm_chat", body)
+    assert first_status == second_status == 200
+    assert second["choices"] == first["choices"]
+    _, status = server.request("GET", "/rkllm_status")
+    assert status["coalescer"]["cache_hits"] == 1
+    assert status["coalescer"]["generations"] == 1
+    assert "Traceback" not in server.log()
+
+
+def test_malformed_warm_prompts_stop_the_server(start_server, tmp_path):
+    warm_path = tmp_path / "warm.jsonl"
+    warm_path.write_text('{"messages": [{"role": "user", "content": "Hello"}]}\n\n{"messages": \n')
+    with pytest.raises(RuntimeError, match="line 3 of"):
+        start_server("flask_server.py", "--warm_prompts", str(warm_path), tokens=4, token_us=0)
@@ -0,0 +1,45 @@
+import ctypes
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from embeddings import HiddenStateBuffer, pool, POOLING_LAST  # noqa: E402
+
+
+# The fields of RKLLMResultLastHiddenLayer that HiddenStateBuffer reads.
+class HiddenLayer(ctypes.Structure):
+    _fields_ = [("hidden_states", ctypes.POINTER(ctypes.c_float)), ("embd_size", ctypes.c_int), ("num_tokens", ctypes.c_int)]
+
+
+def hidden_layer(values):
+    data = (ctypes.c_float * values.size)(*values.ravel())
+    return HiddenLayer(ctypes.cast(data, ctypes.POINTER(ctypes.c_float)), values.shape[1], values.shape[0]), data
+
+
+def test_buffer_grows_to_the_input_and_is_reused():
+    buffer = HiddenStateBuffer()
+    assert buffer.states() is None
+    long_input = np.arange(12, dtype=np.float32).reshape(4, 3)
+    layer, _ = hidden_layer(long_input)
+    assert buffer.copy_from(layer)
+    assert buffer.array.shape == (4, 3)
+    np.testing.assert_array_equal(buffer.states(), long_input)
+    array = buffer.array
+
+    buffer.reset()
+    assert buffer.states() is None
+    short_input = np.ones((2, 3), dtype=np.float32)
+    layer, _ = hidden_layer(short_input)
+    assert buffer.copy_from(layer)
+    assert buffer.array is array
+    np.testing.assert_array_equal(buffer.states(), short_input)
+
+
+def test_pooled_vector_does_not_share_the_buffer():
+    buffer = HiddenStateBuffer()
+    layer, _ = hidden_layer(np.arange(6, dtype=np.float32).reshape(2, 3))
+    buffer.copy_from(layer)
+    vector = pool(buffer.states(), POOLING_LAST, normalize=False)
+    buffer.array[:] = 0
+    np.testing.assert_array_equal(vector, [3, 4, 5])
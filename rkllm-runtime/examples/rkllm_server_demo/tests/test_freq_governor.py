@@ -0,0 +1,117 @@
+import json
+import os
+import sys
+import time
+
+import pytest
+
+import freq_governor
+from freq_governor import FrequencyGovernor, STATE_FILE, USERSPACE_GOVERNOR
+from conftest import BENCH_DIR
+
+sys.path.insert(0, BENCH_DIR)
+from run_stub_server import make_fake_sysfs
+
+NPU_GOVERNOR = "sys/class/devfreq/fdab0000.npu/governor"
+CPU0_GOVERNOR = "sys/devices/system/cpu/cpufreq/policy0/scaling_governor"
+
+
+def read(root, path):
+    with open(os.path.join(root, path)) as sysfs_file:
+        return sysfs_file.read().strip()
+
+
+def write(root, path, value):
+    with open(os.path.join(root, path), "w") as sysfs_file:
+        sysfs_file.write(value)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    make_fake_sysfs(str(tmp_path), "rk3588")
+    return str(tmp_path)
+
+
+def test_boost_and_relax(sysfs):
+    governor = FrequencyGovernor("rk3588", sysfs, idle_seconds=0.1, sample_interval=0.05, cpuidle=True)
+    try:
+        assert governor.controls_clocks()
+        assert os.path.exists(os.path.join(sysfs, STATE_FILE))
+        governor.set_active(1)
+        assert wait_for(lambda: governor.stats()["boosted"])
+        assert read(sysfs, NPU_GOVERNOR) == USERSPACE_GOVERNOR
+        assert read(sysfs, "sys/class/devfreq/fdab0000.npu/userspace/set_freq") == "1000000000"
+        assert read(sysfs, "sys/devices/system/cpu/cpu0/cpuidle/state1/disable") == "1"
+        governor.set_active(0)
+        assert wait_for(lambda: not governor.stats()["boosted"])
+        assert read(sysfs, NPU_GOVERNOR) == "simple_ondemand"
+        assert read(sysfs, CPU0_GOVERNOR) == "schedutil"
+        assert read(sysfs, "sys/devices/system/cpu/cpu0/cpuidle/state1/disable") == "0"
+    finally:
+        governor.close()
+    assert not os.path.exists(os.path.join(sysfs, STATE_FILE))
+
+
+def test_close_relaxes_boosted_clocks(sysfs):
+    governor = FrequencyGovernor("rk3588", sysfs, idle_seconds=60)
+    governor.set_active(1)
+    assert wait_for(lambda: governor.stats()["boosted"])
+    governor.close()
+    assert read(sysfs, NPU_GOVERNOR) == "simple_ondemand"
+
+
+# A server killed while boosted leaves the domains in userspace; the next one restores the governors it saved.
+def test_saved_governors_survive_a_killed_server(sysfs):
+    governor = FrequencyGovernor("rk3588", sysfs, idle_seconds=60)
+    governor.set_active(1)
+    assert wait_for(lambda: governor.stats()["boosted"])
+    governor.stop.set()
+    governor.wake.set()
+    governor.thread.join()
+    assert read(sysfs, NPU_GOVERNOR) == USERSPACE_GOVERNOR
+
+    write(sysfs, "sys/class/devfreq/fdab0000.npu/available_governors", "userspace")
+    restarted = FrequencyGovernor("rk3588", sysfs, idle_seconds=60)
+    restarted.set_active(1)
+    assert wait_for(lambda: restarted.stats()["boosted"])
+    restarted.close()
+    assert read(sysfs, NPU_GOVERNOR) == "simple_ondemand"
+    assert read(sysfs, CPU0_GOVERNOR) == "schedutil"
+
+
+def test_userspace_at_startup_is_given_a_kernel_governor(sysfs):
+    write(sysfs, NPU_GOVERNOR, USERSPACE_GOVERNOR)
+    governor = FrequencyGovernor("rk3588", sysfs, idle_seconds=60)
+    governor.set_active(1)
+    assert wait_for(lambda: governor.stats()["boosted"])
+    governor.close()
+    assert read(sysfs, NPU_GOVERNOR) == "simple_ondemand"
+
+
+def test_state_file_is_json(sysfs):
+    governor = FrequencyGovernor("rk3588", sysfs)
+    try:
+        with open(os.path.join(sysfs, STATE_FILE)) as state_file:
+            saved = json.load(state_file)
+        assert saved[os.path.join(sysfs, "sys/class/devfreq/fdab0000.npu")] == "simple_ondemand"
+    finally:
+        governor.close()
+
+
+def test_read_only_sysfs_is_not_managed(sysfs, monkeypatch):
+    monkeypatch.setattr(freq_governor.os, "access", lambda path, mode: False)
+    governor = FrequencyGovernor("rk3588", sysfs)
+    try:
+        assert not governor.controls_clocks()
+        assert not os.path.exists(os.path.join(sysfs, STATE_FILE))
+    finally:
+        governor.close()
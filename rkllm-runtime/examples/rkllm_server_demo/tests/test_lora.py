@@ -0,0 +1,59 @@
+import json
+import os
+
+import pytest
+
+from lora_registry import adapter_path
+
+
+@pytest.fixture
+def lora_dir(tmp_path):
+    directory = tmp_path / "lora"
+    directory.mkdir()
+    (directory / "medic.rkllm_lora").write_bytes(b"")
+    (tmp_path / "lora2").mkdir()
+    (tmp_path / "lora2" / "other.rkllm_lora").write_bytes(b"")
+    (tmp_path / "secret.rkllm_lora").write_bytes(b"")
+    os.symlink(tmp_path / "secret.rkllm_lora", directory / "link.rkllm_lora")
+    return directory
+
+
+def test_adapter_path_inside_directory(lora_dir):
+    expected = os.path.realpath(lora_dir / "medic.rkllm_lora")
+    assert adapter_path(str(lora_dir), "medic.rkllm_lora") == expected
+    assert adapter_path(str(lora_dir), str(lora_dir / "medic.rkllm_lora")) == expected
+
+
+@pytest.mark.parametrize("path", ["../secret.rkllm_lora", "../lora2/other.rkllm_lora", "link.rkllm_lora", "/etc/passwd"])
+def test_adapter_path_outside_directory(lora_dir, path):
+    with pytest.raises(ValueError):
+        adapter_path(str(lora_dir), path)
+
+
+def test_registration_stays_in_adapter_directory(start_server, lora_dir):
+    server = start_server("flask_server.py", "--lora_dir", str(lora_dir), tokens=4)
+
+    assert server.request("POST", "/rkllm_lora", {"name": "leak", "path": "../secret.rkllm_lora"})[0] == 400
+    status, response = server.request("POST", "/rkllm_lora", {"name": "medic", "path": "medic.rkllm_lora"})
+    assert status == 200
+    assert response["adapter"]["path"] == os.path.realpath(lora_dir / "medic.rkllm_lora")
+    assert server.request("DELETE", "/rkllm_lora/medic")[0] == 200
+
+
+def test_registration_needs_key(start_server, lora_dir, tmp_path):
+    api_keys = tmp_path / "api_keys.json"
+    api_keys.write_text(json.dumps({"secret-key": "interactive"}))
+    server = start_server("flask_server.py", "--api_keys", str(api_keys), "--lora_dir", str(lora_dir), tokens=4)
+    key = {"Authorization": "Bearer secret-key"}
+
+    assert server.request("POST", "/rkllm_lora", {"name": "medic", "path": "medic.rkllm_lora"})[0] == 401
+    assert server.request("POST", "/rkllm_lora", {"name": "medic", "path": "medic.rkllm_lora"}, {"X-API-Key": "wrong"})[0] == 401
+    assert server.request("POST", "/rkllm_lora", {"name": "medic", "path": "medic.rkllm_lora"}, key)[0] == 200
+    assert server.request("DELETE", "/rkllm_lora/medic")[0] == 401
+    assert server.request("DELETE", "/rkllm_lora/medic", headers=key)[0] == 200
+
+
+def test_registration_is_off_without_adapter_directory(start_server, lora_dir):
+    server = start_server("flask_server.py", tokens=4)
+    status, _ = server.request("POST", "/rkllm_lora", {"name": "medic", "path": str(lora_dir / "medic.rkllm_lora")})
+    assert status == 403
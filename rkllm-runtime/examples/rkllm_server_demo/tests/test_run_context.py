@@ -0,0 +1,28 @@
+import pytest
+
+from rkllm_runtime import LLMCallState
+from run_context import RunContext
+
+
+class ListContext(RunContext):
+    def __init__(self):
+        RunContext.__init__(self)
+        self.items = []
+
+    def put(self, state, text=None):
+        self.items.append((state, text))
+
+
+def test_run_context_requires_put():
+    with pytest.raises(TypeError):
+        RunContext()
+
+
+def test_finish_flushes_held_back_bytes():
+    context = ListContext()
+    context.handle(None, LLMCallState.RKLLM_RUN_FINISH)
+    assert context.items == [(LLMCallState.RKLLM_RUN_FINISH, None)]
+    context = ListContext()
+    context.decoder.decode("中".encode("utf-8")[:2])
+    context.handle(None, LLMCallState.RKLLM_RUN_FINISH)
+    assert context.items == [(LLMCallState.RKLLM_RUN_NORMAL, "�"), (LLMCallState.RKLLM_RUN_FINISH, None)]
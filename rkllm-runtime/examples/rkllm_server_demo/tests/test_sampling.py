@@ -0,0 +1,43 @@
+import json
+import urllib.request
+
+import pytest
+
+from sampling import SamplingParams
+
+
+def chat(server, **fields):
+    body = dict({"model": "stub", "messages": [{"role": "user", "content": "Hello"}], "stream": False}, **fields)
+    req = urllib.request.Request(server.url + "/v1/chat/completions", data=json.dumps(body).encode("utf-8"),
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=30) as response:
+        return json.loads(response.headers["X-RKLLM-Sampling"])
+
+
+def test_request_fields_override_defaults():
+    sampling = SamplingParams(top_k=40).with_request({"temperature": 0.7, "top_p": None})
+    assert sampling.values["temperature"] == 0.7
+    assert sampling.values["top_p"] == 0.9
+    assert SamplingParams(top_k=40).with_request({"temperature": 0}).greedy
+
+
+def test_invalid_request_value_is_rejected():
+    with pytest.raises(ValueError):
+        SamplingParams().with_request({"top_p": 0})
+
+
+def test_request_sampling_is_ignored_by_default(start_server):
+    server = start_server("flask_server.py", tokens=4)
+    for _ in range(3):
+        assert chat(server, temperature=0.3, top_p=0.5) == SamplingParams().values
+    _, status = server.request("GET", "/rkllm_status")
+    assert status["request_sampling"] is False
+    assert status["sampling"] == [SamplingParams().values]
+
+
+def test_request_sampling_reconfigures_the_handle(start_server):
+    server = start_server("flask_server.py", "--request_sampling", tokens=4)
+    applied = chat(server, temperature=0.3, top_p=0.5)
+    assert (applied["temperature"], applied["top_p"]) == (0.3, 0.5)
+    _, status = server.request("GET", "/rkllm_status")
+    assert status["sampling"] == [applied]
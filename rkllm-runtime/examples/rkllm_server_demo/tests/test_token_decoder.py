@@ -0,0 +1,50 @@
+import pytest
+
+from token_decoder import TokenDecoder
+
+
+def decode_pieces(pieces):
+    decoder = TokenDecoder()
+    texts = [decoder.decode(piece) for piece in pieces]
+    return texts, decoder.flush()
+
+
+@pytest.mark.parametrize("char", ["é", "中", "🚀"])
+def test_character_split_over_callbacks(char):
+    data = char.encode("utf-8")
+    pieces = [data[index:index + 1] for index in range(len(data))]
+    texts, rest = decode_pieces([b"a"] + pieces + [b"b"])
+    assert texts == ["a"] + [""] * (len(data) - 1) + [char, "b"]
+    assert rest == ""
+
+
+def test_split_across_token_boundaries():
+    data = "a中🚀b".encode("utf-8")
+    texts, rest = decode_pieces([data[:2], data[2:5], data[5:7], data[7:]])
+    assert texts == ["a", "中", "", "🚀b"]
+    assert rest == ""
+
+
+def test_invalid_bytes_become_replacement_characters():
+    texts, rest = decode_pieces([b"\x9f", b"ok", b"\xff\xfe", "中".encode("utf-8")])
+    assert texts == ["�", "ok", "��", "中"]
+    assert rest == ""
+
+
+def test_sequence_broken_by_another_character():
+    texts, rest = decode_pieces([b"\xe4\xb8", b"a"])
+    assert texts == ["", "�a"]
+    assert rest == ""
+
+
+def test_partial_sequence_is_flushed_at_finish():
+    decoder = TokenDecoder()
+    assert decoder.decode("ok".encode("utf-8") + "🚀".encode("utf-8")[:3]) == "ok"
+    assert decoder.flush() == "�"
+    # flush() resets the decoder for the next run.
+    assert decoder.decode("é".encode("utf-8")) == "é"
+    assert decoder.flush() == ""
+
+
+def test_empty_piece():
+    assert decode_pieces([b"", None]) == (["", ""], "")
@@ -0,0 +1,43 @@
+import json
+import urllib.request
+
+# The stub emits "tok " per token without a delay, so the runtime is always ahead of the request that reads its output.
+STUB = {"tokens": 64, "token_us": 0}
+
+
+def post_lines(server, path, body):
+    req = urllib.request.Request(server.url + path, data=json.dumps(body).encode("utf-8"),
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=30) as response:
+        return [line for line in response.read().decode("utf-8").splitlines() if line.strip()]
+
+
+def test_usage_counts_delivered_tokens(start_server):
+    server = start_server("flask_server.py", **STUB)
+    body = {"model": "stub", "messages": [{"role": "user", "content": "Hello"}], "max_tokens": 5}
+    for _ in range(5):
+        _, response = server.request("POST", "/v1/chat/completions", body)
+        assert response["choices"][0]["message"]["content"].count("tok") == 5
+        assert response["usage"]["completion_tokens"] == 5
+
+
+def test_streamed_usage_counts_delivered_tokens(start_server):
+    server = start_server("flask_server.py", **STUB)
+    body = {"model": "stub", "messages": [{"role": "user", "content": "Hello"}], "max_tokens": 4, "stream": True,
+            "stream_options": {"include_usage": True}}
+    events = [json.loads(line[len("data: "):]) for line in post_lines(server, "/v1/chat/completions", body)
+              if line.startswith("data: ") and line != "data: [DONE]"]
+    text = "".join(choice["delta"].get("content") or "" for event in events for choice in event["choices"])
+    assert text.count("tok") == 4
+    assert events[-1]["usage"]["completion_tokens"] == 4
+
+
+def test_batch_usage_counts_delivered_tokens(start_server):
+    server = start_server("flask_server.py", **STUB)
+    body = {"prompts": ["Hello", "World"], "max_tokens": 4}
+    results = [json.loads(line) for line in post_lines(server, "/rkllm_batch", body)]
+    items = [result for result in results if result.get("object") == "rkllm_batch.item"]
+    assert len(items) == 2
+    for item in items:
+        assert item["content"].count("tok") == 4
+        assert item["completion_tokens"] == 4
@@ -0,0 +1,98 @@
+import threading
+import time
+
+import pytest
+
+from admission import Lane
+from batch_runner import BatchRunner
+from worker_pool import WorkerPool, PoolTimeout
+
+INTERACTIVE = Lane("interactive", 0)
+BATCH = Lane("batch", 10, preemptible=True)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_holder_that_does_not_yield_is_not_preempted():
+    pool = WorkerPool(["a"])
+    worker = pool.acquire(lane=BATCH)
+    with pytest.raises(PoolTimeout):
+        pool.acquire(timeout=0.1, lane=INTERACTIVE)
+    assert not pool.should_yield(worker)
+    assert pool.stats()["preemptions"] == 0
+
+
+def test_one_holder_is_preempted_per_waiting_request():
+    pool = WorkerPool(["a", "b", "c"])
+    workers = [pool.acquire(lane=BATCH, preemptible=True) for _ in range(3)]
+    waiters = [threading.Thread(target=pool.acquire, kwargs={"timeout": 5, "lane": INTERACTIVE}) for _ in range(2)]
+    for waiter in waiters:
+        waiter.start()
+    assert wait_for(lambda: pool.stats()["preemptions"] == 2)
+    yielding = [worker for worker in workers if pool.should_yield(worker)]
+    assert len(yielding) == 2
+    for worker in yielding:
+        pool.release(worker)
+    for waiter in waiters:
+        waiter.join()
+    assert pool.stats()["preemptions"] == 2
+
+
+def test_preempted_item_runs_again():
+    pool = WorkerPool(["a"])
+    runs = []
+
+    def run_item(worker, item, cancelled):
+        runs.append(item)
+        if len(runs) == 1:
+            pool.preempting.add(worker) # As if a request of a higher lane were waiting
+            assert cancelled.is_set()
+            return {"content": "", "finish_reason": "cancelled"}
+        return {"content": item, "finish_reason": "stop"}
+
+    results = list(BatchRunner(pool, ["x"], run_item, lane=BATCH))
+    assert runs == ["x", "x"]
+    assert results == [(0, {"content": "x", "finish_reason": "stop"})]
+
+
+def test_item_finished_before_the_preemption_keeps_its_result():
+    pool = WorkerPool(["a"])
+    runs = []
+
+    def run_item(worker, item, cancelled):
+        runs.append(item)
+        pool.preempting.add(worker) # The request to yield arrives after the last check of cancelled
+        return {"content": item, "finish_reason": "stop"}
+
+    results = list(BatchRunner(pool, ["x"], run_item, lane=BATCH))
+    assert runs == ["x"]
+    assert results == [(0, {"content": "x", "finish_reason": "stop"})]
+
+
+@pytest.mark.parametrize("path, body", [
+    ("/rkllm_chat", {"messages": [{"role": "user", "content": "Hello"}]}),
+    ("/v1/chat/completions", {"messages": [{"role": "user", "content": "Hello"}]}),
+    ("/v1/embeddings", {"input": "Hello"}),
+])
+def test_invalid_priority_is_rejected(start_server, path, body):
+    server = start_server("flask_server.py", tokens=4, token_us=0)
+    for priority in ("high", None):
+        status, _ = server.request("POST", path, dict(body, priority=priority))
+        assert status == 400, (path, priority)
+    status, _ = server.request("POST", "/rkllm_chat", {"messages": [{"role": "user", "content": "Hello"}], "priority": "3"})
+    assert status == 200
+
+
+def test_invalid_priority_is_rejected_by_the_asgi_server(start_server):
+    pytest.importorskip("uvicorn")
+    server = start_server("asgi_server.py", tokens=4, token_us=0)
+    status, response = server.request("POST", "/rkllm_chat", {"messages": [{"role": "user", "content": "Hello"}], "priority": "high"})
+    assert status == 400
+    assert "priority" in response["message"]